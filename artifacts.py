@@ -0,0 +1,570 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import catalogue
+import telemetry
+
+# INSTRUCTIONS:
+# declare a manager once per process using
+# artifact_manager = artifacts.ArtifactManager([source][, max_bytes=budget])
+# where source is artifacts.HubSource() (default, the Hugging Face hub) or
+# artifacts.MirrorSource(folder), a copy of another models folder (i.e. on
+# a network share or a USB disk, useful offline). The HAPPYCHATTER_MIRROR
+# environment variable selects a mirror too.
+# Start the download of a model as soon as it is chosen using
+# artifact_manager.prefetch(model_type_as_in_neo)
+# it returns at once: the files are copied in background, in chunks of
+# chunk_bytes by several threads, into models/<model>/.partial (so an
+# interrupted download resumes where it stopped), checked against the
+# checksums of the source and moved in place. A manifest with the size and
+# the sha256 of every file is written in models/<model>/artifact.json.
+# The state of a model ("absent", "queued", "downloading", "verifying",
+# "ready" or "failed", with the bytes done) is read using
+# artifact_manager.state(model) or artifact_manager.ready(model)
+# and a worker thread can wait for it using
+# artifact_manager.wait(model[, progress=callback][, should_stop=callback])
+# The downloaded models must fit in max_bytes: the least recently used ones
+# (see touch) are deleted first, never the ones returned by in_use() nor
+# the trained checkpoints. Files written later in the folder by neo.GPTNeo
+# are added to the manifest using
+# artifacts.record_files(model) A model can be checked again using
+# artifact_manager.verify(model)
+# Statistics can be read using
+# artifact_manager.stats()
+
+MANIFEST = "artifact.json"
+PARTIAL = ".partial"
+
+# NOTE Files of a model folder meaning the weights are there
+WEIGHTS = ("model.safetensors", "model.safetensors.index.json",
+           "pytorch_model.bin", "pytorch_model.bin.index.json")
+
+# NOTE Weights of other frameworks and repository files, never loaded
+SKIPPED = (".h5", ".msgpack", ".ot", ".onnx", ".md", ".gitattributes")
+
+
+def is_ready(model, folder="models"):
+    path = folder + "/" + model
+    return (os.path.exists(path + "/" + MANIFEST) or
+            any(os.path.exists(path + "/" + name) for name in WEIGHTS))
+
+
+def sha256_of(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as stream:
+        for chunk in iter(lambda: stream.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# NOTE Small files of the hub are checked by their git blob id
+def git_sha1_of(path):
+    digest = hashlib.sha1()
+    digest.update(b"blob " + str(os.path.getsize(path)).encode() + b"\0")
+    with open(path, "rb") as stream:
+        for chunk in iter(lambda: stream.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_json(path, data):
+    # NOTE The manager and the model loader may write the same manifest
+    temporary = path + "." + str(threading.get_ident()) + ".tmp"
+    with open(temporary, "w") as json_stream:
+        json.dump(data, json_stream, indent=2)
+    os.replace(temporary, path)
+
+
+# ANCHOR Files written after the download
+# NOTE neo.GPTNeo writes in the model folder too: the mappable copy of the
+#      weights, the files saved again by happytransformer and the converted
+#      precisions. They are added to the manifest (with their checksum), so
+#      verify and the disk budget see them. The checkpoints and training
+#      data are not part of the artifact.
+RECORDED = ("precision",)
+
+
+def artifact_files(path):
+    names = [name for name in os.listdir(path)
+             if os.path.isfile(path + "/" + name) and
+             name != MANIFEST and not name.endswith(".tmp")]
+    for folder in RECORDED:
+        for root, _, files in os.walk(path + "/" + folder):
+            names.extend(os.path.relpath(os.path.join(root, name), path)
+                         .replace(os.sep, "/") for name in files)
+    return names
+
+
+def record_files(model, folder="models"):
+    path = folder + "/" + model
+    manifest_path = path + "/" + MANIFEST
+    if not os.path.exists(manifest_path):
+        # NOTE Not managed (yet), adopted by the next scan
+        return False
+    with open(manifest_path) as manifest_stream:
+        manifest = json.load(manifest_stream)
+    recorded = manifest.get("recorded", manifest["fetched"])
+    names = artifact_files(path)
+    changed = False
+    for name in names:
+        file_path = path + "/" + name
+        entry = manifest["files"].get(name)
+        size = os.path.getsize(file_path)
+        # NOTE Adopted files have no checksum, only their size is compared
+        if (entry is not None and entry["size"] == size and
+                (entry["sha256"] is None or
+                 os.path.getmtime(file_path) <= recorded)):
+            continue
+        manifest["files"][name] = {"size": size,
+                                   "sha256": sha256_of(file_path)}
+        changed = True
+    # NOTE Converted precisions are replaced as a whole
+    for name in list(manifest["files"]):
+        if (name.startswith(tuple(folder + "/" for folder in RECORDED)) and
+                name not in names):
+            del manifest["files"][name]
+            changed = True
+    if changed:
+        manifest["recorded"] = time.time()
+        write_json(manifest_path, manifest)
+    return changed
+
+
+# ANCHOR Sources
+# NOTE A source lists the files of a model as dictionaries with "path",
+#      "size" and optionally "sha256" or "git_sha1", and copies a byte
+#      range of one of them into an open file
+class MirrorSource:
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.name = "mirror:" + folder
+
+    def files(self, model):
+        root = self.folder + "/" + model
+        if not os.path.isdir(root):
+            raise Exception("Model " + model + " not found in " + self.folder)
+        checksums = {}
+        # NOTE A mirror made of a managed models folder has the checksums
+        if os.path.exists(root + "/" + MANIFEST):
+            with open(root + "/" + MANIFEST) as manifest_stream:
+                checksums = json.load(manifest_stream)["files"]
+        files = []
+        for name in sorted(os.listdir(root)):
+            if (name == MANIFEST or name.endswith(SKIPPED) or
+                    not os.path.isfile(root + "/" + name)):
+                continue
+            files.append({"path": name,
+                          "size": os.path.getsize(root + "/" + name),
+                          "sha256": checksums.get(name, {}).get("sha256")})
+        return files
+
+    def copy(self, model, path, start, length, stream):
+        with open(self.folder + "/" + model + "/" + path, "rb") as source:
+            source.seek(start)
+            while length > 0:
+                data = source.read(min(length, 1024 * 1024))
+                if not data:
+                    raise Exception("Short read of " + path)
+                stream.write(data)
+                length -= len(data)
+
+
+class HubSource:
+
+    def __init__(self, endpoint="https://huggingface.co"):
+        self.endpoint = endpoint
+        self.name = "hub"
+
+    def repo(self, model):
+        return catalogue.repo(model)
+
+    def files(self, model):
+        from huggingface_hub import HfApi
+        info = HfApi(endpoint=self.endpoint).model_info(self.repo(model),
+                                                       files_metadata=True)
+        siblings = [sibling for sibling in info.siblings
+                    if "/" not in sibling.rfilename and
+                    not sibling.rfilename.endswith(SKIPPED)]
+        names = set(sibling.rfilename for sibling in siblings)
+        # NOTE The safetensors weights are enough when there are some,
+        #      they are mapped instead of unpickled (see neo.load_mmap)
+        if names & {"model.safetensors", "model.safetensors.index.json"}:
+            siblings = [sibling for sibling in siblings
+                        if not sibling.rfilename.startswith("pytorch_model")]
+        files = []
+        for sibling in siblings:
+            lfs = sibling.lfs
+            if isinstance(lfs, dict):
+                sha256 = lfs.get("sha256")
+            else:
+                sha256 = getattr(lfs, "sha256", None)
+            files.append({"path": sibling.rfilename,
+                          "size": sibling.size,
+                          "sha256": sha256,
+                          "git_sha1": None if lfs else sibling.blob_id})
+        return files
+
+    def copy(self, model, path, start, length, stream):
+        import urllib.request
+        url = (self.endpoint + "/" + self.repo(model) + "/resolve/main/" +
+               path)
+        request = urllib.request.Request(
+            url, headers={"Range": "bytes=%d-%d" % (start, start + length - 1)})
+        with urllib.request.urlopen(request, timeout=60) as response:
+            if length and response.status != 206:
+                raise Exception("The server ignored the range of " + path)
+            while length > 0:
+                data = response.read(min(length, 1024 * 1024))
+                if not data:
+                    raise Exception("Short read of " + path)
+                stream.write(data)
+                length -= len(data)
+
+
+def default_source():
+    mirror = os.environ.get("HAPPYCHATTER_MIRROR")
+    if mirror:
+        return MirrorSource(mirror)
+    return HubSource()
+
+
+# ANCHOR Manager
+class ArtifactManager:
+
+    def __init__(self, source=None, folder="models", max_bytes=64 * 1024 ** 3,
+                 workers=4, chunk_bytes=8 * 1024 ** 2, in_use=None):
+        self.source = source or default_source()
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.chunk_bytes = chunk_bytes
+        # NOTE Models that must not be deleted (i.e. the loaded ones)
+        self.in_use = in_use or (lambda: ())
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        # NOTE Chunks of every download share the same threads
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix="artifacts")
+        # NOTE model -> {"state", "done", "total", "error"}
+        self.states = {}
+        # NOTE model -> manifest of the ready models
+        self.manifests = {}
+        # Statistics
+        self.fetched = 0
+        self.fetched_bytes = 0
+        self.evictions = 0
+        self.failures = 0
+        self.scan()
+
+    def path(self, model):
+        return self.folder + "/" + model
+
+    # ANCHOR Models already on disk
+    def scan(self):
+        if not os.path.isdir(self.folder):
+            return
+        for model in os.listdir(self.folder):
+            path = self.path(model)
+            if os.path.exists(path + "/" + MANIFEST):
+                with open(path + "/" + MANIFEST) as manifest_stream:
+                    self.manifests[model] = json.load(manifest_stream)
+            elif is_ready(model, self.folder):
+                # NOTE Saved by neo.GPTNeo before the manager existed,
+                #      adopted with the sizes only (hashing would be slow)
+                self.manifests[model] = self.adopt(model)
+            else:
+                continue
+            self.states[model] = {"state": "ready", "done": 0, "total": 0,
+                                  "error": None}
+
+    def adopt(self, model):
+        path = self.path(model)
+        files = {name: {"size": os.path.getsize(path + "/" + name),
+                        "sha256": None}
+                 for name in os.listdir(path)
+                 if os.path.isfile(path + "/" + name)}
+        manifest = {"model": model, "source": "local", "files": files,
+                    "fetched": os.path.getmtime(path),
+                    "last_used": os.path.getmtime(path)}
+        write_json(path + "/" + MANIFEST, manifest)
+        return manifest
+
+    # ANCHOR Readiness
+    def state(self, model):
+        with self.lock:
+            state = self.states.get(model)
+            if state is None:
+                return {"state": "absent", "done": 0, "total": 0,
+                        "error": None}
+            return dict(state)
+
+    def ready(self, model):
+        return self.state(model)["state"] == "ready"
+
+    def set_state(self, model, state, **values):
+        with self.condition:
+            entry = self.states.setdefault(model, {"state": state, "done": 0,
+                                                   "total": 0, "error": None})
+            entry["state"] = state
+            entry.update(values)
+            self.condition.notify_all()
+
+    def usage(self):
+        with self.lock:
+            return sum(sum(entry["size"] for entry in manifest["files"].values())
+                       for manifest in self.manifests.values())
+
+    # ANCHOR Fetching in background
+    def prefetch(self, model):
+        with self.lock:
+            state = self.states.get(model)
+            if state is not None and state["state"] not in ("failed",):
+                return False
+            self.states[model] = {"state": "queued", "done": 0, "total": 0,
+                                  "error": None}
+        threading.Thread(target=self.fetch, args=(model,),
+                         name="artifacts-" + model, daemon=True).start()
+        return True
+
+    def fetch(self, model):
+        start = time.perf_counter()
+        try:
+            files = self.source.files(model)
+            total = sum(entry["size"] for entry in files)
+            self.set_state(model, "downloading", total=total)
+            self.make_room(total, keep=model)
+            self.download(model, files)
+            self.set_state(model, "verifying")
+            self.install(model, files)
+        except Exception as error:
+            print("[!] Download of " + model + " failed: " + str(error))
+            self.failures += 1
+            telemetry.count("artifacts.failed")
+            self.set_state(model, "failed", error=str(error))
+            return
+        telemetry.observe("artifacts.fetch", time.perf_counter() - start)
+        self.fetched += 1
+        self.fetched_bytes += total
+        print("[+] Model " + model + " downloaded")
+        self.set_state(model, "ready")
+
+    def download(self, model, files):
+        partial = self.path(model) + "/" + PARTIAL
+        os.makedirs(partial, exist_ok=True)
+        progress_path = partial + "/progress.json"
+        # NOTE Chunks already copied by an interrupted download, valid as
+        #      long as the files did not change at the source
+        sizes = {entry["path"]: entry["size"] for entry in files}
+        progress = {"sizes": sizes, "chunks": {}}
+        if os.path.exists(progress_path):
+            with open(progress_path) as progress_stream:
+                previous = json.load(progress_stream)
+            if previous["sizes"] == sizes:
+                progress = previous
+        chunks = []
+        done = 0
+        for entry in files:
+            target = partial + "/" + entry["path"]
+            copied = set(progress["chunks"].get(entry["path"], []))
+            if not os.path.exists(target):
+                copied = set()
+            with open(target, "ab") as target_stream:
+                target_stream.truncate(entry["size"])
+            for number, start in enumerate(range(0, entry["size"],
+                                                 self.chunk_bytes)):
+                length = min(self.chunk_bytes, entry["size"] - start)
+                if number in copied:
+                    done += length
+                else:
+                    chunks.append((entry["path"], number, start, length))
+            progress["chunks"][entry["path"]] = sorted(copied)
+        self.set_state(model, "downloading", done=done)
+        progress_lock = threading.Lock()
+
+        def copy(path, number, start, length):
+            with open(partial + "/" + path, "r+b") as target_stream:
+                target_stream.seek(start)
+                self.source.copy(model, path, start, length, target_stream)
+            with progress_lock:
+                progress["chunks"][path].append(number)
+                write_json(progress_path, progress)
+            with self.condition:
+                self.states[model]["done"] += length
+                self.condition.notify_all()
+
+        futures = [self.executor.submit(copy, *chunk) for chunk in chunks]
+        try:
+            for future in futures:
+                future.result()
+        except Exception:
+            # NOTE The chunks not started yet are left for the next try
+            for future in futures:
+                future.cancel()
+            raise
+
+    def install(self, model, files):
+        partial = self.path(model) + "/" + PARTIAL
+        manifest = {"model": model, "source": self.source.name, "files": {},
+                    "fetched": time.time(), "last_used": time.time()}
+        for entry in files:
+            path = partial + "/" + entry["path"]
+            sha256 = sha256_of(path)
+            if entry.get("sha256") and sha256 != entry["sha256"]:
+                self.discard(partial, entry["path"])
+                raise Exception("Checksum mismatch for " + entry["path"])
+            if entry.get("git_sha1") and git_sha1_of(path) != entry["git_sha1"]:
+                self.discard(partial, entry["path"])
+                raise Exception("Checksum mismatch for " + entry["path"])
+            manifest["files"][entry["path"]] = {"size": entry["size"],
+                                                "sha256": sha256}
+        for entry in files:
+            os.replace(partial + "/" + entry["path"],
+                       self.path(model) + "/" + entry["path"])
+        # NOTE Written last, the model is ready only when it exists
+        write_json(self.path(model) + "/" + MANIFEST, manifest)
+        shutil.rmtree(partial, ignore_errors=True)
+        with self.lock:
+            self.manifests[model] = manifest
+
+    # NOTE A damaged file is copied again from scratch on the next try
+    def discard(self, partial, path):
+        os.remove(partial + "/" + path)
+
+    # ANCHOR Waiting (worker threads only)
+    def wait(self, model, progress=None, should_stop=None, timeout=None):
+        self.prefetch(model)
+        deadline = None if timeout is None else time.time() + timeout
+        reported = None
+        with self.condition:
+            while self.states[model]["state"] not in ("ready", "failed"):
+                state = self.states[model]
+                # NOTE Reported without the lock, the callback may post
+                #      events to the window
+                if progress is not None and state["total"]:
+                    percent = int(100 * state["done"] / state["total"])
+                    if percent != reported:
+                        reported = percent
+                        self.condition.release()
+                        try:
+                            progress("downloading " + model + " (" +
+                                     str(percent) + "%)...")
+                        finally:
+                            self.condition.acquire()
+                if should_stop is not None and should_stop():
+                    return False
+                if deadline is not None and time.time() >= deadline:
+                    return False
+                self.condition.wait(timeout=1.0)
+            state = dict(self.states[model])
+        if state["state"] == "failed":
+            raise Exception("Model " + model + " not available: " +
+                            state["error"])
+        self.touch(model)
+        return True
+
+    # NOTE The manifest on disk may have new files (see record_files)
+    def reload(self, model):
+        path = self.path(model) + "/" + MANIFEST
+        if not os.path.exists(path):
+            return
+        with open(path) as manifest_stream:
+            manifest = json.load(manifest_stream)
+        with self.lock:
+            if model in self.manifests:
+                self.manifests[model] = manifest
+
+    # ANCHOR Disk budget
+    def touch(self, model):
+        self.reload(model)
+        with self.lock:
+            manifest = self.manifests.get(model)
+            if manifest is None:
+                return
+            manifest["last_used"] = time.time()
+        write_json(self.path(model) + "/" + MANIFEST, manifest)
+
+    def make_room(self, needed, keep=None):
+        if needed > self.max_bytes:
+            raise Exception("The disk budget is smaller than the model")
+        busy = set(self.in_use()) | {keep}
+        with self.lock:
+            models = list(self.manifests)
+        for model in models:
+            self.reload(model)
+        while self.usage() + needed > self.max_bytes:
+            with self.lock:
+                candidates = [(manifest["last_used"], model)
+                              for model, manifest in self.manifests.items()
+                              if model not in busy and
+                              self.states.get(model, {}).get("state") ==
+                              "ready"]
+            if not candidates:
+                raise Exception("Not enough disk budget, the other models "
+                                "are in use")
+            self.evict(min(candidates)[1])
+        os.makedirs(self.folder, exist_ok=True)
+        if shutil.disk_usage(self.folder).free < needed:
+            raise Exception("Not enough free disk space")
+
+    def evict(self, model):
+        # NOTE Everything but the trained checkpoints: the downloaded files,
+        #      the copies written by neo.GPTNeo and the converted precisions
+        #      are all made again from the download
+        with self.lock:
+            self.manifests.pop(model)
+            self.states.pop(model, None)
+        print("[*] Deleting model " + model + " (least recently used)")
+        path = self.path(model)
+        # NOTE The manifest first, a crash in between leaves no ready model
+        os.remove(path + "/" + MANIFEST)
+        for name in os.listdir(path):
+            if name == "checkpoints":
+                continue
+            if os.path.isdir(path + "/" + name):
+                shutil.rmtree(path + "/" + name, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path + "/" + name)
+                except OSError:
+                    pass
+        try:
+            # NOTE Kept when there are checkpoints
+            os.rmdir(path)
+        except OSError:
+            pass
+        self.evictions += 1
+        telemetry.count("artifacts.evicted")
+
+    # ANCHOR Integrity
+    def verify(self, model):
+        self.reload(model)
+        with self.lock:
+            manifest = self.manifests.get(model)
+        if manifest is None:
+            return False
+        for name, entry in manifest["files"].items():
+            path = self.path(model) + "/" + name
+            if not os.path.exists(path) or os.path.getsize(path) != entry["size"]:
+                return False
+            if entry["sha256"] and sha256_of(path) != entry["sha256"]:
+                return False
+        return True
+
+    # ANCHOR Statistics
+    def stats(self):
+        used = self.usage()
+        with self.lock:
+            return {"source": self.source.name,
+                    "used_bytes": used,
+                    "max_bytes": self.max_bytes,
+                    "fetched": self.fetched,
+                    "fetched_bytes": self.fetched_bytes,
+                    "evictions": self.evictions,
+                    "failures": self.failures,
+                    "states": {model: state["state"] for model, state
+                               in self.states.items()}}
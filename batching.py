@@ -0,0 +1,113 @@
+import threading
+import time
+from concurrent.futures import Future
+
+# INSTRUCTIONS:
+# declare a batcher for a loaded model using
+# batcher = batching.MicroBatcher(gpt[, window_ms=5, max_batch=8])
+# then, from as many threads as needed, ask for a reply using
+# future = batcher.submit(prompt[, settings])
+# reply, stats = future.result()
+# Requests arriving within window_ms of each other are generated together
+# with gpt.generate_batch, which is much faster than one by one on CPU.
+# stats are the statistics of this request (its new tokens, the size and
+# time of its batch).
+# Statistics can be read using
+# batcher.stats()
+
+
+class MicroBatcher:
+
+    def __init__(self, gpt, window_ms=5, max_batch=8):
+        self.gpt = gpt
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self.pending = []
+        self.condition = threading.Condition()
+        self.closing = False
+        # Statistics
+        self.batches = 0
+        self.requests = 0
+        self.new_tokens = 0
+        self.busy_time = 0.0
+        self.largest_batch = 0
+        self.last_batch = None
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    # ANCHOR Queueing a request
+    def submit(self, prompt, settings=None):
+        future = Future()
+        with self.condition:
+            if self.closing:
+                raise Exception("Batcher is closed")
+            self.pending.append((prompt, settings, future))
+            self.condition.notify()
+        return future
+
+    # ANCHOR Collecting requests for a few milliseconds
+    def collect(self):
+        with self.condition:
+            while not self.pending and not self.closing:
+                self.condition.wait()
+            if not self.pending:
+                return []
+            deadline = time.perf_counter() + self.window
+            while len(self.pending) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0 or self.closing:
+                    break
+                self.condition.wait(remaining)
+            batch = self.pending[:self.max_batch]
+            self.pending = self.pending[self.max_batch:]
+            return batch
+
+    # ANCHOR Batching thread
+    def loop(self):
+        while True:
+            batch = self.collect()
+            if not batch:
+                return
+            prompts = [prompt for prompt, _, _ in batch]
+            # NOTE None means the current settings of the model
+            default = self.gpt.generation_settings()
+            settings = [setting or default for _, setting, _ in batch]
+            try:
+                replies, stats = self.gpt.generate_batch(prompts, settings,
+                                                         return_stats=True)
+            except Exception as error:
+                for _, _, future in batch:
+                    future.set_exception(error)
+                continue
+            for reply, row_stats, (_, _, future) in zip(replies, stats, batch):
+                future.set_result((reply, row_stats))
+            with self.condition:
+                self.batches += 1
+                self.requests += len(batch)
+                self.new_tokens += stats[0]["batch_new_tokens"]
+                self.busy_time += stats[0]["total"]
+                self.largest_batch = max(self.largest_batch, len(batch))
+                self.last_batch = {key: stats[0][key] for key
+                                   in ("batch_size", "groups",
+                                       "batch_new_tokens", "total",
+                                       "tokens_per_sec")}
+
+    # ANCHOR Statistics
+    def stats(self):
+        with self.condition:
+            return {"batches": self.batches,
+                    "requests": self.requests,
+                    "mean_batch_size": (self.requests / self.batches
+                                        if self.batches else 0.0),
+                    "largest_batch": self.largest_batch,
+                    "new_tokens": self.new_tokens,
+                    "tokens_per_sec": (self.new_tokens / self.busy_time
+                                       if self.busy_time else 0.0),
+                    "last_batch": self.last_batch}
+
+    # ANCHOR Stopping the thread (pending requests are still served)
+    def close(self):
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        self.thread.join()
@@ -0,0 +1,471 @@
+import argparse
+import csv
+import gc
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import telemetry
+
+# INSTRUCTIONS:
+# measure the models using
+# python benchmark.py models [--models neo-small,dialo-small] [--tiny]
+# for every model this measures the cold load (first load in a fresh
+# process) and the warm load (second load, weights in the page cache), the
+# time to first token and the tokens per second at several prompt lengths,
+# the peak memory and the training speed.
+# compare the precisions of a model using
+# python benchmark.py precision [--model neo-small] [--tokens 32] [--tiny]
+# compare plain and speculative decoding (see neo.DRAFT_PAIRS) using
+# python benchmark.py speculative [--model neo-large] [--tokens 32]
+# measure the aggregate throughput of the worker pool (see pool.py) using
+# python benchmark.py pool [--model neo-small] [--workers 1,2,4]
+#                          [--requests 16] [--tiny] [--fork]
+# measure the startup (import time of the GUI and of the ML libraries, each
+# in a fresh interpreter) using
+# python benchmark.py startup [--runs 5]
+# compare two runs using
+# python benchmark.py compare bench/old.json bench/new.json
+# --tiny creates (once) and uses a tiny randomly initialized GPT-Neo in
+# models/tiny, so the suite runs offline without downloading anything.
+# Every model is measured in a fresh process so the memory numbers do not
+# leak into each other. Results are written as JSON and CSV in the bench
+# folder (see --output).
+
+PROMPT = ("This is a conversation between a smart and curious Bot "
+          "and a Human.\nHuman: Hello! How are you today?\n")
+
+TRAINING_LINE = ("Human: What are you doing today?\n"
+                 "Bot: I am reading a book about the sea.\n")
+
+
+# ANCHOR Tiny random model for offline runs
+def make_tiny_model(folder="models/tiny"):
+    if os.path.exists(folder + "/config.json"):
+        return
+    from tokenizers import ByteLevelBPETokenizer
+    from transformers import (GPTNeoConfig, GPTNeoForCausalLM,
+                              PreTrainedTokenizerFast)
+    print("[*] Creating the tiny model in " + folder)
+    os.makedirs(folder, exist_ok=True)
+    # NOTE A byte level tokenizer trained on a few sentences, no download
+    trainer = ByteLevelBPETokenizer()
+    trainer.train_from_iterator([PROMPT, TRAINING_LINE] * 8,
+                                vocab_size=512,
+                                special_tokens=["<|endoftext|>"])
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=trainer,
+                                        bos_token="<|endoftext|>",
+                                        eos_token="<|endoftext|>",
+                                        unk_token="<|endoftext|>",
+                                        model_max_length=512)
+    tokenizer.save_pretrained(folder)
+    config = GPTNeoConfig(vocab_size=len(tokenizer),
+                          max_position_embeddings=512,
+                          hidden_size=64,
+                          num_layers=2,
+                          num_heads=4,
+                          attention_types=[[["global", "local"], 1]],
+                          window_size=64,
+                          bos_token_id=tokenizer.eos_token_id,
+                          eos_token_id=tokenizer.eos_token_id)
+    GPTNeoForCausalLM(config).save_pretrained(folder, safe_serialization=True)
+
+
+def prompt_of_length(tokenizer, length):
+    ids = []
+    while len(ids) < length:
+        ids += tokenizer.encode(PROMPT)
+    return ids[:length]
+
+
+# ANCHOR Whole model measure (runs in a child process)
+def measure_model(model, prompt_lengths, tokens, runs, train_lines):
+    import neo
+    import registry
+    from happytransformer import GENTrainArgs
+    result = {"model": model}
+    before = telemetry.rss_bytes()
+    start = time.perf_counter()
+    gpt = neo.GPTNeo(model=model)
+    result["cold_load"] = time.perf_counter() - start
+    after = telemetry.rss_bytes()
+    result["rss_model_bytes"] = (None if before is None or after is None
+                                 else after - before)
+    result["weights_bytes"] = registry.model_size(gpt)
+    del gpt
+    gc.collect()
+    start = time.perf_counter()
+    gpt = neo.GPTNeo(model=model)
+    result["warm_load"] = time.perf_counter() - start
+    # NOTE Greedy and fixed length, so every run decodes the same tokens
+    gpt.set_parameters(min_length=tokens, max_length=tokens, do_sample=False)
+    # NOTE Not stopping at turn boundaries either (see neo.STOP_SEQUENCES)
+    gpt.stop_sequences = ()
+    budget = gpt.context_size() - tokens
+    rows = []
+    for length in prompt_lengths:
+        if length > budget:
+            continue
+        ids = prompt_of_length(gpt.gen.tokenizer, length)
+        ttfts = []
+        totals = []
+        generated = []
+        for _ in range(runs + 1):
+            # NOTE No KV cache reuse, every run pays the full prefill
+            gpt.drop_cache()
+            gpt.generate_stream(None, ids=ids)
+            ttfts.append(gpt.last_stats["ttft"])
+            totals.append(gpt.last_stats["total"])
+            # NOTE The tokens actually decoded, in case the run ended early
+            generated.append(gpt.last_stats["new_tokens"])
+        # NOTE The first run is a warm up
+        ttft = sum(ttfts[1:]) / runs
+        total = sum(totals[1:]) / runs
+        new_tokens = sum(generated[1:]) / runs
+        decode = max(total - ttft, 1e-9)
+        rows.append(dict(result,
+                         prompt_tokens=length,
+                         new_tokens=new_tokens,
+                         ttft=ttft,
+                         total=total,
+                         prefill_tokens_per_sec=length / ttft if ttft else 0.0,
+                         decode_tokens_per_sec=max(new_tokens - 1, 0) / decode))
+    # ANCHOR Training speed
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as data:
+        data.write(TRAINING_LINE * (train_lines // 2))
+    try:
+        start = time.perf_counter()
+        # NOTE Training the HappyGeneration directly, so no checkpoint is
+        #      written (the weights die with this process)
+        gpt.gen.train(data.name, args=GENTrainArgs(num_train_epochs=1))
+        train_time = time.perf_counter() - start
+    finally:
+        os.remove(data.name)
+    for row in rows:
+        row["train_samples_per_sec"] = train_lines / train_time
+        row["peak_rss_bytes"] = telemetry.peak_rss_bytes()
+    return rows
+
+
+# ANCHOR Single precision measure (runs in a child process)
+def measure_precision(model, precision, tokens, runs):
+    import neo
+    import registry
+    gc.collect()
+    before = telemetry.rss_bytes()
+    start = time.perf_counter()
+    gpt = neo.GPTNeo(model=model, precision=precision)
+    load_time = time.perf_counter() - start
+    after = telemetry.rss_bytes()
+    # NOTE Greedy and fixed length, so every run decodes the same tokens
+    gpt.set_parameters(min_length=tokens, max_length=tokens, do_sample=False)
+    gpt.stop_sequences = ()
+    gpt.generate_batch([PROMPT])
+    speeds = []
+    for _ in range(runs):
+        gpt.generate_batch([PROMPT])
+        speeds.append(gpt.last_batch_stats["tokens_per_sec"])
+    return {"model": model,
+            "precision": precision,
+            "load_time": load_time,
+            "weights_bytes": registry.model_size(gpt),
+            "rss_delta_bytes": (None if before is None or after is None
+                                else after - before),
+            "peak_rss_bytes": telemetry.peak_rss_bytes(),
+            "tokens": tokens,
+            "tokens_per_sec": sum(speeds) / len(speeds)}
+
+
+# ANCHOR Speculative decoding measure (runs in a child process)
+def measure_speculative(model, tokens, runs):
+    import neo
+    draft_model, draft_tokens = neo.DRAFT_PAIRS[model]
+    gpt = neo.GPTNeo(model=model)
+    draft = neo.GPTNeo(model=draft_model)
+    # NOTE Greedy and fixed length, so both modes decode the same tokens
+    gpt.set_parameters(min_length=tokens, max_length=tokens, do_sample=False)
+    gpt.stop_sequences = ()
+    ids = gpt.gen.tokenizer.encode(PROMPT)
+    result = {"model": model, "draft_model": draft_model,
+              "draft_tokens": draft_tokens, "tokens": tokens}
+    for mode in ("plain", "speculative"):
+        gpt.set_draft(draft if mode == "speculative" else None,
+                      tokens=draft_tokens)
+        totals = []
+        generated = []
+        for _ in range(runs + 1):
+            gpt.drop_cache()
+            gpt.generate_stream(None, ids=ids)
+            totals.append(gpt.last_stats["total"])
+            generated.append(gpt.last_stats["new_tokens"])
+        # NOTE The first run is a warm up
+        total = sum(totals[1:]) / runs
+        result[mode + "_tokens_per_sec"] = sum(generated[1:]) / runs / total
+    result["speedup"] = (result["speculative_tokens_per_sec"] /
+                         result["plain_tokens_per_sec"])
+    result["acceptance_rate"] = gpt.acceptance_rate()
+    return result
+
+
+def run_isolated(function, *args):
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(function, args)
+
+
+# ANCHOR Startup measure (a fresh interpreter for every run)
+# NOTE happychatter is what runs before the window is shown, neo is what
+#      the first model load pays (in background since the lazy imports)
+STARTUP_MODULES = ("happychatter", "neo")
+
+
+def measure_import(module):
+    code = ("import time; start = time.perf_counter(); import " + module +
+            "; print(time.perf_counter() - start)")
+    completed = subprocess.run([sys.executable, "-c", code],
+                               capture_output=True, text=True, check=True)
+    # NOTE The module may print, the time is the last line
+    return float(completed.stdout.strip().splitlines()[-1])
+
+
+# ANCHOR Commands
+def bench_models(args):
+    import neo
+    if args.tiny:
+        models = ["tiny"]
+    elif args.models:
+        models = args.models.split(",")
+    else:
+        models = list(neo.MODELS)
+    lengths = [int(length) for length in args.prompt_lengths.split(",")]
+    results = []
+    for model in models:
+        print("[*] Measuring " + model)
+        try:
+            rows = run_isolated(measure_model, model, lengths, args.tokens,
+                                args.runs, args.train_lines)
+        except Exception as error:
+            print("[!] " + model + " failed: " + str(error))
+            continue
+        for row in rows:
+            print("    %4d prompt tokens: load %.2fs/%.2fs, first token %.3fs, "
+                  "%.1f tokens/s" % (row["prompt_tokens"], row["cold_load"],
+                                     row["warm_load"], row["ttft"],
+                                     row["decode_tokens_per_sec"]))
+        results += rows
+    return results
+
+
+def bench_precision(args):
+    import neo
+    model = "tiny" if args.tiny else args.model
+    results = []
+    for precision in neo.PRECISIONS:
+        print("[*] Measuring " + model + " in " + precision)
+        # NOTE First run converts and caches, the second one is measured
+        run_isolated(measure_precision, model, precision, 1, 1)
+        result = run_isolated(measure_precision, model, precision,
+                              args.tokens, args.runs)
+        print("    load %.2fs, weights %.0fMB, %.1f tokens/s" %
+              (result["load_time"], result["weights_bytes"] / 1024 ** 2,
+               result["tokens_per_sec"]))
+        results.append(result)
+    return results
+
+
+def bench_speculative(args):
+    import neo
+    models = args.model.split(",") if args.model else list(neo.DRAFT_PAIRS)
+    results = []
+    for model in models:
+        print("[*] Measuring " + model + " drafted by " +
+              neo.DRAFT_PAIRS[model][0])
+        try:
+            result = run_isolated(measure_speculative, model, args.tokens,
+                                  args.runs)
+        except Exception as error:
+            print("[!] " + model + " failed: " + str(error))
+            continue
+        print("    %.1f -> %.1f tokens/s (x%.2f), %.0f%% accepted" %
+              (result["plain_tokens_per_sec"],
+               result["speculative_tokens_per_sec"], result["speedup"],
+               100 * result["acceptance_rate"]))
+        results.append(result)
+    return results
+
+
+def bench_startup(args):
+    results = []
+    for module in STARTUP_MODULES:
+        print("[*] Importing " + module)
+        try:
+            times = [measure_import(module) for _ in range(args.runs)]
+        except (subprocess.CalledProcessError, ValueError) as error:
+            print("[!] " + module + " failed: " + str(error))
+            continue
+        result = {"module": module,
+                  "runs": args.runs,
+                  "mean": sum(times) / len(times),
+                  "min": min(times),
+                  "max": max(times)}
+        print("    %.3fs mean, %.3fs min" % (result["mean"], result["min"]))
+        results.append(result)
+    return results
+
+
+def bench_pool(args):
+    # NOTE Not isolated: the pool starts its own processes
+    import pool
+    model = "tiny" if args.tiny else args.model
+    # NOTE Greedy and fixed length, so every request decodes the same tokens
+    parameters = {"min_length": args.tokens, "max_length": args.tokens,
+                  "do_sample": False}
+    results = []
+    for workers in [int(number) for number in args.workers.split(",")]:
+        print("[*] Measuring " + model + " with " + str(workers) + " worker(s)")
+        start = time.perf_counter()
+        model_pool = pool.ModelPool(model, workers=workers,
+                                    threads=args.threads,
+                                    start_method="fork" if args.fork else "spawn",
+                                    parameters=parameters)
+        load_time = time.perf_counter() - start
+        try:
+            # NOTE One warm up request per worker
+            for future in [model_pool.generate(PROMPT) for _ in range(workers)]:
+                future.result()
+            start = time.perf_counter()
+            futures = [model_pool.chat("bench-" + str(number), PROMPT)
+                       for number in range(args.requests)]
+            stats = [future.result()["stats"] for future in futures]
+            elapsed = time.perf_counter() - start
+        finally:
+            model_pool.close()
+        new_tokens = sum(entry["new_tokens"] for entry in stats)
+        result = {"model": model,
+                  "workers": workers,
+                  "threads": model_pool.threads,
+                  "requests": args.requests,
+                  "load_time": load_time,
+                  "elapsed": elapsed,
+                  "requests_per_sec": args.requests / elapsed,
+                  "tokens_per_sec": new_tokens / elapsed}
+        print("    %.2f requests/s, %.1f tokens/s" %
+              (result["requests_per_sec"], result["tokens_per_sec"]))
+        results.append(result)
+    return results
+
+
+def compare(args):
+    with open(args.old) as old_stream:
+        old = json.load(old_stream)
+    with open(args.new) as new_stream:
+        new = json.load(new_stream)
+
+    def index(rows):
+        return {(row.get("model"), row.get("module"), row.get("precision"),
+                 row.get("prompt_tokens"), row.get("workers")): row
+                for row in rows}
+
+    old_rows = index(old)
+    for key, row in index(new).items():
+        if key not in old_rows:
+            continue
+        print(" / ".join(str(part) for part in key if part is not None))
+        for metric, value in row.items():
+            previous = old_rows[key].get(metric)
+            if (isinstance(value, (int, float)) and
+                    isinstance(previous, (int, float)) and previous):
+                print("    %-24s %12.4g -> %12.4g (x%.2f)" %
+                      (metric, previous, value, value / previous))
+
+
+# ANCHOR Writing the results
+def write_results(results, output):
+    folder = os.path.dirname(output)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(output + ".json", "w") as json_stream:
+        json.dump(results, json_stream, indent=2)
+    columns = []
+    for result in results:
+        for column in result:
+            if column not in columns:
+                columns.append(column)
+    with open(output + ".csv", "w", newline="") as csv_stream:
+        writer = csv.DictWriter(csv_stream, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(results)
+    print("[+] Results written to " + output + ".json/.csv")
+
+
+# ANCHOR Entry point
+def main():
+    parser = argparse.ArgumentParser(description="HappyChatter benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+    models = commands.add_parser("models",
+                                 help="load, prefill, decode and training")
+    models.add_argument("--models", default="",
+                        help="comma separated, all of them by default")
+    models.add_argument("--prompt-lengths", default="16,128,512")
+    models.add_argument("--tokens", type=int, default=32)
+    models.add_argument("--runs", type=int, default=3)
+    models.add_argument("--train-lines", type=int, default=64)
+    models.add_argument("--tiny", action="store_true")
+    models.add_argument("--output", default="bench/models")
+    precision = commands.add_parser("precision",
+                                    help="compare fp32, bf16 and int8")
+    precision.add_argument("--model", default="neo-small")
+    precision.add_argument("--tokens", type=int, default=32)
+    precision.add_argument("--runs", type=int, default=3)
+    precision.add_argument("--tiny", action="store_true")
+    precision.add_argument("--output", default="bench/precision")
+    speculative = commands.add_parser("speculative",
+                                      help="plain against drafted decoding")
+    speculative.add_argument("--model", default="",
+                             help="comma separated, all the pairs by default")
+    speculative.add_argument("--tokens", type=int, default=32)
+    speculative.add_argument("--runs", type=int, default=3)
+    speculative.add_argument("--output", default="bench/speculative")
+    pooled = commands.add_parser("pool",
+                                 help="throughput of 1, 2, 4... workers")
+    pooled.add_argument("--model", default="neo-small")
+    pooled.add_argument("--workers", default="1,2,4")
+    pooled.add_argument("--threads", type=int, default=None,
+                        help="per worker, all cores split evenly by default")
+    pooled.add_argument("--requests", type=int, default=16)
+    pooled.add_argument("--tokens", type=int, default=32)
+    pooled.add_argument("--fork", action="store_true")
+    pooled.add_argument("--tiny", action="store_true")
+    pooled.add_argument("--output", default="bench/pool")
+    startup = commands.add_parser("startup",
+                                  help="import time of the GUI and of neo")
+    startup.add_argument("--runs", type=int, default=5)
+    startup.add_argument("--output", default="bench/startup")
+    comparison = commands.add_parser("compare", help="compare two results")
+    comparison.add_argument("old")
+    comparison.add_argument("new")
+    args = parser.parse_args()
+    # NOTE Same working directory layout as the GUI
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    if getattr(args, "tiny", False):
+        make_tiny_model()
+    if args.command == "models":
+        write_results(bench_models(args), args.output)
+    elif args.command == "precision":
+        write_results(bench_precision(args), args.output)
+    elif args.command == "speculative":
+        write_results(bench_speculative(args), args.output)
+    elif args.command == "pool":
+        write_results(bench_pool(args), args.output)
+    elif args.command == "startup":
+        write_results(bench_startup(args), args.output)
+    elif args.command == "compare":
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+# INSTRUCTIONS:
+# declare a cache once per process using
+# response_cache = cache.ResponseCache([max_entries=256][, folder=path])
+# and attach it to a model using
+# gpt.response_cache = response_cache
+# from now on, every generation with do_sample=False (greedy or beam search,
+# so always the same reply for the same prompt) is looked up in memory, then
+# on disk under data/response_cache, before running the model.
+# Pass folder=None to keep the cache in memory only.
+# Statistics can be read using
+# response_cache.stats()
+
+
+class ResponseCache:
+
+    def __init__(self, max_entries=256, folder="data/response_cache",
+                 max_disk_bytes=64 * 1024 ** 2):
+        self.max_entries = max_entries
+        self.folder = folder
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        # NOTE key -> [size, last access] of the files on disk
+        self.disk = {}
+        # Statistics
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if self.folder is not None:
+            os.makedirs(self.folder, exist_ok=True)
+            self.scan()
+
+    # ANCHOR Deterministic settings only
+    def cacheable(self, settings):
+        return not settings.do_sample
+
+    # ANCHOR Key building
+    def key(self, model, checkpoint, prompt, settings_key, stop_sequences=()):
+        # NOTE Same prompt written with different line endings or
+        #      surrounding spaces gives the same key. The stop sequences
+        #      decide where the reply is cut, they are part of the key too
+        prompt = prompt.replace("\r\n", "\n").strip()
+        raw = json.dumps([model, checkpoint, prompt, list(settings_key),
+                          list(stop_sequences)])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return self.folder + "/" + key + ".json"
+
+    # ANCHOR Looking up a reply
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory_hits += 1
+                self.memory.move_to_end(key)
+                return self.memory[key]
+            if self.folder is None or key not in self.disk:
+                self.misses += 1
+                return None
+        try:
+            with open(self.path(key)) as cache_stream:
+                text = json.load(cache_stream)["text"]
+            os.utime(self.path(key))
+        except (OSError, ValueError, KeyError):
+            with self.lock:
+                self.disk.pop(key, None)
+                self.misses += 1
+            return None
+        with self.lock:
+            self.disk_hits += 1
+            if key in self.disk:
+                self.disk[key][1] = os.path.getmtime(self.path(key))
+            self.remember(key, text)
+        return text
+
+    # ANCHOR Storing a reply
+    def put(self, key, text):
+        with self.lock:
+            self.remember(key, text)
+        if self.folder is None:
+            return
+        data = json.dumps({"text": text})
+        # NOTE Concurrent puts of the same key (threads, pool workers) each
+        #      write their own file, the last replace wins
+        temporary = (self.path(key) + "." + str(os.getpid()) + "." +
+                     str(threading.get_ident()) + ".tmp")
+        with open(temporary, "w") as cache_stream:
+            cache_stream.write(data)
+        os.replace(temporary, self.path(key))
+        with self.lock:
+            self.disk[key] = [len(data), os.path.getmtime(self.path(key))]
+            self.evict_disk()
+
+    # NOTE Must be called with the lock held
+    def remember(self, key, text):
+        self.memory[key] = text
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+            self.evictions += 1
+
+    # ANCHOR Disk store
+    def scan(self):
+        for name in os.listdir(self.folder):
+            if name.endswith(".json"):
+                path = self.folder + "/" + name
+                self.disk[name[:-5]] = [os.path.getsize(path),
+                                        os.path.getmtime(path)]
+        self.evict_disk()
+
+    # NOTE Must be called with the lock held, least recently used go first
+    def evict_disk(self):
+        used = sum(entry[0] for entry in self.disk.values())
+        if used <= self.max_disk_bytes:
+            return
+        for key in sorted(self.disk, key=lambda key: self.disk[key][1]):
+            if used <= self.max_disk_bytes:
+                break
+            used -= self.disk.pop(key)[0]
+            self.evictions += 1
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            for key in list(self.disk):
+                try:
+                    os.remove(self.path(key))
+                except OSError:
+                    pass
+            self.disk.clear()
+
+    # ANCHOR Statistics
+    def stats(self):
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            hits = self.memory_hits + self.disk_hits
+            return {"memory_hits": self.memory_hits,
+                    "disk_hits": self.disk_hits,
+                    "misses": self.misses,
+                    "hit_rate": hits / lookups if lookups else 0.0,
+                    "evictions": self.evictions,
+                    "memory_entries": len(self.memory),
+                    "disk_entries": len(self.disk),
+                    "disk_bytes": sum(entry[0] for entry in self.disk.values())}
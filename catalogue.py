@@ -0,0 +1,86 @@
+# INSTRUCTIONS:
+# the supported models, precisions and draft pairs, without importing torch
+# or transformers, so the server, the registry and the tools can list them
+# before any model is loaded using
+# import catalogue
+# catalogue.MODELS, catalogue.PRECISIONS, catalogue.DRAFT_PAIRS
+# neo.py exposes the same names (neo.MODELS, ...).
+# Everything known about a model (hub repository, happytransformer name,
+# radio key in the window, size) is read from CATALOGUE using
+# catalogue.repo(model), catalogue.happy_name(model),
+# catalogue.radio_keys(), catalogue.parameters(model)
+# by neo.GPTNeo.set_model, the router (see router.py) and the downloads
+# (see artifacts.py).
+
+
+# NOTE Every model supported by GPTNeo.set_model
+MODELS = ("neo-small", "neo-medium", "neo-large", "neox",
+          "dialo-small", "dialo-medium", "dialo-large",
+          "rag",
+          "blender-small", "blender-medium", "blender-large", "blender-huge",
+          "aeona")
+
+
+# NOTE Every model of MODELS, smallest first: model -> (hub repository,
+#      happytransformer model name, radio key in the window, millions of
+#      parameters)
+CATALOGUE = {"blender-small": ("facebook/blenderbot_small-90M",
+                               "BLENDER-SMALL", "BLENDER-SMALL", 90),
+             "dialo-small": ("microsoft/DialoGPT-small", "DialoGPT-Small",
+                             "DIALO-SMALL", 117),
+             "aeona": ("deepparag/Aeona", "AEONA", "AEONA", 117),
+             # NOTE Approx 600MB
+             "neo-small": ("EleutherAI/gpt-neo-125M", "GPT-NEO", "SMALL", 125),
+             "dialo-medium": ("microsoft/DialoGPT-medium", "DialoGPT-Medium",
+                              "DIALO-MEDIUM", 345),
+             "blender-medium": ("facebook/blenderbot-400M-distill",
+                                "BLENDER-MEDIUM", "BLENDER-MEDIUM", 400),
+             "rag": ("facebook/rag-token-nq", "RAG", "RAG", 515),
+             "dialo-large": ("microsoft/DialoGPT-large", "DialoGPT-Large",
+                             "DIALO-LARGE", 762),
+             "blender-large": ("facebook/blenderbot-1B-distill",
+                               "BLENDER-LARGE", "BLENDER-LARGE", 1000),
+             # NOTE Approx 5GB
+             "neo-medium": ("EleutherAI/gpt-neo-1.3B", "GPT-NEO", "MEDIUM",
+                            1300),
+             # NOTE Approx 10GB
+             "neo-large": ("EleutherAI/gpt-neo-2.7B", "GPT-NEO", "LARGE", 2700),
+             "blender-huge": ("facebook/blenderbot-3B", "BLENDER-HUGE",
+                              "BLENDER-HUGE", 2700),
+             # NOTE Approx 45GB
+             "neox": ("EleutherAI/gpt-neox-20b", "GPT-NEOX", "NEOX", 20000)}
+
+# NOTE Precisions supported by GPTNeo (see neo.GPTNeo.load_precision)
+# fp32 is the original model, bf16 halves the memory and int8 applies
+# dynamic quantization to the Linear layers (GPT-2 based models like
+# DialoGPT use Conv1D layers, so only their output head is quantized).
+# Converted models are cached in models/<folder>/precision/<precision>
+PRECISIONS = ("fp32", "bf16", "int8")
+
+# NOTE Speculative decoding pairs (see neo.GPTNeo.set_draft)
+# target model -> (draft model, tokens drafted per step). The draft must
+# share the tokenizer of the target: it proposes the next tokens and the
+# target checks all of them in a single forward pass, keeping the longest
+# prefix it agrees with. The reply is the same the target alone would give.
+# Blender has no pair: encoder-decoder models are refused by set_draft, and
+# blender-small does not share the vocabulary of the large ones anyway.
+DRAFT_PAIRS = {"neo-large": ("neo-small", 5),
+               "dialo-large": ("dialo-small", 5)}
+
+
+def repo(model):
+    if model not in CATALOGUE:
+        raise Exception("Unknown model: " + model)
+    return CATALOGUE[model][0]
+
+
+def happy_name(model):
+    return CATALOGUE[model][1]
+
+
+def radio_keys():
+    return {model: entry[2] for model, entry in CATALOGUE.items()}
+
+
+def parameters(model):
+    return CATALOGUE[model][3]
@@ -0,0 +1,264 @@
+import dataclasses
+import gzip
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+
+import telemetry
+
+# INSTRUCTIONS:
+# declare a log once per process using
+# chat_log = chatlog.ChatLog([folder="logs"][, compress=True])
+# then record the start of a conversation and every turn using
+# chat_log.start(session_id, model, preamble)
+# chat_log.turn(session_id, model, human, bot[, settings][, stats])
+# and call chat_log.close() before exiting to write what is left.
+# Writing never blocks: the records are queued and a background thread
+# writes them in batches, flushing every flush_every seconds and syncing
+# to disk every fsync_every seconds.
+# The records are one JSON object per line in logs/chat-<date>.jsonl. The
+# file is rotated when it grows over max_bytes or gets older than max_age,
+# and the rotated files are gzipped when compress is True.
+# The logs can be read back using
+# chatlog.read_records([folder][, session=id])
+# chatlog.load_session(session_id) -> list of (speaker, text)
+# chatlog.search(text) -> matching turns
+# or from the command line using
+# python chatlog.py sessions | show session_id | search text
+
+
+# ANCHOR Background writer
+class ChatLog:
+
+    def __init__(self, folder="logs", max_bytes=4 * 1024 ** 2,
+                 max_age=24 * 60 * 60, compress=True, flush_every=1.0,
+                 fsync_every=5.0):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compress = compress
+        self.flush_every = flush_every
+        self.fsync_every = fsync_every
+        self.records = queue.Queue()
+        self.stream = None
+        self.path = None
+        self.opened = 0.0
+        # Statistics
+        self.written = 0
+        self.rotations = 0
+        self.thread = threading.Thread(target=self.loop, name="chatlog",
+                                       daemon=True)
+        self.thread.start()
+
+    # ANCHOR Recording (any thread)
+    def write(self, record):
+        record.setdefault("time", time.time())
+        self.records.put(record)
+
+    def start(self, session_id, model, preamble=None):
+        self.write({"type": "start", "session": session_id, "model": model,
+                    "preamble": preamble})
+
+    def turn(self, session_id, model, human, bot, settings=None, stats=None):
+        if dataclasses.is_dataclass(settings):
+            settings = dataclasses.asdict(settings)
+        self.write({"type": "turn", "session": session_id, "model": model,
+                    "human": human, "bot": bot, "settings": settings,
+                    "stats": stats})
+
+    # ANCHOR Files
+    def open(self):
+        os.makedirs(self.folder, exist_ok=True)
+        name = "chat-" + time.strftime("%Y%m%d-%H%M%S")
+        path = self.folder + "/" + name + ".jsonl"
+        number = 1
+        # NOTE Two rotations in the same second
+        while os.path.exists(path) or os.path.exists(path + ".gz"):
+            number += 1
+            path = self.folder + "/" + name + "-" + str(number) + ".jsonl"
+        self.path = path
+        self.stream = open(path, "a", encoding="utf-8")
+        self.opened = time.time()
+
+    def rotate(self):
+        path = self.path
+        self.sync()
+        self.stream.close()
+        self.stream = None
+        self.rotations += 1
+        if self.compress:
+            with telemetry.timer("chatlog.compress"):
+                with open(path, "rb") as plain_stream:
+                    with gzip.open(path + ".gz.tmp", "wb") as gzip_stream:
+                        shutil.copyfileobj(plain_stream, gzip_stream)
+                os.replace(path + ".gz.tmp", path + ".gz")
+                os.remove(path)
+
+    def needs_rotation(self):
+        return (self.stream.tell() >= self.max_bytes or
+                time.time() - self.opened >= self.max_age)
+
+    def sync(self):
+        self.stream.flush()
+        os.fsync(self.stream.fileno())
+
+    # ANCHOR Writer thread
+    def loop(self):
+        last_sync = time.time()
+        closing = False
+        while not closing:
+            try:
+                batch = [self.records.get(timeout=self.flush_every)]
+            except queue.Empty:
+                batch = []
+            # NOTE Taking everything queued meanwhile, written at once
+            while True:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                closing = True
+                batch = [record for record in batch if record is not None]
+            if batch:
+                if self.stream is None:
+                    self.open()
+                with telemetry.timer("chatlog.write"):
+                    self.stream.write("".join(json.dumps(record,
+                                                         ensure_ascii=False) +
+                                              "\n"
+                                              for record in batch))
+                    self.stream.flush()
+                self.written += len(batch)
+            if self.stream is None:
+                continue
+            if closing or time.time() - last_sync >= self.fsync_every:
+                self.sync()
+                last_sync = time.time()
+            if self.needs_rotation():
+                self.rotate()
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def close(self):
+        self.records.put(None)
+        self.thread.join()
+
+    def stats(self):
+        return {"written": self.written,
+                "queued": self.records.qsize(),
+                "rotations": self.rotations,
+                "file": self.path}
+
+
+# ANCHOR Reading the logs back
+def log_files(folder="logs"):
+    # NOTE The names start with the date, so sorting is chronological
+    if not os.path.isdir(folder):
+        return []
+    return [folder + "/" + name for name in sorted(os.listdir(folder),
+                                                   key=log_order)
+            if name.startswith("chat-") and
+            name.endswith((".jsonl", ".jsonl.gz"))]
+
+
+# NOTE Files opened in the same second are numbered (see ChatLog.open),
+#      chat-<date>-2.jsonl comes after chat-<date>.jsonl
+def log_order(name):
+    base = name.split(".", 1)[0]
+    stamp = base[:len("chat-YYYYmmdd-HHMMSS")]
+    number = base[len(stamp) + 1:]
+    return stamp, int(number) if number.isdigit() else 1
+
+
+def read_lines(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as log_stream:
+        for line in log_stream:
+            yield line
+
+
+def read_records(folder="logs", session=None, contains=None):
+    # NOTE Matching the raw line first, only matches are parsed
+    needle = None
+    if session is not None:
+        needle = json.dumps(session)
+    for path in log_files(folder):
+        for line in read_lines(path):
+            if needle is not None and needle not in line:
+                continue
+            if contains is not None and contains not in line.lower():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # NOTE A line cut by a crash, the others are still valid
+                continue
+            if session is None or record.get("session") == session:
+                yield record
+
+
+def load_session(session_id, folder="logs"):
+    turns = []
+    for record in read_records(folder, session=session_id):
+        if record["type"] == "turn":
+            turns.append(("Human", record["human"]))
+            turns.append(("Bot", record["bot"]))
+    return turns
+
+
+def list_sessions(folder="logs"):
+    sessions = {}
+    for record in read_records(folder):
+        entry = sessions.setdefault(record["session"],
+                                    {"session": record["session"],
+                                     "model": record["model"],
+                                     "started": record["time"],
+                                     "turns": 0})
+        entry["model"] = record["model"] or entry["model"]
+        entry["last"] = record["time"]
+        if record["type"] == "turn":
+            entry["turns"] += 1
+    return list(sessions.values())
+
+
+def search(text, folder="logs"):
+    text = text.lower()
+    # NOTE The raw line is JSON escaped, so the lowercase check is only a
+    #      prefilter and the fields are matched again
+    prefilter = json.dumps(text, ensure_ascii=False)[1:-1]
+    return [record for record in read_records(folder, contains=prefilter)
+            if record["type"] == "turn" and
+            (text in record["human"].lower() or text in record["bot"].lower())]
+
+
+# ANCHOR Command line
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="HappyChatter logs")
+    parser.add_argument("--folder", default="logs")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("sessions", help="list the logged conversations")
+    show = commands.add_parser("show", help="print a conversation")
+    show.add_argument("session")
+    finder = commands.add_parser("search", help="find turns with a text")
+    finder.add_argument("text")
+    args = parser.parse_args()
+    if args.command == "sessions":
+        for entry in list_sessions(args.folder):
+            print("%s  %-14s %4d turns  %s" %
+                  (entry["session"], entry["model"], entry["turns"],
+                   time.strftime("%Y-%m-%d %H:%M",
+                                 time.localtime(entry["started"]))))
+    elif args.command == "show":
+        for speaker, text in load_session(args.session, args.folder):
+            print(speaker + ": " + text)
+    elif args.command == "search":
+        for record in search(args.text, args.folder):
+            print("[" + record["session"] + "]")
+            print("Human: " + record["human"])
+            print("Bot: " + record["bot"])
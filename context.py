@@ -0,0 +1,218 @@
+# INSTRUCTIONS:
+# declare a conversation using
+# context = context.ConversationContext(preamble=imprinting_text)
+# then add every line of the conversation using
+# context.add("Human", text) or context.add("Bot", text)
+# before generating, tell the context which tokenizer and budget to use
+# context.set_tokenizer(gpt.gen.tokenizer, max_tokens=gpt.context_budget()[,
+#                       name=gpt.model])
+# where name is the base model the tokenizer comes from (the hub id): it
+# stays the same after training, when the tokenizer is saved in a new
+# checkpoint folder.
+# and build the prompt with
+# prompt = context.build_prompt()
+# Only the preamble and the most recent turns fitting in the budget are
+# included, so the prompt size stays flat in long conversations.
+# Truncation statistics can be read using
+# context.stats()
+# The whole state, token ids included, can be saved and restored using
+# data = context.to_dict()
+# context = ConversationContext.from_dict(data)
+# the ids are kept as long as the same tokenizer is set again.
+# Turns recalled from past conversations (see memory.py) are set using
+# context.set_memories([(human_text, bot_text), ...])
+# they are written after the preamble and use at most a quarter of the
+# budget, the rest is left to the recent turns. They are not saved.
+
+# ANCHOR Identity of a tokenizer
+# NOTE The ids stay valid as long as the vocabulary is the same: the base
+#      model and the vocabulary size (added tokens) are compared, not the
+#      folder the tokenizer was loaded from, which changes with every
+#      checkpoint
+def tokenizer_name(tokenizer, base=None):
+    if base is None:
+        base = type(tokenizer).__name__
+    try:
+        size = len(tokenizer)
+    except TypeError:
+        size = getattr(tokenizer, "vocab_size", None)
+    return base + "-" + str(size)
+
+
+# NOTE You can set an initial imprinting here
+IMPRINTING = '''This is a conversation between a smart and curious Bot
+             and a Human. The bot is self conscious and creative.
+             The Bot is original and doesn't repeat the same sentences.\n\n
+             Human: Hello!\n
+             Bot: Hello there!\n
+             Human: How are you?\n
+             Bot: Fine! And you?\n
+             Human: Who are you?\n
+             Bot: I am a sentient bot, and you?\n'''
+
+
+# ANCHOR A single line of the conversation
+class Turn:
+
+    def __init__(self, speaker, text, ids=None):
+        self.speaker = speaker
+        self.text = text
+        # NOTE Token ids are cached so every turn is tokenized only once
+        self.ids = ids
+
+    def line(self):
+        return self.speaker + ": " + self.text + "\n"
+
+
+class ConversationContext:
+
+    def __init__(self, preamble="", max_tokens=1024):
+        self.preamble = preamble
+        self.preamble_ids = None
+        self.turns = []
+        self.tokenizer = None
+        self.tokenizer_name = None
+        self.max_tokens = max_tokens
+        # NOTE Pairs of recalled turns, and the ones fitting in the budget
+        self.memories = []
+        self.recalled = []
+        # Statistics
+        self.builds = 0
+        self.truncated_builds = 0
+        self.last_included = 0
+        self.last_dropped = 0
+        self.last_tokens = 0
+        self.last_memory_tokens = 0
+        self.encoded = 0
+
+    # ANCHOR Tokenizer and budget selection
+    def set_tokenizer(self, tokenizer, max_tokens=None, name=None):
+        name = tokenizer_name(tokenizer, name)
+        if name != self.tokenizer_name:
+            # NOTE A different tokenizer means the cached ids are useless
+            self.preamble_ids = None
+            for turn in self.turns:
+                turn.ids = None
+            for pair in self.memories:
+                for turn in pair:
+                    turn.ids = None
+            self.tokenizer_name = name
+        self.tokenizer = tokenizer
+        if max_tokens is not None:
+            self.max_tokens = max_tokens
+
+    # ANCHOR Adding a turn
+    def add(self, speaker, text):
+        turn = Turn(speaker, text)
+        if self.tokenizer is not None:
+            turn.ids = self.encode(turn.line())
+        self.turns.append(turn)
+        return turn
+
+    def remove(self, turn):
+        self.turns.remove(turn)
+
+    # ANCHOR Recalled turns
+    def set_memories(self, pairs):
+        self.memories = [(Turn("Human", human), Turn("Bot", bot))
+                         for human, bot in pairs]
+
+    def memory_window(self):
+        budget = self.max_tokens // 4
+        included = []
+        for pair in self.memories:
+            for turn in pair:
+                if turn.ids is None:
+                    turn.ids = self.encode(turn.line())
+            size = len(pair[0].ids) + len(pair[1].ids)
+            if size > budget:
+                break
+            budget -= size
+            included.extend(pair)
+        return included
+
+    def encode(self, text):
+        self.encoded += 1
+        return self.tokenizer.encode(text)
+
+    # ANCHOR Choosing the turns fitting in the budget
+    def window(self):
+        if self.tokenizer is None:
+            raise Exception("No tokenizer set for the conversation")
+        if self.preamble_ids is None:
+            self.preamble_ids = self.encode(self.preamble)
+        self.recalled = self.memory_window()
+        budget = (self.max_tokens - len(self.preamble_ids) -
+                  sum(len(turn.ids) for turn in self.recalled))
+        included = []
+        # NOTE Walking backwards from the newest turn
+        for turn in reversed(self.turns):
+            if turn.ids is None:
+                turn.ids = self.encode(turn.line())
+            if len(turn.ids) > budget:
+                break
+            budget -= len(turn.ids)
+            included.append(turn)
+        included.reverse()
+        return included
+
+    # ANCHOR Building the prompt
+    def build_prompt(self):
+        return self.build()[0]
+
+    def build_ids(self):
+        return self.build()[1]
+
+    def build(self):
+        included = self.window()
+        # NOTE Recalled turns first, read as an earlier part of the chat
+        text = self.preamble + "".join(turn.line()
+                                       for turn in self.recalled + included)
+        ids = list(self.preamble_ids)
+        for turn in self.recalled + included:
+            ids.extend(turn.ids)
+        # NOTE Updating the statistics
+        self.builds += 1
+        self.last_included = len(included)
+        self.last_dropped = len(self.turns) - len(included)
+        self.last_tokens = len(ids)
+        self.last_memory_tokens = sum(len(turn.ids) for turn in self.recalled)
+        if self.last_dropped:
+            self.truncated_builds += 1
+        return text, ids
+
+    # ANCHOR Saving and restoring (see sessions.py)
+    def to_dict(self):
+        return {"preamble": self.preamble,
+                "preamble_ids": self.preamble_ids,
+                "tokenizer": self.tokenizer_name,
+                "max_tokens": self.max_tokens,
+                "turns": [{"speaker": turn.speaker,
+                           "text": turn.text,
+                           "ids": turn.ids} for turn in self.turns]}
+
+    @classmethod
+    def from_dict(cls, data):
+        conversation = cls(preamble=data["preamble"],
+                           max_tokens=data["max_tokens"])
+        # NOTE Only names are comparable across runs, not object ids
+        if isinstance(data.get("tokenizer"), str):
+            conversation.tokenizer_name = data["tokenizer"]
+            conversation.preamble_ids = data.get("preamble_ids")
+        for turn in data["turns"]:
+            ids = turn.get("ids") if conversation.tokenizer_name else None
+            conversation.turns.append(Turn(turn["speaker"], turn["text"], ids))
+        return conversation
+
+    # ANCHOR Statistics
+    def stats(self):
+        return {"turns": len(self.turns),
+                "included_turns": self.last_included,
+                "dropped_turns": self.last_dropped,
+                "prompt_tokens": self.last_tokens,
+                "memory_turns": len(self.recalled) // 2,
+                "memory_tokens": self.last_memory_tokens,
+                "max_tokens": self.max_tokens,
+                "builds": self.builds,
+                "truncated_builds": self.truncated_builds,
+                "tokenizer_calls": self.encoded}
@@ -0,0 +1,231 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import telemetry
+
+# INSTRUCTIONS:
+# declare a store once per process using
+# feedback_store = feedback.FeedbackStore([path="data/feedback.jsonl"])
+# and rate a bot reply using
+# feedback_store.rate(reply_id, model, human_text, bot_text, +1 or -1)
+# Every rating is appended to the file, never rewritten: rating the same
+# reply again appends a new line and the last one wins.
+# The approved replies are trained in the background using
+# scheduler = feedback.FeedbackScheduler(worker, feedback_store)
+# scheduler.start()
+# and calling scheduler.touch() on every user action. When nothing ran for
+# idle_seconds and at least min_pairs replies of a model are approved, a
+# small training job of at most max_pairs replies is queued on the worker
+# (never more than one every min_interval seconds, and after a failed
+# training the wait doubles up to max_backoff). A training interrupted
+# by new chat activity resumes on the next idle period (see pipeline.py),
+# and the trained replies are marked so they are never trained again.
+
+BATCH_FOLDER = "data/feedback"
+
+
+# ANCHOR Append-only feedback store
+class FeedbackStore:
+
+    def __init__(self, path="data/feedback.jsonl"):
+        self.path = path
+        self.lock = threading.Lock()
+        # NOTE reply id -> last rating record, and ids already trained
+        self.ratings = {}
+        self.trained = set()
+        if os.path.exists(self.path):
+            self.scan()
+
+    def scan(self):
+        with open(self.path) as feedback_stream:
+            for line in feedback_stream:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # NOTE A line cut by a crash, the others are still valid
+                    continue
+                self.apply(record)
+
+    # NOTE Must be called with the lock held (or while scanning)
+    def apply(self, record):
+        if record.get("type") == "trained":
+            self.trained.update(record["ids"])
+        else:
+            self.ratings[record["id"]] = record
+
+    def append(self, record):
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with self.lock:
+            with open(self.path, "a") as feedback_stream:
+                feedback_stream.write(json.dumps(record) + "\n")
+            self.apply(record)
+
+    # ANCHOR Writing
+    def rate(self, reply_id, model, human, bot, rating):
+        self.append({"type": "rating",
+                     "id": reply_id,
+                     "time": time.time(),
+                     "model": model,
+                     "human": human,
+                     "bot": bot,
+                     "rating": 1 if rating > 0 else -1})
+        telemetry.count("feedback.up" if rating > 0 else "feedback.down")
+
+    def mark_trained(self, ids):
+        self.append({"type": "trained", "time": time.time(), "ids": list(ids)})
+
+    # ANCHOR Reading
+    def approved(self, model=None):
+        # NOTE Oldest first, so an interrupted batch is picked again
+        with self.lock:
+            records = [record for record in self.ratings.values()
+                       if record["rating"] > 0 and
+                       record["id"] not in self.trained and
+                       (model is None or record["model"] == model)]
+        return sorted(records, key=lambda record: record["time"])
+
+    def stats(self):
+        with self.lock:
+            up = sum(1 for record in self.ratings.values()
+                     if record["rating"] > 0)
+            return {"rated": len(self.ratings),
+                    "up": up,
+                    "down": len(self.ratings) - up,
+                    "trained": len(self.trained)}
+
+
+# ANCHOR Training batches
+def write_batch(records, folder=BATCH_FOLDER):
+    # NOTE Same format as the conversation, one turn per line
+    text = "".join("Human: " + record["human"].strip() + "\n" +
+                   "Bot: " + record["bot"].strip() + "\n"
+                   for record in records)
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    path = folder + "/" + digest + ".txt"
+    if not os.path.exists(path):
+        os.makedirs(folder, exist_ok=True)
+        with open(path, "w") as batch_stream:
+            batch_stream.write(text)
+    return path
+
+
+class FeedbackScheduler:
+
+    def __init__(self, worker, store, min_pairs=8, max_pairs=64,
+                 idle_seconds=60, min_interval=30 * 60, check_every=10,
+                 max_backoff=24 * 60 * 60):
+        self.worker = worker
+        self.store = store
+        self.min_pairs = min_pairs
+        self.max_pairs = max_pairs
+        self.idle_seconds = idle_seconds
+        self.min_interval = min_interval
+        self.check_every = check_every
+        self.max_backoff = max_backoff
+        self.last_activity = time.time()
+        self.last_run = 0.0
+        # NOTE Failed trainings in a row, each one restores the weights
+        self.failures = 0
+        self.job = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    # NOTE Called on every user action, interrupts a running training
+    def touch(self):
+        self.last_activity = time.time()
+
+    def idle(self):
+        return time.time() - self.last_activity >= self.idle_seconds
+
+    # ANCHOR Choosing what to train
+    def next_batch(self):
+        models = {}
+        for record in self.store.approved():
+            models.setdefault(record["model"], []).append(record)
+        for model, records in models.items():
+            if len(records) >= self.min_pairs:
+                return model, records[:self.max_pairs]
+        return None, []
+
+    def wait_time(self):
+        if not self.failures:
+            return self.min_interval
+        return min(self.min_interval * 2 ** self.failures, self.max_backoff)
+
+    def check(self):
+        if self.job is not None and self.job.state in ("queued", "running"):
+            return None
+        if not self.idle() or self.worker.pending():
+            return None
+        if time.time() - self.last_run < self.wait_time():
+            return None
+        model, records = self.next_batch()
+        if model is None:
+            return None
+        self.job = self.submit(model, records)
+        return self.job
+
+    def submit(self, model, records):
+        path = write_batch(records)
+        ids = [record["id"] for record in records]
+        started = time.time()
+
+        def should_stop(job):
+            # NOTE Chat has priority, the training resumes when idle again
+            return job.cancelled() or self.last_activity > started
+
+        def run(job):
+            try:
+                gpt = self.worker.registry.get(model)
+                if should_stop(job):
+                    return False
+                job.progress("training on " + str(len(ids)) +
+                             " approved replies...")
+                import pipeline
+                trainer = pipeline.TrainingPipeline(gpt)
+                trained = trainer.run([path], progress=job.progress,
+                                      should_stop=lambda: should_stop(job))
+            except Exception:
+                # NOTE Failures count for the rate limit too, backing off
+                self.last_run = time.time()
+                self.failures += 1
+                telemetry.count("feedback.failed")
+                raise
+            # NOTE Not trained and not interrupted means a previous run
+            #      finished the batch but stopped before marking it
+            if trained or not should_stop(job):
+                # NOTE Interrupted runs do not count for the rate limit
+                self.last_run = time.time()
+                self.failures = 0
+                self.store.mark_trained(ids)
+                os.remove(path)
+                telemetry.count("feedback.trained", len(ids))
+            return trained
+
+        print("[*] Training " + model + " on " + str(len(ids)) +
+              " approved replies")
+        return self.worker.submit("feedback", model, run,
+                                  lane="train:" + model)
+
+    # ANCHOR Background thread
+    def loop(self):
+        while not self.stopped.wait(self.check_every):
+            try:
+                self.check()
+            except Exception as error:
+                print("[!] Feedback training not scheduled: " + str(error))
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.loop, name="feedback",
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
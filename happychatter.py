@@ -1,6 +1,24 @@
+import time
+# NOTE Startup clock, measured until the window is shown
+STARTED = time.perf_counter()
 import PySimpleGUI as sg
 import os
-import neo
+import json
+import threading
+# NOTE neo (torch, transformers) is imported by the registry on the first
+#      load, or in background right after the window is shown
+import catalogue
+import registry
+import sessions
+import context
+import worker
+import cache
+import chatlog
+import feedback
+import memory
+import router
+import artifacts
+import telemetry
 import uuid
 import base64
 
@@ -80,44 +98,136 @@ def get_model_description(model):
 os.chdir(os.path.dirname(os.path.realpath(__file__)))
 print(os.getcwd())
 
-# NOTE: Creating the structure needed if is not present
-if not os.path.exists("data"):
-    os.mkdir("data")
-if not os.path.exists("logs"):
-    os.mkdir("logs")
-if not os.path.exists("models/dialo-small"):
-    os.makedirs("models/dialo-small/preprocessed_data")
-if not os.path.exists("models/dialo-medium"):
-    os.makedirs("models/dialo-medium/preprocessed_data")
-if not os.path.exists("models/dialo-large"):
-    os.makedirs("models/dialo-large/preprocessed_data")
-if not os.path.exists("models/neo-small"):
-    os.makedirs("models/neo-small/preprocessed_data")
-if not os.path.exists("models/neo-medium"):
-    os.makedirs("models/neo-medium/preprocessed_data")
-if not os.path.exists("models/neo-large"):
-    os.makedirs("models/neo-large/preprocessed_data")
-if not os.path.exists("models/neox"):
-    os.makedirs("models/neox/preprocessed_data")
-if not os.path.exists("models/rag"):
-    os.makedirs("models/rag/preprocessed_data")
-if not os.path.exists("models/blender-small"):
-    os.makedirs("models/blender-small/preprocessed_data")
-if not os.path.exists("models/blender-medium"):
-    os.makedirs("models/blender-medium/preprocessed_data")
-if not os.path.exists("models/blender-large"):
-    os.makedirs("models/blender-large/preprocessed_data")
-if not os.path.exists("models/blender-huge"):
-    os.makedirs("models/blender-huge/preprocessed_data")
-if not os.path.exists("models/aeona"):
-    os.makedirs("models/aeona/preprocessed_data")
+# NOTE The folders are created on demand by the modules writing in them
 
-# ANCHOR Save chat method
+# ANCHOR Model selection helper
+# NOTE Radio button of every model (see catalogue.CATALOGUE)
+RADIO_KEYS = catalogue.radio_keys()
 
 
-def save_chat(logfile, In, Out):
-    with open(logfile, "a") as logfile_stream:
-        logfile_stream.write(In + "\n" + Out + "\n")
+def get_chosen_model(values):
+    for model, key in RADIO_KEYS.items():
+        if values[key]:
+            return model
+    return None
+
+
+# ANCHOR Loading job (runs on a worker thread)
+# NOTE The files come from the artifact manager, never downloaded by
+#      the model itself (see artifacts.py)
+def load_job(job):
+    if not job.data["artifacts"].wait(job.model, progress=job.progress,
+                                      should_stop=job.cancelled):
+        return None
+    job.progress("loading model, please be patient...")
+    job.worker.registry.get(job.model)
+    return job.model
+
+
+# ANCHOR Chat job (runs on a worker thread)
+def chat_job(job):
+    model_registry = job.worker.registry
+    conversation = job.data["conversation"]
+    # NOTE Waiting for the download started when the model was selected
+    if not job.data["artifacts"].wait(job.model, progress=job.progress,
+                                      should_stop=job.cancelled):
+        return None
+    # NOTE Model loading (only the first time, then kept in memory)
+    load_time = None
+    if not model_registry.is_loaded(job.model):
+        job.progress("loading model, please be patient...")
+        print("[*] Loading model...")
+        load_time = time.perf_counter()
+    with telemetry.timer("chat.load"):
+        if job.data["speculative"]:
+            # NOTE The small model of the family drafts for the large one
+            gpt = model_registry.get_speculative(job.model)
+        else:
+            gpt = model_registry.get(job.model)
+            if gpt.draft is not None:
+                gpt.set_draft(None)
+    if load_time is not None:
+        load_time = time.perf_counter() - load_time
+    gpt.response_cache = job.data["response_cache"]
+    # NOTE Settings of a reopened session, for this reply only: the model
+    #      is shared with the other sessions
+    previous = gpt.parameters()
+    if job.data["session_settings"]:
+        gpt.set_parameters(**job.data["session_settings"])
+    print("[+] Model loaded.")
+    print("REGISTRY: " + str(model_registry.stats()))
+    # NOTE Adding the turn here keeps queued messages in order
+    human = conversation.add("Human", job.data["text"])
+    try:
+        return chat_reply(job, gpt, conversation, load_time)
+    finally:
+        gpt.restore_parameters(previous)
+        # NOTE A cancelled or failed turn leaves no unanswered message
+        if conversation.turns[-1] is human:
+            conversation.remove(human)
+
+
+def chat_reply(job, gpt, conversation, load_time):
+    model_registry = job.worker.registry
+    if job.cancelled():
+        return None
+    job.progress("model loaded. Generating response...")
+    # NOTE Chatbot response
+    # NOTE Sending the most recent turns fitting in the model context
+    conversation.set_tokenizer(gpt.gen.tokenizer,
+                               max_tokens=gpt.context_budget(),
+                               name=gpt.model)
+    # NOTE Adding the few past turns closest to the message (see memory.py)
+    if job.data["memory"]:
+        memory_indexes = job.data["memory_indexes"]
+        # NOTE A new index when the model was trained since
+        if (job.model not in memory_indexes or
+                not memory_indexes[job.model].encoder.current(gpt)):
+            memory_indexes[job.model] = memory.MemoryIndex(
+                memory.HiddenStateEncoder(model_registry, job.model,
+                                          gpt.weights_name()))
+        job.progress("recalling past conversations...")
+        with telemetry.timer("chat.recall"):
+            recalled = memory.recall(memory_indexes[job.model], conversation,
+                                     job.data["text"])
+        print("MEMORY: " + str(len(recalled)) + " past turns recalled, " +
+              str(memory_indexes[job.model].stats()))
+    else:
+        conversation.set_memories([])
+    # NOTE Streaming the tokens to the window while they are decoded
+    # NOTE Passing the cached token ids so the model can reuse its KV cache
+    with telemetry.timer("chat.context"):
+        prompt, prompt_ids = conversation.build()
+    telemetry.observe("chat.prompt_tokens", len(prompt_ids))
+    with telemetry.timer("chat.generate"):
+        result, raw = gpt.generate_stream(prompt,
+                                          callback=job.stream,
+                                          should_stop=job.cancelled,
+                                          ids=prompt_ids)
+    print("CONTEXT: " + str(conversation.stats()))
+    print("RAW DATA:")
+    print(raw)
+    print("TIMING: first token %.2fs, total %.2fs" % (raw["ttft"], raw["total"]))
+    if "acceptance_rate" in raw:
+        print("DRAFT: %d of %d drafted tokens accepted (overall %.0f%%)" %
+              (raw["accepted"], raw["drafted"], 100 * gpt.acceptance_rate()))
+    print("RAW RESULT: " + result)
+    job.data["stats"] = raw
+    job.data["settings"] = gpt.settings
+    # NOTE Every reply improves the latency profiles (see router.py)
+    if not job.cancelled():
+        job.data["router"].observe(job.model, raw,
+                                   time.perf_counter() - job.created,
+                                   load_time=load_time,
+                                   routed=job.data["routed"])
+    result = result.strip()
+    if not job.cancelled():
+        conversation.add("Bot", result)
+        # NOTE Saving the state, token ids included, to reopen it later
+        with telemetry.timer("chat.session_save"):
+            job.data["session_store"].save(job.data["session"], conversation,
+                                           job.model, settings=gpt.settings)
+    return result
 
 # ANCHOR Settings Menu
 def settings_window():
@@ -164,31 +274,95 @@ def settings_window():
             # TODO Save a json
             break
 
+# ANCHOR Persistent settings
+SETTINGS_PATH = "data/settings.json"
+
+
+def load_settings():
+    settings = {"model": "neo-small", "warmup": False, "route": False,
+                "slo": 5.0}
+    try:
+        with open(SETTINGS_PATH) as settings_stream:
+            settings.update(json.load(settings_stream))
+    except (OSError, ValueError):
+        pass
+    return settings
+
+
+def save_settings(settings):
+    os.makedirs(os.path.dirname(SETTINGS_PATH), exist_ok=True)
+    temporary = SETTINGS_PATH + ".tmp"
+    with open(temporary, "w") as settings_stream:
+        json.dump(settings, settings_stream, indent=2)
+    os.replace(temporary, SETTINGS_PATH)
+
+# ANCHOR Background import of the ML libraries
+def import_models():
+    with telemetry.timer("startup.ml_imports"):
+        import neo
+    print("[+] ML libraries ready")
+
+# ANCHOR Sessions Menu
+def sessions_window(session_store):
+    entries = session_store.list()
+    labels = [time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["updated"])) +
+              "  " + entry["model"] + "  (" + str(entry["turns"]) + " turns)  " +
+              entry["title"] for entry in entries]
+    sessions_layout = [
+        [sg.Text("Saved conversations")],
+        [sg.Listbox(labels, size=(80, 12), key="-SESSIONS-")],
+        [sg.Button("Open"), sg.Button("New"), sg.Button("Cancel")]
+    ]
+    sessions = sg.Window('Sessions', layout=sessions_layout)
+    chosen = None
+    while True:
+        event, values = sessions.read()
+        if event == sg.WIN_CLOSED or event == 'Cancel':
+            break
+        elif event == 'New':
+            chosen = ""
+            break
+        elif event == 'Open' and values["-SESSIONS-"]:
+            chosen = entries[labels.index(values["-SESSIONS-"][0])]["id"]
+            break
+    sessions.close()
+    return chosen
+
 # ANCHOR Entry point
 if __name__ == "__main__":
-    # TODO Load JSON with settings
-    # NOTE Generating a random logfile name
-    folder = "logs"
+    # NOTE Last used model, warm up and routing preferences
+    app_settings = load_settings()
+    # NOTE Generating a random session id for the logs
     rname = str(uuid.uuid4())
-    filename = folder + "/" + rname
+    # NOTE Keeping the loaded models in memory between messages
+    model_registry = registry.ModelRegistry()
+    # NOTE Replies of deterministic settings are answered from the cache
+    response_cache = cache.ResponseCache()
+    # NOTE Vector indexes of the logged turns, by model (see memory.py)
+    memory_indexes = {}
+    # NOTE Latency profiles of the models, for the automatic choice
+    model_router = router.Router(slo=app_settings["slo"])
+    # NOTE Models downloaded in background, the loaded ones are never
+    #      deleted to respect the disk budget
+    artifact_manager = artifacts.ArtifactManager(
+        in_use=lambda: model_registry.stats()["resident"])
+    # NOTE Every load waits for the download, drafts and training included
+    model_registry.artifacts = artifact_manager
     # NOTE Preparing GUI parameters
     MLINE_KEY = '-ML-'+sg.WRITE_ONLY_KEY
     # NOTE Setting the default model description
     model_description = get_model_description("SMALL")
     output = "Output:\n\n"
-    # NOTE You can set an initial imprinting here
-    log = '''This is a conversation between a smart and curious Bot
-             and a Human. The bot is self conscious and creative.
-             The Bot is original and doesn't repeat the same sentences.\n\n
-             Human: Hello!\n
-             Bot: Hello there!\n
-             Human: How are you?\n
-             Bot: Fine! And you?\n
-             Human: Who are you?\n
-             Bot: I am a sentient bot, and you?\n'''
-    # NOTE Creating the logfile included initial logs
-    with open(filename, "w+") as logfile_stream:
-        logfile_stream.write("HappyChatter Logfile\n\n\n" + log)
+    # NOTE The initial imprinting is in context.py (shared with the server)
+    log = context.IMPRINTING
+    # NOTE Keeping the turns with their tokens to bound the prompt size
+    conversation = context.ConversationContext(preamble=log)
+    # NOTE Conversations are saved after every reply (see sessions.py)
+    session_store = sessions.SessionStore()
+    session_settings = None
+    # NOTE The logs are written in background (see chatlog.py)
+    chat_log = chatlog.ChatLog()
+    chat_log.start(rname, None, log)
     # NOTE Building the GUI
     sg.theme('Dark2')
     font = ("Arial", 12)
@@ -200,14 +374,32 @@ if __name__ == "__main__":
                             size=(100, 10), 
                             key=MLINE_KEY, 
                             autoscroll=True)],
-              [sg.Button("Settings", key="SETTINGS")],
+              [sg.Button("Settings", key="SETTINGS"),
+               sg.Button("Sessions", key="SESSIONS"),
+               sg.Button("Stats", key="STATS"),
+               sg.Checkbox("Speculative decoding (large models only)",
+                           key="-SPECULATIVE-", default=False),
+               sg.Checkbox("Long-term memory", key="-MEMORY-",
+                           default=False),
+               sg.Checkbox("Preload the last model at startup",
+                           key="-WARMUP-", enable_events=True,
+                           default=app_settings["warmup"])],
+              [sg.Checkbox("Choose the model automatically, replying within",
+                           key="-ROUTE-", default=app_settings["route"]),
+               sg.Input(str(app_settings["slo"]), key="-SLO-", size=(5, 1)),
+               sg.Text("seconds")],
               [sg.Text('Write something'),
                sg.Input(key='-IN-')],
-              [sg.Button('Send'), sg.Exit()],
+              [sg.Button('Send'), sg.Button('Cancel', key="CANCEL"), sg.Exit()],
+              [sg.Text('Rate the last reply'),
+               sg.Button('Good reply', key="-UP-"),
+               sg.Button('Bad reply', key="-DOWN-")],
               [sg.Text('Status: Ready', key="Status")],
               [sg.HorizontalSeparator()],
-              [sg.Text("Train on a file: "), 
-               sg.FileBrowse(key="-TRAINFILE-")],
+              [sg.Text("Train on files: "), 
+               sg.FilesBrowse(key="-TRAINFILE-"),
+               sg.Text("or a folder: "),
+               sg.FolderBrowse(key="-TRAINDIR-")],
               [sg.Button('Train')],
               [sg.HorizontalSeparator()],
               [sg.Text("Model Selection")],
@@ -246,7 +438,35 @@ if __name__ == "__main__":
               [sg.Button("Credits", key="CREDITS")]]
 
     print("ICON: " + icon)
-    window = sg.Window('HappyChatter', layout=layout)
+    window = sg.Window('HappyChatter', layout=layout, finalize=True)
+    if app_settings["model"] in RADIO_KEYS:
+        window[RADIO_KEYS[app_settings["model"]]].update(True)
+        model_description = get_model_description(
+            RADIO_KEYS[app_settings["model"]])
+        window["Description"].update(model_description)
+    telemetry.observe("startup.window", time.perf_counter() - STARTED)
+    print("[+] Window ready in %.2fs" % (time.perf_counter() - STARTED))
+    # NOTE Output text before each streamed reply, by job id
+    streaming = {}
+    # NOTE Running the models in the background so the window never freezes
+    chat_worker = worker.Worker(model_registry, post=window.write_event_value)
+    # NOTE Writing the metrics file every 30 seconds
+    telemetry.start_exporter()
+    # NOTE Rated replies, the approved ones are trained when the app is idle
+    feedback_store = feedback.FeedbackStore()
+    feedback_scheduler = feedback.FeedbackScheduler(chat_worker, feedback_store)
+    feedback_scheduler.start()
+    # NOTE Last bot reply, the one rated by the buttons
+    last_reply = None
+    # NOTE Warming up while the user writes the first message
+    if app_settings["warmup"]:
+        chat_worker.submit("load", app_settings["model"], load_job,
+                           artifacts=artifact_manager)
+    else:
+        # NOTE Downloading the last model while the user writes
+        artifact_manager.prefetch(app_settings["model"])
+        threading.Thread(target=import_models, name="imports",
+                         daemon=True).start()
 
     # ANCHOR Event loop
     while True:
@@ -258,96 +478,175 @@ if __name__ == "__main__":
             break
         # NOTE Text input event
         elif event == "Send":
+            # NOTE Chat has priority over the feedback training
+            feedback_scheduler.touch()
             # NOTE Getting the input
             text_input = values["-IN-"]
-            # NOTE Updating the output and the chat log
-            log += "Human: " + text_input + "\n"
+            # NOTE Updating the output, the chat log is updated by the job
             output += "Human: " + text_input + "\n"
             window[MLINE_KEY].update(output)
-            window["Status"].update(
-                "Status: loading model, please be patient...")
-            window.refresh()
+            window["-IN-"].update("")
             # NOTE Model preparation
-            model_chosen = None
-            if values["SMALL"]:
-                model_chosen = "neo-small"
-            elif values["MEDIUM"]:
-                model_chosen = "neo-medium"
-            elif values["LARGE"]:
-                model_chosen = "neo-large"
-            elif values["NEOX"]:
-                model_chosen = "neox"
-            elif values["DIALO-SMALL"]:
-                model_chosen = "dialo-small"
-            elif values["DIALO-MEDIUM"]:
-                model_chosen = "dialo-medium"
-            elif values["DIALO-LARGE"]:
-                model_chosen = "dialo-large"
-            elif values["RAG"]:
-                model_chosen = "rag"
-            elif values["BLENDER-SMALL"]:
-                model_chosen = "blender-small"
-            elif values["BLENDER-MEDIUM"]:
-                model_chosen = "blender-medium"
-            elif values["BLENDER-LARGE"]:
-                model_chosen = "blender-large"
-            elif values["BLENDER-HUGE"]:
-                model_chosen = "blender-huge"
-            elif values["AEONA"]:
-                model_chosen = "aeona"
-            # NOTE Model loading
-            print("[*] Loading model...")
-            gpt = neo.GPTNeo(model=model_chosen)
-            print("[+] Model loaded.")
-            window["Status"].update(
-                "Status: model loaded. Generating response...")
-            window.refresh()
-            # NOTE Loading existant training data if any
-            gpt.train("", load=True)
-            # NOTE Chatbot response
-            # NOTE Sending the whole log to try to keep coherency
-            result, raw = gpt.generate(log)
-            print("RAW DATA:")
-            print(raw)
-            print("RAW RESULT: " + result)
-            result = result.strip()
-            log += "Bot: " + result + "\n"
-            output += "Bot: " + result + "\n"
+            model_chosen = get_chosen_model(values)
+            routed = values["-ROUTE-"]
+            previous = dict(app_settings)
+            if routed:
+                try:
+                    model_router.slo = float(values["-SLO-"])
+                except ValueError:
+                    window["-SLO-"].update(str(model_router.slo))
+                # NOTE The largest model replying in time, given the queue
+                #      and the models already in memory
+                model_chosen = model_router.choose(
+                    resident=model_registry.stats()["resident"],
+                    pending=chat_worker.pending(),
+                    default=model_chosen)
+                print("ROUTER: " + str(model_router.stats()))
+            else:
+                app_settings["model"] = model_chosen
+            app_settings["route"] = routed
+            app_settings["slo"] = model_router.slo
+            if app_settings != previous:
+                save_settings(app_settings)
+            # NOTE Queueing the reply, chat jobs run one after the other
+            chat_worker.submit("chat", model_chosen, chat_job, lane="chat",
+                               text=text_input, conversation=conversation,
+                               response_cache=response_cache,
+                               session=rname, session_store=session_store,
+                               session_settings=session_settings,
+                               speculative=values["-SPECULATIVE-"],
+                               memory=values["-MEMORY-"],
+                               memory_indexes=memory_indexes,
+                               router=model_router, routed=routed,
+                               artifacts=artifact_manager)
+            window["Status"].update("Status: " + str(chat_worker.pending()) +
+                                    " job(s) queued")
+        # NOTE Background job events
+        elif event == worker.PROGRESS:
+            window["Status"].update("Status: " + values[event].message)
+        elif event == worker.PARTIAL:
+            job = values[event]
+            # NOTE Remembering where the streamed reply starts
+            if job.id not in streaming:
+                streaming[job.id] = output
+            window[MLINE_KEY].update(streaming[job.id] + "Bot: " + job.partial)
+        elif event == worker.DONE:
+            job = values[event]
+            if job.kind == "chat":
+                result = job.result
+                # NOTE Replacing the streamed text with the final reply
+                output = streaming.pop(job.id, output)
+                output += "Bot: " + result + "\n"
+                window[MLINE_KEY].update(output)
+                last_reply = {"id": str(uuid.uuid4()), "model": job.model,
+                              "human": job.data["text"], "bot": result}
+                # NOTE Saving the logs
+                with telemetry.timer("chat.log_write"):
+                    chat_log.turn(rname, job.model, job.data["text"], result,
+                                  settings=job.data["settings"],
+                                  stats=job.data["stats"])
+                telemetry.observe("chat.turn", time.perf_counter() - job.created)
+                print("[+] Done. Ready for another round")
+            if chat_worker.pending():
+                window["Status"].update("Status: " + str(chat_worker.pending()) +
+                                        " job(s) queued")
+            elif job.kind == "chat":
+                stats = job.data["stats"]
+                status = ("Status: ready (first token %.2fs, total %.2fs" %
+                          (stats["ttft"], stats["total"]))
+                if job.data["routed"]:
+                    status += ", answered by " + job.model
+                if "acceptance_rate" in stats:
+                    status += ", %.0f%% drafted tokens accepted" % (
+                        100 * stats["acceptance_rate"])
+                if stats.get("tokens_saved"):
+                    status += ", stopped at the %s, %d tokens saved" % (
+                        stats["stopped"], stats["tokens_saved"])
+                window["Status"].update(status + ")")
+            else:
+                window["Status"].update("Status: ready")
+        elif event == worker.ERROR:
+            job = values[event]
+            output = streaming.pop(job.id, output)
             window[MLINE_KEY].update(output)
-            window["Status"].update("Status: saving the response")
-            window.refresh()
-            result = "Bot: " + result
-            # NOTE Saving the logs
-            save_chat(filename, "Human: " + text_input, result)
-            window["Status"].update("Status: ready")
-            window.refresh()
-            print("[+] Done. Ready for another round")
+            window["Status"].update("Status: " + job.kind + " failed: " +
+                                    str(job.error))
+        elif event == worker.CANCELLED:
+            output = streaming.pop(values[event].id, output)
+            window[MLINE_KEY].update(output)
+            window["Status"].update("Status: cancelled")
+        elif event == "-WARMUP-":
+            app_settings["warmup"] = values["-WARMUP-"]
+            save_settings(app_settings)
+        elif event == "CANCEL":
+            chat_worker.cancel_all()
+        # NOTE Feedback events
+        elif event == "-UP-" or event == "-DOWN-":
+            if last_reply is None:
+                pass
+            else:
+                feedback_store.rate(last_reply["id"], last_reply["model"],
+                                    last_reply["human"], last_reply["bot"],
+                                    1 if event == "-UP-" else -1)
+                window["Status"].update("Status: feedback saved")
         # NOTE Train event
         elif event == "Train":
-            if values["-TRAINFILE-"] == "":
+            # NOTE Multiple files are separated by ";"
+            paths = [path for path in values["-TRAINFILE-"].split(";") if path]
+            if values["-TRAINDIR-"]:
+                paths.append(values["-TRAINDIR-"])
+            if not paths:
                 pass
             else:
                 window["Status"].update("Status: sending training...")
-                window.refresh()
-                gpt.train(values["-TRAINFILE-"])
-                window["Status"].update("Status: ready")
-                window.refresh()
+                feedback_scheduler.touch()
+                chat_worker.train(get_chosen_model(values), paths,
+                                  artifacts=artifact_manager)
         # NOTE Radio button change events
-        elif ((event == "SMALL") or
-              (event == "MEDIUM") or
-              (event == "LARGE") or
-              (event == "BLENDER-SMALL") or
-              (event == "BLENDER-MEDIUM") or
-              (event == "BLENDER-LARGE") or
-              (event == "BLENDER-HUGE") or
-              (event == "DIALO-SMALL") or
-              (event == "DIALO-MEDIUM") or
-              (event == "DIALO-LARGE") or
-              (event == "RAG") or
-              (event == "AEONA")):
+        elif event in RADIO_KEYS.values():
             model_description = get_model_description(event)
             window["Description"].update(model_description)
+            # NOTE Selecting never blocks, the download starts in background
+            model_selected = get_chosen_model(values)
+            if artifact_manager.prefetch(model_selected):
+                window["Status"].update("Status: downloading " +
+                                        model_selected + " in background")
             window.refresh()
+        elif event == "STATS":
+            # NOTE In-app stats panel, also exported to data/metrics.json
+            sg.popup_scrolled(telemetry.summary(),
+                              "Models: " + str(model_registry.stats()),
+                              "Context: " + str(conversation.stats()),
+                              "Response cache: " + str(response_cache.stats()),
+                              "Feedback: " + str(feedback_store.stats()),
+                              "Router: " + str(model_router.stats()),
+                              "Artifacts: " + str(artifact_manager.stats()),
+                              title="Stats", size=(100, 30))
+        elif event == "SESSIONS":
+            chosen = sessions_window(session_store)
+            if chosen is not None:
+                # NOTE Queued replies belong to the previous conversation
+                chat_worker.cancel_all("chat")
+                streaming.clear()
+                if chosen:
+                    conversation, meta = session_store.load(chosen)
+                    rname = chosen
+                    session_settings = meta["settings"]
+                    if meta["model"] in RADIO_KEYS:
+                        window[RADIO_KEYS[meta["model"]]].update(True)
+                        model_description = get_model_description(
+                            RADIO_KEYS[meta["model"]])
+                        window["Description"].update(model_description)
+                else:
+                    conversation = context.ConversationContext(preamble=log)
+                    rname = str(uuid.uuid4())
+                    session_settings = None
+                    chat_log.start(rname, None, log)
+                output = "Output:\n\n" + "".join(turn.line() for turn
+                                                 in conversation.turns)
+                window[MLINE_KEY].update(output)
+                last_reply = None
+                window["Status"].update("Status: ready")
         elif event == "SETTINGS":
             window.Hide()
             settings_window()
@@ -366,4 +665,8 @@ if __name__ == "__main__":
                      ''')
             window.UnHide()
     # NOTE Event close
+    telemetry.export()
+    feedback_scheduler.stop()
+    chat_worker.shutdown()
+    chat_log.close()
     window.close()
@@ -0,0 +1,354 @@
+import json
+import os
+import threading
+import zlib
+
+import chatlog
+import telemetry
+
+# INSTRUCTIONS:
+# declare an index once per process using
+# memory_index = memory.MemoryIndex(memory.HiddenStateEncoder(
+#     model_registry, model, gpt.weights_name()[, options]))
+# or, without a model, using a small local encoder
+# memory_index = memory.MemoryIndex(memory.HashEncoder())
+# memory_index = memory.MemoryIndex(memory.SentenceEncoder())  # needs
+#                                              # sentence-transformers
+# then, before building the prompt of a turn, recall the past turns using
+# memory.recall(memory_index, conversation, message[, k=3])
+# which indexes the turns logged since the last call (see chatlog.py), finds
+# the k past turns closest to the message and gives them to the
+# conversation (see context.ConversationContext.set_memories). Only these
+# few turns are added to the prompt, inside the same token budget, so the
+# prompt size stays bounded however long the history is.
+# The vectors are kept in data/memory/<encoder>/vectors.f32 (float32 rows,
+# memory mapped, appended to), the turns in memories.jsonl and the position
+# reached in every log file in state.json. A search is a single matrix
+# product over the mapped rows, the operating system keeps the pages in
+# memory. Statistics can be read using
+# memory_index.stats()
+
+# NOTE Past turns indexed at most per recall, the rest on the next turns,
+#      so a long history never delays a reply by much
+UPDATE_LIMIT = 64
+# NOTE Words left out by the hash encoder, they match almost every turn
+STOP_WORDS = frozenset(("a", "an", "and", "are", "be", "bot", "do", "for",
+                        "human", "i", "in", "is", "it", "me", "my", "of",
+                        "on", "the", "to", "what", "you", "your"))
+
+
+def normalize(vectors):
+    import numpy as np
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def turn_text(human, bot):
+    return "Human: " + human.strip() + "\nBot: " + bot.strip() + "\n"
+
+
+# ANCHOR Encoders
+# NOTE Mean of the last hidden states of the chat model itself, no other
+#      model to download or keep in memory. The model is asked to the
+#      registry at every encoding, the index does not keep it resident.
+#      The vectors only compare with the same weights: a new checkpoint or
+#      another precision needs a new index (see current)
+class HiddenStateEncoder:
+
+    # NOTE Turns less similar than min_score are not worth the prompt
+    #      tokens. Mean hidden states are all quite close to each other,
+    #      so only the k best count here
+    min_score = 0.0
+
+    def __init__(self, model_registry, model, weights, options=None,
+                 max_tokens=128, batch_size=8):
+        self.registry = model_registry
+        self.model = model
+        self.weights = weights
+        self.options = options or {}
+        self.max_tokens = max_tokens
+        self.batch_size = batch_size
+        self.name = "hidden-" + model + "-" + weights
+
+    def current(self, gpt):
+        return gpt.weights_name() == self.weights
+
+    def encode(self, texts):
+        import numpy as np
+        import torch
+        gpt = self.registry.get(self.model, **self.options)
+        if not self.current(gpt):
+            raise Exception("The weights of " + self.model + " changed, "
+                            "the memory index needs a new encoder")
+        model = gpt.gen.model
+        tokenizer = gpt.gen.tokenizer
+        # NOTE The encoder of encoder-decoder models, the base model
+        #      (without the language modeling head) of the others
+        if model.config.is_encoder_decoder:
+            encoder = model.get_encoder()
+        else:
+            encoder = model.base_model
+        filler = tokenizer.eos_token_id or 0
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = [tokenizer.encode(text)[:self.max_tokens] or [filler]
+                     for text in texts[start:start + self.batch_size]]
+            length = max(len(ids) for ids in batch)
+            # NOTE Padded by hand, not every tokenizer has a pad token
+            input_ids = torch.full((len(batch), length), filler,
+                                   dtype=torch.long)
+            mask = torch.zeros((len(batch), length), dtype=torch.long)
+            for row, ids in enumerate(batch):
+                input_ids[row, :len(ids)] = torch.tensor(ids)
+                mask[row, :len(ids)] = 1
+            with gpt.generation_lock, torch.no_grad():
+                hidden = encoder(input_ids=input_ids.to(model.device),
+                                 attention_mask=mask.to(model.device),
+                                 use_cache=False).last_hidden_state
+            weights = mask.to(hidden.device).unsqueeze(-1).to(hidden.dtype)
+            pooled = (hidden * weights).sum(1) / weights.sum(1)
+            vectors.append(pooled.float().cpu().numpy())
+        return normalize(np.concatenate(vectors))
+
+
+# NOTE Hashed bag of words, works without any model (i.e. with the stub)
+class HashEncoder:
+
+    min_score = 0.15
+
+    def __init__(self, dimensions=512):
+        self.dimensions = dimensions
+        self.name = "hash-" + str(dimensions)
+
+    def encode(self, texts):
+        import numpy as np
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in text.lower().split():
+                word = word.strip(".,;:!?\"'()")
+                if word and word not in STOP_WORDS:
+                    column = zlib.crc32(word.encode("utf-8")) % self.dimensions
+                    vectors[row, column] += 1.0
+        return normalize(vectors)
+
+
+# NOTE Small sentence embedding model, loaded the first time it is used
+class SentenceEncoder:
+
+    min_score = 0.3
+
+    def __init__(self, model="sentence-transformers/all-MiniLM-L6-v2"):
+        self.model_name = model
+        self.model = None
+        self.name = "sentence-" + model.split("/")[-1]
+
+    def encode(self, texts):
+        if self.model is None:
+            try:
+                from sentence_transformers import SentenceTransformer
+            except ImportError:
+                raise Exception("SentenceEncoder needs sentence-transformers "
+                                "(pip install sentence-transformers)")
+            self.model = SentenceTransformer(self.model_name)
+        return normalize(self.model.encode(texts))
+
+
+# ANCHOR Memory mapped vector index
+class MemoryIndex:
+
+    def __init__(self, encoder, folder="data/memory", logs="logs"):
+        self.encoder = encoder
+        self.folder = folder + "/" + encoder.name
+        self.logs = logs
+        self.vectors_path = self.folder + "/vectors.f32"
+        self.memories_path = self.folder + "/memories.jsonl"
+        self.state_path = self.folder + "/state.json"
+        self.lock = threading.Lock()
+        self.dimensions = None
+        self.memories = []
+        # NOTE Log file name (without .gz, rotation only compresses it)
+        #      -> lines already indexed
+        self.positions = {}
+        # NOTE Rotated files read to the end, they never change again
+        self.finished = set()
+        self.mapped = None
+        # Statistics
+        self.searches = 0
+        self.recalled = 0
+        self.indexed = 0
+        if os.path.exists(self.state_path):
+            self.load()
+
+    # ANCHOR Loading and saving
+    def load(self):
+        with open(self.state_path) as state_stream:
+            state = json.load(state_stream)
+        self.dimensions = state["dimensions"]
+        self.positions = state["positions"]
+        self.finished = set(state["finished"])
+        rows = state["rows"]
+        lines = []
+        if os.path.exists(self.memories_path):
+            with open(self.memories_path, encoding="utf-8") as memories_stream:
+                lines = memories_stream.readlines()
+        size = rows * (self.dimensions or 0) * 4
+        vectors_size = (os.path.getsize(self.vectors_path)
+                        if os.path.exists(self.vectors_path) else 0)
+        if len(lines) < rows or vectors_size < size:
+            raise Exception("Memory index damaged, delete " + self.folder)
+        self.memories = [json.loads(line) for line in lines[:rows]]
+        # NOTE Rows written after the last saved state (a crash in the
+        #      middle of an update) are dropped, they are indexed again
+        if len(lines) > rows:
+            with open(self.memories_path, "w",
+                      encoding="utf-8") as memories_stream:
+                memories_stream.writelines(lines[:rows])
+        if vectors_size > size:
+            with open(self.vectors_path, "r+b") as vectors_stream:
+                vectors_stream.truncate(size)
+
+    def save_state(self):
+        os.makedirs(self.folder, exist_ok=True)
+        temporary = self.state_path + ".tmp"
+        with open(temporary, "w") as state_stream:
+            json.dump({"encoder": self.encoder.name,
+                       "dimensions": self.dimensions,
+                       "rows": len(self.memories),
+                       "positions": self.positions,
+                       "finished": sorted(self.finished)}, state_stream)
+        os.replace(temporary, self.state_path)
+
+    def vectors(self):
+        import numpy as np
+        # NOTE Mapped again only when rows were appended
+        if self.mapped is None or len(self.mapped) != len(self.memories):
+            self.mapped = np.memmap(self.vectors_path, dtype=np.float32,
+                                    mode="r",
+                                    shape=(len(self.memories), self.dimensions))
+        return self.mapped
+
+    # ANCHOR Indexing the logged turns
+    def new_turns(self, limit):
+        turns = []
+        finished = []
+        for path in chatlog.log_files(self.logs):
+            name = os.path.basename(path)
+            if name in self.finished:
+                continue
+            rotated = name.endswith(".gz")
+            if rotated:
+                name = name[:-3]
+            done = self.positions.get(name, 0)
+            number = 0
+            for number, line in enumerate(chatlog.read_lines(path), 1):
+                if number <= done:
+                    continue
+                # NOTE The writer may be in the middle of the last line
+                if not line.endswith("\n"):
+                    number -= 1
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("type") == "turn" and record["bot"].strip():
+                    turns.append((name, number, record))
+                    if len(turns) == limit:
+                        return turns, finished
+            if number > done:
+                turns.append((name, number, None))
+            if rotated:
+                finished.append(name + ".gz")
+        return turns, finished
+
+    def update(self, limit=UPDATE_LIMIT):
+        with self.lock:
+            with telemetry.timer("recall.update"):
+                turns, finished = self.new_turns(limit)
+                records = [record for _, _, record in turns
+                           if record is not None]
+                if records:
+                    self.append(records)
+                for name, number, _ in turns:
+                    self.positions[name] = number
+                self.finished.update(finished)
+                if turns or finished:
+                    self.save_state()
+        return len(records)
+
+    def append(self, records):
+        vectors = self.encoder.encode([turn_text(record["human"],
+                                                 record["bot"])
+                                       for record in records])
+        if self.dimensions is None:
+            self.dimensions = vectors.shape[1]
+        os.makedirs(self.folder, exist_ok=True)
+        # NOTE Vectors first: rows without a turn are cut on loading
+        with open(self.vectors_path, "ab") as vectors_stream:
+            vectors_stream.write(vectors.tobytes())
+        memories = [{"session": record["session"],
+                     "time": record["time"],
+                     "human": record["human"],
+                     "bot": record["bot"]} for record in records]
+        with open(self.memories_path, "a", encoding="utf-8") as memories_stream:
+            memories_stream.write("".join(json.dumps(memory,
+                                                     ensure_ascii=False) + "\n"
+                                          for memory in memories))
+        self.memories.extend(memories)
+        self.indexed += len(memories)
+        telemetry.count("recall.indexed", len(memories))
+
+    # ANCHOR Searching
+    def search(self, text, k=3, skip=(), min_score=None):
+        import numpy as np
+        if min_score is None:
+            min_score = self.encoder.min_score
+        with self.lock:
+            if not self.memories:
+                return []
+            with telemetry.timer("recall.search"):
+                query = self.encoder.encode([text])[0]
+                scores = self.vectors() @ query
+                # NOTE Extra candidates in case some are skipped
+                wanted = min(len(scores), k + len(skip))
+                top = np.argpartition(-scores, wanted - 1)[:wanted]
+                top = top[np.argsort(-scores[top])]
+                found = []
+                # NOTE The same turn logged twice is recalled once
+                seen = set(skip)
+                for row in top:
+                    memory = self.memories[row]
+                    if scores[row] < min_score or len(found) == k:
+                        break
+                    pair = (memory["human"], memory["bot"])
+                    if pair in seen:
+                        continue
+                    seen.add(pair)
+                    found.append(dict(memory, score=float(scores[row])))
+            self.searches += 1
+            self.recalled += len(found)
+        return found
+
+    # ANCHOR Statistics
+    def stats(self):
+        return {"encoder": self.encoder.name,
+                "memories": len(self.memories),
+                "dimensions": self.dimensions,
+                "indexed": self.indexed,
+                "searches": self.searches,
+                "recalled": self.recalled}
+
+
+# ANCHOR Recalling into a conversation
+def recall(memory_index, conversation, message, k=3):
+    memory_index.update()
+    # NOTE Turns still in the prompt are not worth recalling
+    window = conversation.window() if conversation.tokenizer else []
+    pairs = set(zip([turn.text for turn in window[:-1]],
+                    [turn.text for turn in window[1:]]))
+    found = memory_index.search(message, k=k, skip=pairs)
+    conversation.set_memories([(memory["human"], memory["bot"])
+                               for memory in found])
+    return found
@@ -1,23 +1,55 @@
 from happytransformer import HappyGeneration, GENSettings, GENTrainArgs
+from happytransformer import happy_generation
+import contextlib
+import hashlib
+import json
 import os
+import shutil
+import threading
+import time
+
+import artifacts
+import catalogue
+import telemetry
+# NOTE Kept in catalogue.py and stops.py, which import nothing heavy
+from catalogue import MODELS, PRECISIONS, DRAFT_PAIRS
+from stops import STOP_SEQUENCES, STOP_WINDOW
+from stops import find_stop, partial_stop, cut_at_stop, cut_stream
 
 # SECTION Journal
 #
-# - TODO insert a feedback system to save the positive results and 
-#        call train() on them
+# - DONE insert a feedback system to save the positive results and 
+#        call train() on them (see feedback.py)
 # - TODO Create a corpus to start with some informations
-# - TODO Find a way to keep the model loaded in memory
+# - DONE Find a way to keep the model loaded in memory (see registry.py)
+# - DONE Stop retraining on preprocessed data before every reply
+#        (training now produces versioned checkpoints)
 #
 # !SECTION Journal
 
 # INSTRUCTIONS:
 # declare an instance using
-# gpt = neo.GPTNeo([model=model_type_as_below])
+# gpt = neo.GPTNeo([model=model_type_as_below][, precision="fp32"])
 # where model_type_as_below is one of the described below
+# and precision is one of fp32, bf16 or int8 (see PRECISIONS)
 # then you can either train the model on a dataset using
 # gpt.train(dataset_path)
+# or on many files and folders (tokenized in parallel and cached) using
+# gpt.train_files([file_or_folder, ...])
 # or generate text using
 # gpt.generate(prompt)
+# or receive the text while it is generated using
+# for piece in gpt.stream(prompt): ...
+# the time to first token and the total time of the last generation
+# are stored in gpt.last_stats
+# a smaller model of the same family can draft the tokens using
+# gpt.set_draft(small_gpt[, tokens=5]) (see DRAFT_PAIRS)
+# and the acceptance statistics are in gpt.draft_stats
+# the reply stops at the first turn boundary (see STOP_SEQUENCES), the
+# sequences can be changed with gpt.stop_sequences = (...) and the tokens
+# saved by stopping early are in gpt.last_stats["tokens_saved"]
+# several prompts can be generated together using
+# gpt.generate_batch([prompt, prompt, ...][, settings])
 # you can also override the default settings using
 # gpt.set_parameters([parameter=value])
 # where parameter is one included in the list below
@@ -27,6 +59,14 @@ import os
 
 # TODO: Improving flexibility through loading and saving preprocessed data
 
+# NOTE Checkpoints
+# Every training run saves the fine tuned model as a new version in
+# models/<folder>/checkpoints/v<number> together with a manifest.json
+# containing the hash of the dataset, the epochs and the datasets already
+# learned by the previous versions. The newest checkpoint is loaded directly
+# on startup, and a dataset whose hash is already in the manifest is not
+# trained again unless force=True is passed to train().
+
 # NOTE Advanced Settings Manual
 '''
 Parameter	Default	Definition
@@ -74,73 +114,362 @@ fp16: If true, enables half precision training which saves space by using 16 bit
 '''
 
 
+# NOTE Loading is serialized while the happytransformer loader is swapped
+loader_lock = threading.Lock()
+
+
+# ANCHOR Building a HappyGeneration around an already loaded model
+class PreloadedModel:
+
+    def __init__(self, loaded):
+        self.loaded = loaded
+
+    def from_pretrained(self, *args, **kwargs):
+        return self.loaded
+
+
+def build_generation(model_name, model, load_path, loaded):
+    # NOTE HappyGeneration always calls from_pretrained on its own, so the
+    #      loader it uses is replaced for the duration of the constructor.
+    #      The tokenizer is still read from load_path. Must be called with
+    #      loader_lock held.
+    original = happy_generation.AutoModelForCausalLM
+    happy_generation.AutoModelForCausalLM = PreloadedModel(loaded)
+    try:
+        return HappyGeneration(model_name, model, load_path=load_path)
+    finally:
+        happy_generation.AutoModelForCausalLM = original
+
+
+# ANCHOR Memory mapped weights
+# NOTE Every saved model is also written as model.safetensors. Loading it
+#      maps the file in memory instead of unpickling a copy: the tensors
+#      point straight to the page cache, so startup is faster, the peak
+#      memory is not doubled and processes serving the same model share
+#      the same pages.
+# NOTE save_pretrained splits the weights in 5GB shards by default, the
+#      large models (neo-large, blender-huge, even in bf16) are written
+#      as a single file instead
+MAX_SHARD_SIZE = "200GB"
+
+
+def save_generation(gen, folder):
+    gen.save(folder)
+    if not has_safetensors(folder):
+        gen.model.save_pretrained(folder, safe_serialization=True,
+                                  max_shard_size=MAX_SHARD_SIZE)
+
+
+def has_weights(folder):
+    # NOTE Large models are sharded, the index lists the shards
+    return any(os.path.exists(folder + "/" + name)
+               for name in ("model.safetensors", "model.safetensors.index.json",
+                            "pytorch_model.bin", "pytorch_model.bin.index.json"))
+
+
+def has_safetensors(folder):
+    return (os.path.exists(folder + "/model.safetensors") or
+            os.path.exists(folder + "/model.safetensors.index.json"))
+
+
+def safetensors_files(folder):
+    # NOTE Sharded checkpoints (i.e. downloaded from the hub) list their
+    #      shards in the index, every shard is mapped on its own
+    index_path = folder + "/model.safetensors.index.json"
+    if not os.path.exists(index_path):
+        return [folder + "/model.safetensors"]
+    with open(index_path) as index_stream:
+        weight_map = json.load(index_stream)["weight_map"]
+    return [folder + "/" + shard for shard in sorted(set(weight_map.values()))]
+
+
+def empty_model(config):
+    # NOTE Parameters are created on the meta device (no memory), buffers
+    #      are real since they are not always saved in the file. Must be
+    #      called with loader_lock held: accelerate swaps the parameter
+    #      registration of torch while the model is built.
+    from transformers import AutoModelForCausalLM
+    try:
+        from accelerate import init_empty_weights
+    except ImportError:
+        # NOTE Without accelerate the random weights are allocated, then
+        #      replaced by the mapped ones
+        return AutoModelForCausalLM.from_config(config)
+    with init_empty_weights(include_buffers=False):
+        return AutoModelForCausalLM.from_config(config)
+
+
+def read_safetensors(folder, device="cpu"):
+    from safetensors import safe_open
+    state = {}
+    for path in safetensors_files(folder):
+        with safe_open(path, framework="pt", device=device) as shard:
+            for name in shard.keys():
+                state[name] = shard.get_tensor(name)
+    return state
+
+
+def load_mmap(folder, dtype=None):
+    from transformers import AutoConfig
+
+    config = AutoConfig.from_pretrained(folder)
+    model = empty_model(config)
+    state = read_safetensors(folder)
+    model.load_state_dict(state, strict=False, assign=True)
+    # NOTE Tied weights (i.e. lm_head) are stored only once
+    model.tie_weights()
+    for name, parameter in model.named_parameters():
+        if parameter.is_meta:
+            raise Exception("Missing weight " + name + " in " + folder)
+    if dtype is not None:
+        model = model.to(dtype)
+    model.eval()
+    return model
+
+
+def quantize(model):
+    import torch
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear},
+                                               dtype=torch.qint8)
+
+
+# NOTE Name, size and modification time of the weights files of a folder,
+#      cheap to compute and different for any other weights
+def weights_signature(folder):
+    names = [name for name in sorted(os.listdir(folder))
+             if name.startswith(("model", "pytorch_model")) and
+             name.endswith((".safetensors", ".bin", ".json"))]
+    return [[name, os.path.getsize(folder + "/" + name),
+             os.path.getmtime(folder + "/" + name)] for name in names]
+
+
+# ANCHOR Checkpoint helpers
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as stream:
+        for chunk in iter(lambda: stream.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def list_checkpoints(model_folder):
+    # Returns the checkpoint folders, oldest first
+    folder = "models/" + model_folder + "/checkpoints"
+    if not os.path.exists(folder):
+        return []
+    versions = []
+    for name in os.listdir(folder):
+        path = folder + "/" + name
+        if (name.startswith("v") and name[1:].isdigit() and
+                os.path.exists(path + "/manifest.json")):
+            versions.append((int(name[1:]), path))
+    return [path for _, path in sorted(versions)]
+
+
+def read_manifest(checkpoint):
+    with open(checkpoint + "/manifest.json") as manifest_stream:
+        return json.load(manifest_stream)
+
+
+def weights_id(manifest):
+    # NOTE Digest of the whole manifest (datasets, epochs, creation time):
+    #      unlike the version number, it is never reused by other weights,
+    #      even when the checkpoints are deleted and trained again
+    if manifest is None:
+        return "base"
+    raw = json.dumps(manifest, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+# ANCHOR Speculative decoding compatibility
+# NOTE Returns why the draft cannot be used, None when it can
+def incompatible_draft(target, draft):
+    if draft is target:
+        return "same model"
+    if (target.gen.model.config.is_encoder_decoder or
+            draft.gen.model.config.is_encoder_decoder):
+        return "encoder-decoder models are not supported"
+    if target.gen.tokenizer.get_vocab() != draft.gen.tokenizer.get_vocab():
+        return "different tokenizers"
+    return None
+
+
+# ANCHOR Hashable form of a GENSettings (used to group and cache requests)
+def settings_key(settings):
+    key = []
+    for value in vars(settings).values():
+        if isinstance(value, list):
+            value = tuple(value)
+        key.append(value)
+    return tuple(key)
+
+
 class GPTNeo:
 
-    def __init__(self, model="neo-small"):
+    def __init__(self, model="neo-small", precision="fp32"):
         # Preparing the model
         self.model = None
         self.model_name = None
         self.model_folder = model
         self.set_model(model)
+        if precision not in PRECISIONS:
+            raise Exception("Invalid precision")
+        self.precision = precision
+        load_start = time.perf_counter()
         # Checking if model exists and loading it
         final_folder = "models/" + self.model_folder
-        if not os.path.exists(final_folder + "/pytorch_model.bin"):
-            self.gen = HappyGeneration(self.model_name,
-                                       self.model)
-            self.gen.save(final_folder)
+        # NOTE The newest checkpoint wins over the base model
+        checkpoints = list_checkpoints(self.model_folder)
+        self.checkpoint = None
+        if checkpoints:
+            self.checkpoint = read_manifest(checkpoints[-1])
+            source = checkpoints[-1]
         else:
-            self.gen = HappyGeneration(self.model_name,
-                                       self.model,
-                                       load_path=final_folder)
+            source = final_folder
+        # NOTE Where the current weights are saved (see restore_weights)
+        self.weights_folder = source
+        # NOTE Every load path runs under loader_lock: building the model
+        #      swaps global loaders (see build_generation and empty_model)
+        with loader_lock:
+            if not checkpoints and not has_weights(final_folder):
+                self.gen = HappyGeneration(self.model_name,
+                                           self.model)
+                save_generation(self.gen, final_folder)
+                if precision != "fp32":
+                    self.gen = self.load_precision(source)
+            elif precision != "fp32":
+                self.gen = self.load_precision(source)
+            elif has_safetensors(source):
+                self.gen = build_generation(self.model_name, self.model,
+                                            source, load_mmap(source))
+            else:
+                self.gen = HappyGeneration(self.model_name,
+                                           self.model,
+                                           load_path=source)
+                # NOTE Old pickled model, adding the mappable copy for
+                #      next time
+                save_generation(self.gen, source)
+            # NOTE The files written above belong to the download
+            #      (see artifacts.record_files)
+            artifacts.record_files(self.model_folder)
+        telemetry.observe("neo.load", time.perf_counter() - load_start)
+        telemetry.count("neo.loads")
+        telemetry.metrics.memory()
         # Default settings
         self.settings = None
         self.setted = False
+        self.last_stats = None
+        self.last_batch_stats = None
+        # NOTE Optional cache of deterministic replies (see cache.py)
+        self.response_cache = None
+        # NOTE Past key/values of the current conversation (see stream)
+        self.kv_cache = None
+        self.kv_ids = []
+        self.generation_lock = threading.Lock()
+        # NOTE Turn boundaries and compiled bad words (see generate_kwargs)
+        self.stop_sequences = STOP_SEQUENCES
+        self.bad_words_ids = {}
+        # NOTE Optional draft model for speculative decoding (see set_draft)
+        self.draft = None
+        self.draft_stats = {"runs": 0, "drafted": 0, "accepted": 0,
+                            "verify_steps": 0, "new_tokens": 0}
+        # NOTE Migrating old preprocessed data into a checkpoint (only once)
+        if self.checkpoint is None and precision == "fp32":
+            self.train("", load=True)
+
+    # ANCHOR Reduced precision loading
+    # NOTE The conversion happens once per checkpoint, then the converted
+    #      model is loaded directly from models/<folder>/precision/<precision>
+    #      (called with loader_lock held)
+    def load_precision(self, source):
+        import torch
+        from transformers import AutoConfig, AutoModelForCausalLM
+        folder = ("models/" + self.model_folder + "/precision/" +
+                  self.precision)
+        # NOTE The converted copy is valid for the very same weights only:
+        #      checkpoint folders are reused when the versions start over
+        signature = weights_signature(source)
+        converted = None
+        if os.path.exists(folder + "/source.json"):
+            with open(folder + "/source.json") as source_stream:
+                if json.load(source_stream).get("weights") == signature:
+                    converted = folder
+        if converted is None:
+            # NOTE Converting from the fp32 weights
+            print("[*] Converting " + source + " to " + self.precision)
+            if has_safetensors(source):
+                loaded = load_mmap(source)
+            else:
+                loaded = AutoModelForCausalLM.from_pretrained(source)
+            temporary = folder + ".tmp"
+            if os.path.exists(temporary):
+                shutil.rmtree(temporary)
+            os.makedirs(temporary)
+            if self.precision == "bf16":
+                loaded = loaded.to(torch.bfloat16)
+                loaded.save_pretrained(temporary, safe_serialization=True,
+                                       max_shard_size=MAX_SHARD_SIZE)
+            else:
+                loaded = quantize(loaded)
+                # NOTE Only the tensors, loaded back without unpickling
+                #      any code (see below)
+                loaded.config.save_pretrained(temporary)
+                torch.save(loaded.state_dict(), temporary + "/model_state.pt")
+            with open(temporary + "/source.json", "w") as source_stream:
+                json.dump({"source": source,
+                           "weights": signature,
+                           "precision": self.precision,
+                           "created": time.time()}, source_stream)
+            if os.path.exists(folder):
+                shutil.rmtree(folder)
+            os.rename(temporary, folder)
+        elif self.precision == "bf16":
+            loaded = load_mmap(folder, dtype=torch.bfloat16)
+        else:
+            # NOTE Same quantized layers, then the saved tensors
+            loaded = quantize(AutoModelForCausalLM.from_config(
+                AutoConfig.from_pretrained(folder)))
+            loaded.load_state_dict(torch.load(folder + "/model_state.pt",
+                                              weights_only=True))
+        loaded.eval()
+        return build_generation(self.model_name, self.model, source, loaded)
 
     # ANCHOR Model selection
     def set_model(self, model):
-        # Supporting either small/medium/large and 125M/1.3B/2.7B
-        if model == "neo-small":
-            self.model = "EleutherAI/gpt-neo-125M"  # Approx 600MB
+        # NOTE Hub repository and happytransformer name from catalogue.py
+        if model == "tiny":
+            # NOTE Tiny random model for offline benchmarks, created by
+            #      python benchmark.py --tiny
+            self.model = "models/tiny"
             self.model_name = "GPT-NEO"
-        elif model == "neo-medium":
-            self.model = "EleutherAI/gpt-neo-1.3B"  # Approx 5GB
-            self.model_name = "GPT-NEO"
-        elif model == "neo-large":
-            self.model = "EleutherAI/gpt-neo-2.7B"  # Approx 10GB
-            self.model_name = "GPT-NEO"
-        elif model == "neox":
-            self.model = "EleutherAI/gpt-neox-20b"  # Approx 45GB
-            self.model_name = "GPT-NEOX"
-        elif model == "dialo-small":
-            self.model = "microsoft/DialoGPT-small"
-            self.model_name = "DialoGPT-Small"
-        elif model == "dialo-medium":
-            self.model = "microsoft/DialoGPT-medium"
-            self.model_name = "DialoGPT-Medium"
-        elif model == "dialo-large":
-            self.model = "microsoft/DialoGPT-large"
-            self.model_name = "DialoGPT-Large"
-        elif model == "rag":
-            self.model = "facebook/rag-token-nq"
-            self.model_name = "RAG"
-        elif model == "blender-small":
-            self.model = "facebook/blenderbot_small-90M"
-            self.model_name = "BLENDER-SMALL"
-        elif model == "blender-medium":
-            self.model = "facebook/blenderbot-400M-distill"
-            self.model_name = "BLENDER-MEDIUM"
-        elif model == "blender-large":
-            self.model = "facebook/blenderbot-1B-distill"
-            self.model_name = "BLENDER-LARGE"
-        elif model == "blender-huge":
-            self.model = "facebook/blenderbot-3B"
-            self.model_name = "BLENDER-HUGE"
-        elif model == "aeona":
-            self.model = "deepparag/Aeona"
-            self.model_name = "AEONA"
+        elif model in catalogue.CATALOGUE:
+            self.model = catalogue.repo(model)
+            self.model_name = catalogue.happy_name(model)
         else:
             raise Exception("Invalid model")
 
+    # ANCHOR Speculative decoding
+    # NOTE The draft is another GPTNeo (usually from the registry), pass
+    #      None to go back to plain decoding
+    def set_draft(self, draft, tokens=5):
+        if draft is None:
+            self.draft = None
+            return
+        reason = incompatible_draft(self, draft)
+        if reason is not None:
+            raise Exception("Cannot draft " + self.model_folder + " with " +
+                            draft.model_folder + ": " + reason)
+        config = draft.gen.model.generation_config
+        config.num_assistant_tokens = tokens
+        # NOTE A fixed number of drafted tokens, as configured in DRAFT_PAIRS
+        config.num_assistant_tokens_schedule = "constant"
+        self.draft = draft
+
+    def acceptance_rate(self):
+        if not self.draft_stats["drafted"]:
+            return 0.0
+        return self.draft_stats["accepted"] / self.draft_stats["drafted"]
+
     # ANCHOR Custom parameters support
     def set_parameters(self,
                        min_length=10,
@@ -168,46 +497,185 @@ class GPTNeo:
         self.no_repeat_ngram_size = no_repeat_ngram_size
         self.bad_words = bad_words
 
+    # NOTE Parameters given to set_parameters, None for the defaults, so
+    #      a caller can put them back (see happychatter.chat_job)
+    def parameters(self):
+        if not self.setted:
+            return None
+        return {"min_length": self.min_length,
+                "max_length": self.max_length,
+                "do_sample": self.do_sample,
+                "early_stopping": self.early_stopping,
+                "num_beams": self.num_beams,
+                "temperature": self.temperature,
+                "top_k": self.top_k,
+                "top_p": self.top_p,
+                "no_repeat_ngram_size": self.no_repeat_ngram_size,
+                "bad_words": self.bad_words}
+
+    def restore_parameters(self, parameters):
+        if parameters is None:
+            self.setted = False
+        else:
+            self.set_parameters(**parameters)
+
     # ANCHOR Training on a file with custom settings as above
     def train(self,
               file,
               load=False,
               epochs=1,
+              force=False,
+              keep=3
               # TODO Add other parameters
               ):
         # Training the model
         # TODO Add other parameters
+        if self.precision != "fp32":
+            raise Exception("Training needs the fp32 precision")
+        preprocessed = ("models/" + self.model_folder +
+                        "/preprocessed_data/preprocess.json")
         # NOTE Supporting plain loading of preprocessed data
         if not load:
+            dataset = file
+            os.makedirs(os.path.dirname(preprocessed), exist_ok=True)
             # NOTE Training and saving data for the next time
             train_settings = GENTrainArgs(num_train_epochs=epochs,
                                           save_preprocessed_data=True,
-                                          save_preprocessed_data_path="models/" +
-                                          self.model_folder +
-                                          "/preprocessed_data/preprocess.json")
+                                          save_preprocessed_data_path=preprocessed)
         else:
-            if os.path.exists("models/" + self.model_folder +
-                              "/preprocessed_data/preprocess.json"):
+            if os.path.exists(preprocessed):
+                dataset = preprocessed
                 # NOTE Loading a preprocessed file
                 train_settings = GENTrainArgs(num_train_epochs=epochs,
                                               load_preprocessed_data=True,
-                                              load_preprocessed_data_path="models/" +
-                                              self.model_folder +
-                                              "/preprocessed_data/preprocess.json")
+                                              load_preprocessed_data_path=preprocessed)
             else:
                 # NOTE Silently avoid loading if not existing
-                return
+                return False
+
+        # NOTE Skipping data that is already part of the checkpoint
+        dataset_hash = file_hash(dataset)
+        if not force and dataset_hash in self.trained_hashes():
+            print("[*] Dataset already trained, skipping: " + dataset)
+            return False
 
         # NOTE Training process
-        self.gen.train(file, args=train_settings)
+        with self.generation_lock:
+            # NOTE New weights, the cached keys/values are not valid anymore
+            self.drop_cache()
+            try:
+                with telemetry.timer("neo.train"):
+                    self.gen.train(file, args=train_settings)
+            except BaseException:
+                # NOTE Not serving half trained weights
+                self.restore_weights()
+                raise
+            self.save_checkpoint(dataset, dataset_hash, epochs, preprocessed,
+                                 keep)
+        return True
 
-    # ANCHOR Actual generation
-    def generate(self, initial):
+    # ANCHOR Training on many files or folders (see pipeline.py)
+    def train_files(self, paths, epochs=1, force=False, progress=None,
+                    should_stop=None):
+        import pipeline
+        trainer = pipeline.TrainingPipeline(self)
+        return trainer.run(paths, epochs=epochs, force=force,
+                           progress=progress, should_stop=should_stop)
 
-        # Setting the input to predict
-        input = initial
+    # ANCHOR Hashes of everything the current weights learned
+    def trained_hashes(self):
+        if self.checkpoint is None:
+            return set()
+        hashes = set()
+        for entry in self.checkpoint["datasets"]:
+            hashes.add(entry["hash"])
+            if entry.get("preprocessed_hash"):
+                hashes.add(entry["preprocessed_hash"])
+        return hashes
 
-        # Generating the reply
+    # ANCHOR Saving a new checkpoint version with its manifest
+    def save_checkpoint(self, dataset, dataset_hash, epochs, preprocessed=None, keep=3):
+        checkpoints = list_checkpoints(self.model_folder)
+        version = 1
+        if checkpoints:
+            version = read_manifest(checkpoints[-1])["version"] + 1
+        folder = ("models/" + self.model_folder +
+                  "/checkpoints/v" + str(version).zfill(4))
+        # NOTE Writing in a temporary folder so a crash never leaves
+        #      a half written checkpoint behind
+        temporary = folder + ".tmp"
+        if os.path.exists(temporary):
+            shutil.rmtree(temporary)
+        save_generation(self.gen, temporary)
+        entry = {"file": dataset,
+                 "hash": dataset_hash,
+                 "epochs": epochs,
+                 "preprocessed_hash": None}
+        if preprocessed is not None and os.path.exists(preprocessed):
+            entry["preprocessed_hash"] = file_hash(preprocessed)
+        previous = self.checkpoint["datasets"] if self.checkpoint else []
+        manifest = {"version": version,
+                    "model": self.model,
+                    "created": time.time(),
+                    "parent": self.checkpoint["version"] if self.checkpoint else None,
+                    "dataset_hash": dataset_hash,
+                    "epochs": epochs,
+                    "total_epochs": sum(d["epochs"] for d in previous) + epochs,
+                    "datasets": previous + [entry]}
+        with open(temporary + "/manifest.json", "w") as manifest_stream:
+            json.dump(manifest, manifest_stream, indent=2)
+        os.rename(temporary, folder)
+        self.checkpoint = manifest
+        self.weights_folder = folder
+        # NOTE Keeping only the newest versions on disk
+        for old in list_checkpoints(self.model_folder)[:-keep]:
+            shutil.rmtree(old)
+        print("[+] Saved checkpoint " + folder)
+        return folder
+
+    # ANCHOR Going back to the saved weights of the current checkpoint
+    # NOTE Used when a training stops half way: the model keeps serving the
+    #      weights of self.checkpoint, which the cache keys refer to. Must
+    #      be called with generation_lock held.
+    def restore_weights(self):
+        model = self.gen.model
+        if has_safetensors(self.weights_folder):
+            state = read_safetensors(self.weights_folder,
+                                     device=str(model.device))
+        else:
+            from transformers import AutoModelForCausalLM
+            state = AutoModelForCausalLM.from_pretrained(
+                self.weights_folder).state_dict()
+        model.load_state_dict(state, strict=False)
+        model.tie_weights()
+        model.eval()
+        self.drop_cache()
+        print("[*] Restored the weights of " + self.weights_folder)
+
+    # NOTE Identifies the weights in memory: checkpoint and precision
+    def weights_name(self):
+        return weights_id(self.checkpoint) + "-" + self.precision
+
+    # ANCHOR Prompt budget
+    def context_size(self):
+        # Maximum number of positions the model can attend to
+        config = self.gen.model.config
+        for attribute in ("max_position_embeddings", "n_positions", "n_ctx"):
+            size = getattr(config, attribute, None)
+            if size:
+                return size
+        return 1024
+
+    def context_budget(self):
+        # NOTE Leaving room for the tokens to be generated
+        if self.setted:
+            max_length = self.max_length
+        else:
+            max_length = GENSettings().max_length
+        return self.context_size() - max_length
+
+    # ANCHOR Settings in use for the next generation
+    def generation_settings(self):
         if self.setted:
             # Initializing the settings
             self.settings = GENSettings(
@@ -222,12 +690,442 @@ class GPTNeo:
                 no_repeat_ngram_size=self.no_repeat_ngram_size,
                 bad_words=self.bad_words
             )
-            result = self.gen.generate_text(input,
-                                            args=self.settings)
         else:
             self.settings = GENSettings(no_repeat_ngram_size=2,
                                         do_sample=True,
                                         top_k=50,
                                         temperature=0.7)
-            result = self.gen.generate_text(input, args=self.settings)
+        return self.settings
+
+    # ANCHOR Translating GENSettings for the transformers model
+    # NOTE Same conversion happytransformer does in generate_text
+    def generate_kwargs(self, settings, input_length):
+        tokenizer = self.gen.tokenizer
+        return {"min_length": settings.min_length + input_length,
+                "max_length": settings.max_length + input_length,
+                "do_sample": settings.do_sample,
+                "early_stopping": settings.early_stopping,
+                "num_beams": settings.num_beams,
+                "temperature": settings.temperature,
+                "top_k": settings.top_k,
+                "top_p": settings.top_p,
+                "no_repeat_ngram_size": settings.no_repeat_ngram_size,
+                "bad_words_ids": self.compile_bad_words(settings.bad_words),
+                "eos_token_id": self.eos_ids(),
+                "pad_token_id": tokenizer.eos_token_id}
+
+    # NOTE Tokenized once per list, not before every reply
+    def compile_bad_words(self, bad_words):
+        if not bad_words:
+            return None
+        key = tuple(bad_words)
+        if key not in self.bad_words_ids:
+            tokenizer = self.gen.tokenizer
+            self.bad_words_ids[key] = [tokenizer(" " + phrase.strip()).input_ids
+                                       for phrase in bad_words
+                                       if phrase.strip()] or None
+        return self.bad_words_ids[key]
+
+    # NOTE Every end of sequence token of the model (DialoGPT and Aeona end
+    #      each turn with one, the generation config may list more)
+    def eos_ids(self):
+        ids = []
+        for value in (self.gen.tokenizer.eos_token_id,
+                      getattr(self.gen.model.generation_config,
+                              "eos_token_id", None)):
+            if value is None:
+                continue
+            for token in (value if isinstance(value, list) else [value]):
+                if token not in ids:
+                    ids.append(token)
+        return ids or None
+
+    # ANCHOR Actual generation
+    def generate(self, initial):
+
+        # Setting the input to predict
+        input = initial
+
+        # Generating the reply
+        start = time.perf_counter()
+        settings = self.generation_settings()
+        # NOTE Deterministic settings can be answered from the cache
+        key = self.cache_key(input, settings)
+        cached = self.cached_reply(key, start)
+        if cached is not None:
+            return cached, happy_generation.GenerationResult(text=cached)
+        result = self.gen.generate_text(input, args=settings)
+        # NOTE No stopping criteria through happytransformer, cutting after
+        result.text = cut_at_stop(result.text, self.stop_sequences)
+        total = time.perf_counter() - start
+        # NOTE Without streaming the first token arrives with the last one
+        self.last_stats = {"ttft": total, "total": total, "streamed": False}
+        telemetry.observe("neo.generate", total)
+        if key is not None:
+            self.response_cache.put(key, result.text)
         return result.text, result
+
+    # ANCHOR Response cache (see cache.py)
+    def cache_key(self, prompt, settings):
+        if (self.response_cache is None or
+                not self.response_cache.cacheable(settings)):
+            return None
+        return self.response_cache.key(self.model,
+                                       self.weights_name(),
+                                       prompt,
+                                       settings_key(settings),
+                                       self.stop_sequences)
+
+    def cached_reply(self, key, start):
+        if key is None:
+            return None
+        cached = self.response_cache.get(key)
+        if cached is not None:
+            total = time.perf_counter() - start
+            self.last_stats = {"ttft": total, "total": total,
+                               "streamed": False, "cached": True}
+            telemetry.count("neo.cached_replies")
+        return cached
+
+    # ANCHOR Conversation KV cache
+    # NOTE The past key/values of the last generation are kept together with
+    #      the token ids they cover. When the next prompt starts with the
+    #      same tokens (the usual case in a chat, where only the new turn is
+    #      appended) the cache is cropped to the common prefix and only the
+    #      new tokens are fed to the model. When the context window slides the
+    #      common prefix shrinks to the preamble, when nothing is shared the
+    #      cache is dropped.
+    def reusable_cache(self, ids, settings):
+        if self.kv_cache is None:
+            return None, 0
+        if (settings.num_beams > 1 or
+                self.gen.model.config.is_encoder_decoder):
+            self.drop_cache()
+            return None, 0
+        common = 0
+        for cached, new in zip(self.kv_ids, ids):
+            if cached != new:
+                break
+            common += 1
+        # NOTE The model must always receive at least one new token
+        common = min(common, len(ids) - 1)
+        if common <= 0:
+            self.drop_cache()
+            return None, 0
+        self.kv_cache.crop(common)
+        self.kv_ids = self.kv_ids[:common]
+        return self.kv_cache, common
+
+    def keep_cache(self, output):
+        try:
+            from transformers import DynamicCache
+        except ImportError:
+            # NOTE Old transformers, no cache reuse
+            return
+        cache = getattr(output, "past_key_values", None)
+        if cache is None or self.gen.model.config.is_encoder_decoder:
+            self.drop_cache()
+            return
+        if not isinstance(cache, DynamicCache):
+            cache = DynamicCache.from_legacy_cache(cache)
+        self.kv_cache = cache
+        self.kv_ids = output.sequences[0].tolist()[:cache.get_seq_length()]
+
+    def drop_cache(self):
+        self.kv_cache = None
+        self.kv_ids = []
+
+    # ANCHOR Streaming generation
+    # NOTE Yields the text as soon as it is decoded, should_stop is an
+    #      optional function returning True to interrupt the generation.
+    #      The prompt token ids can be passed in ids to skip tokenization.
+    def stream(self, initial, should_stop=None, ids=None):
+        settings = self.generation_settings()
+        if settings.num_beams > 1:
+            # NOTE Streamers do not support beam search
+            text, _ = self.generate(initial)
+            yield text
+            return
+        start = time.perf_counter()
+        key = self.cache_key(initial, settings)
+        cached = self.cached_reply(key, start)
+        if cached is not None:
+            yield cached
+            return
+        import torch
+        from transformers import (TextIteratorStreamer, StoppingCriteria,
+                                  StoppingCriteriaList)
+
+        class StopOnRequest(StoppingCriteria):
+            def __call__(self, input_ids, scores, **kwargs):
+                return should_stop is not None and should_stop()
+
+        tokenizer = self.gen.tokenizer
+        model = self.gen.model
+        if ids is None:
+            ids = tokenizer.encode(initial)
+        stops = self.stop_sequences
+        boundary = {"stop": None}
+
+        # NOTE Only the last few new tokens are decoded at every step
+        class StopAtTurn(StoppingCriteria):
+            def __call__(self, input_ids, scores, **kwargs):
+                new = input_ids[0, len(ids):]
+                if not len(new):
+                    return False
+                tail = tokenizer.decode(new[-STOP_WINDOW:],
+                                        skip_special_tokens=True)
+                # NOTE The tail is the start of the reply only at first
+                found = find_stop(tail, stops,
+                                  reply_start=len(new) <= STOP_WINDOW)
+                if found is not None:
+                    boundary["stop"] = found[1]
+                    return True
+                return False
+
+        draft = self.draft
+        # NOTE The draft may be chatting on its own too, waiting for it
+        draft_lock = (draft.generation_lock if draft is not None
+                      else contextlib.nullcontext())
+        with self.generation_lock, draft_lock:
+            if draft is not None:
+                # NOTE Drafting rebuilds the caches of both models, the
+                #      conversation cache is not reused
+                self.drop_cache()
+                cache, reused = None, 0
+            else:
+                cache, reused = self.reusable_cache(ids, settings)
+            input_ids = torch.tensor([ids], device=model.device)
+            streamer = TextIteratorStreamer(tokenizer,
+                                            skip_prompt=True,
+                                            skip_special_tokens=True)
+            kwargs = self.generate_kwargs(settings, len(ids))
+            kwargs["input_ids"] = input_ids
+            kwargs["attention_mask"] = torch.ones_like(input_ids)
+            kwargs["streamer"] = streamer
+            criteria = [StopOnRequest()]
+            if stops:
+                criteria.append(StopAtTurn())
+            kwargs["stopping_criteria"] = StoppingCriteriaList(criteria)
+            kwargs["return_dict_in_generate"] = True
+            if cache is not None:
+                kwargs["past_key_values"] = cache
+            # NOTE Counting the forward passes of both models: every pass
+            #      of the draft proposes a token, every pass of the target
+            #      verifies them and adds one token of its own
+            calls = {"target": 0, "draft": 0}
+            hooks = []
+            if draft is not None:
+                kwargs["assistant_model"] = draft.gen.model
+
+                def counter(name):
+                    def count(*args):
+                        calls[name] += 1
+                    return count
+
+                hooks = [model.register_forward_hook(counter("target")),
+                         draft.gen.model.register_forward_hook(counter("draft"))]
+            outputs = []
+            errors = []
+
+            def run():
+                try:
+                    outputs.append(model.generate(**kwargs))
+                except Exception as error:
+                    errors.append(error)
+                    # NOTE Unblocking the consumer
+                    streamer.end()
+
+            first = None
+            pieces = 0
+            text = ""
+            thread = threading.Thread(target=run, daemon=True)
+            thread.start()
+            # NOTE The boundary is never shown (see stops.cut_stream)
+            for piece in cut_stream(streamer, stops):
+                if first is None:
+                    first = time.perf_counter() - start
+                pieces += 1
+                text += piece
+                yield piece
+            thread.join()
+            for hook in hooks:
+                hook.remove()
+            total = time.perf_counter() - start
+            if errors:
+                self.drop_cache()
+                raise errors[0]
+            if draft is None:
+                self.keep_cache(outputs[0])
+            sequence = outputs[0].sequences[0]
+            new_tokens = len(sequence) - len(ids)
+            ttft = first if first is not None else total
+            # NOTE Why the generation ended, and the decode budget left
+            if boundary["stop"] is not None:
+                stopped = "turn"
+            elif new_tokens and int(sequence[-1]) in (self.eos_ids() or []):
+                stopped = "eos"
+            elif should_stop is not None and should_stop():
+                stopped = "cancelled"
+            else:
+                stopped = "max_length"
+            saved = 0
+            if stopped in ("turn", "eos"):
+                saved = max(settings.max_length - new_tokens, 0)
+            self.last_stats = {"ttft": ttft,
+                               "total": total,
+                               "streamed": True,
+                               "pieces": pieces,
+                               "prompt_tokens": len(ids),
+                               "reused_tokens": reused,
+                               "prefill_tokens": len(ids) - reused,
+                               "new_tokens": new_tokens,
+                               "stopped": stopped,
+                               "tokens_saved": saved}
+            if draft is not None:
+                self.draft_statistics(draft, calls, new_tokens)
+            telemetry.observe("neo.prefill", ttft)
+            telemetry.observe("neo.decode", total - ttft)
+            telemetry.observe("neo.new_tokens", new_tokens)
+            telemetry.count("tokens.prefilled", len(ids) - reused)
+            telemetry.count("tokens.reused", reused)
+            telemetry.count("tokens.generated", new_tokens)
+            telemetry.count("tokens.saved", saved)
+            telemetry.count("neo.stopped." + stopped)
+            # NOTE Interrupted replies are not complete, not caching them
+            if key is not None and not (should_stop is not None and should_stop()):
+                self.response_cache.put(key, text)
+
+    def draft_statistics(self, draft, calls, new_tokens):
+        accepted = max(new_tokens - calls["target"], 0)
+        self.draft_stats["runs"] += 1
+        self.draft_stats["drafted"] += calls["draft"]
+        self.draft_stats["accepted"] += accepted
+        self.draft_stats["verify_steps"] += calls["target"]
+        self.draft_stats["new_tokens"] += new_tokens
+        self.last_stats.update({
+            "draft_model": draft.model_folder,
+            "drafted": calls["draft"],
+            "accepted": accepted,
+            "verify_steps": calls["target"],
+            "acceptance_rate": accepted / calls["draft"] if calls["draft"] else 0.0})
+        telemetry.count("draft.drafted", calls["draft"])
+        telemetry.count("draft.accepted", accepted)
+        telemetry.count("draft.verify_steps", calls["target"])
+
+    # ANCHOR Batched generation
+    # NOTE Generates a reply for every prompt. settings is either None (the
+    #      current settings), one GENSettings for all the prompts or a list
+    #      with one GENSettings per prompt. Prompts sharing the same settings
+    #      are padded on the left and run in a single forward pass per step.
+    #      With return_stats=True the statistics of every prompt are returned
+    #      too, as (replies, stats), instead of only in last_batch_stats.
+    def generate_batch(self, prompts, settings=None, return_stats=False):
+        import torch
+        from transformers import StoppingCriteria, StoppingCriteriaList
+        if settings is None:
+            settings = self.generation_settings()
+        if not isinstance(settings, (list, tuple)):
+            settings = [settings] * len(prompts)
+        groups = {}
+        for index, prompt_settings in enumerate(settings):
+            group = groups.setdefault(settings_key(prompt_settings),
+                                      (prompt_settings, []))
+            group[1].append(index)
+        tokenizer = self.gen.tokenizer
+        model = self.gen.model
+        stops = self.stop_sequences
+        results = [None] * len(prompts)
+        row_tokens = [0] * len(prompts)
+        new_tokens = 0
+        start = time.perf_counter()
+
+        # NOTE One flag per row: the rows reaching a turn boundary are
+        #      finished (padded) while the others keep generating, and the
+        #      whole batch ends as soon as every row is finished
+        class StopRowsAtTurn(StoppingCriteria):
+            def __init__(self, input_length):
+                self.input_length = input_length
+                self.done = None
+
+            def __call__(self, input_ids, scores, **kwargs):
+                if self.done is None:
+                    self.done = torch.zeros(input_ids.shape[0],
+                                            dtype=torch.bool,
+                                            device=input_ids.device)
+                new = input_ids[:, self.input_length:]
+                if not new.shape[1]:
+                    return self.done.clone()
+                tails = tokenizer.batch_decode(new[:, -STOP_WINDOW:],
+                                               skip_special_tokens=True)
+                for row, tail in enumerate(tails):
+                    if self.done[row]:
+                        continue
+                    if find_stop(tail, stops, reply_start=new.shape[1] <=
+                                 STOP_WINDOW) is not None:
+                        self.done[row] = True
+                return self.done.clone()
+
+        with self.generation_lock:
+            padding_side = tokenizer.padding_side
+            pad_token = tokenizer.pad_token
+            tokenizer.padding_side = "left"
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
+            try:
+                for group_settings, indexes in groups.values():
+                    inputs = tokenizer([prompts[i] for i in indexes],
+                                       return_tensors="pt",
+                                       padding=True).to(model.device)
+                    input_length = inputs["input_ids"].shape[1]
+                    kwargs = self.generate_kwargs(group_settings, input_length)
+                    kwargs["pad_token_id"] = tokenizer.pad_token_id
+                    if stops:
+                        kwargs["stopping_criteria"] = StoppingCriteriaList(
+                            [StopRowsAtTurn(input_length)])
+                    with torch.no_grad():
+                        output = model.generate(**inputs, **kwargs)
+                    generated = output[:, input_length:]
+                    counts = (generated != tokenizer.pad_token_id).sum(1)
+                    new_tokens += int(counts.sum())
+                    texts = tokenizer.batch_decode(generated,
+                                                   skip_special_tokens=True)
+                    for index, text, count in zip(indexes, texts, counts):
+                        results[index] = cut_at_stop(text, self.stop_sequences)
+                        row_tokens[index] = int(count)
+            finally:
+                tokenizer.padding_side = padding_side
+                tokenizer.pad_token = pad_token
+        total = time.perf_counter() - start
+        self.last_batch_stats = {"batch_size": len(prompts),
+                                 "groups": len(groups),
+                                 "new_tokens": new_tokens,
+                                 "total": total,
+                                 "tokens_per_sec": new_tokens / total if total else 0.0}
+        telemetry.observe("neo.batch", total)
+        telemetry.observe("neo.batch_size", len(prompts))
+        telemetry.count("tokens.generated", new_tokens)
+        # NOTE Deterministic replies are kept for the next same request
+        for prompt, prompt_settings, text in zip(prompts, settings, results):
+            key = self.cache_key(prompt, prompt_settings)
+            if key is not None:
+                self.response_cache.put(key, text)
+        if not return_stats:
+            return results
+        stats = [{"batch_size": len(prompts),
+                  "groups": len(groups),
+                  "batch_new_tokens": new_tokens,
+                  "new_tokens": tokens,
+                  "total": total,
+                  "tokens_per_sec": new_tokens / total if total else 0.0,
+                  "streamed": False} for tokens in row_tokens]
+        return results, stats
+
+    # ANCHOR Streaming generation with a callback
+    def generate_stream(self, initial, callback=None, should_stop=None, ids=None):
+        text = ""
+        for piece in self.stream(initial, should_stop=should_stop, ids=ids):
+            text += piece
+            if callback is not None:
+                callback(piece)
+        return text, self.last_stats
@@ -0,0 +1,296 @@
+import array
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import neo
+import telemetry
+
+# INSTRUCTIONS:
+# train a loaded model on many files or whole folders using
+# trainer = pipeline.TrainingPipeline(gpt)
+# trainer.run([file_or_folder, ...][, epochs=1])
+# 1. every file is hashed and tokenized in parallel by a process pool, the
+#    tokens are cached as a shard in models/<folder>/shards/<hash>.bin so an
+#    unchanged file is never tokenized again (even if renamed)
+# 2. the shards are merged in models/<folder>/shards/dataset.bin, a flat
+#    array of 16 bit (or 32 bit for big vocabularies) token ids, with its
+#    index in dataset.json
+# 3. the model is trained on blocks of the merged dataset. The progress is
+#    saved in models/<folder>/train_state every save_every steps, so an
+#    interrupted training (crash or cancel) resumes where it stopped. After
+#    an interruption the model goes back to the weights of its checkpoint
+# 4. the result is saved as a new checkpoint (see neo.py), and a dataset
+#    already part of the checkpoint is not trained again
+
+EXTENSIONS = (".txt", ".md", ".log")
+
+# NOTE Tokenizer of the pool processes, loaded once per process
+TOKENIZER = None
+
+
+# ANCHOR Pool process helpers
+def load_tokenizer(path):
+    global TOKENIZER
+    from transformers import AutoTokenizer
+    TOKENIZER = AutoTokenizer.from_pretrained(path)
+
+
+def tokenize_file(path, shard, typecode):
+    ids = array.array(typecode)
+    with open(path, encoding="utf-8", errors="replace") as text_stream:
+        for line in text_stream:
+            # NOTE Same as the datasets "text" loader: one sample per line
+            line = line.rstrip("\n")
+            if line.strip():
+                ids.extend(TOKENIZER.encode(line + "\n"))
+    temporary = shard + ".tmp"
+    with open(temporary, "wb") as shard_stream:
+        ids.tofile(shard_stream)
+    os.replace(temporary, shard)
+    return len(ids)
+
+
+# ANCHOR Collecting the files
+def collect_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in sorted(os.walk(path)):
+                for name in sorted(names):
+                    if name.endswith(EXTENSIONS):
+                        files.append(os.path.join(root, name))
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            raise Exception("Training data not found: " + path)
+    return files
+
+
+class TrainingPipeline:
+
+    def __init__(self, gpt, block_size=256, batch_size=4, learning_rate=5e-5,
+                 save_every=50, processes=None):
+        self.gpt = gpt
+        self.folder = "models/" + gpt.model_folder
+        self.shards = self.folder + "/shards"
+        self.state_folder = self.folder + "/train_state"
+        self.block_size = min(block_size, gpt.context_size())
+        self.batch_size = batch_size
+        self.learning_rate = learning_rate
+        self.save_every = save_every
+        self.processes = processes or os.cpu_count() or 1
+        # NOTE 16 bits are enough for every supported vocabulary but neox
+        self.typecode = "H" if len(gpt.gen.tokenizer) < 2 ** 16 else "I"
+
+    # ANCHOR 1. Tokenizing the new files in parallel
+    def tokenize(self, files, progress=None):
+        os.makedirs(self.shards, exist_ok=True)
+        hashes = [neo.file_hash(path) for path in files]
+        missing = {}
+        for path, digest in zip(files, hashes):
+            if not os.path.exists(self.shard_path(digest)):
+                missing[digest] = path
+        telemetry.count("pipeline.cached_shards", len(files) - len(missing))
+        if missing:
+            if progress:
+                progress("tokenizing " + str(len(missing)) + " file(s)...")
+            # NOTE The pool processes load the tokenizer from disk
+            tokenizer_path = self.shards + "/tokenizer"
+            self.gpt.gen.tokenizer.save_pretrained(tokenizer_path)
+            context = multiprocessing.get_context("spawn")
+            with telemetry.timer("pipeline.tokenize"):
+                with ProcessPoolExecutor(max_workers=min(self.processes,
+                                                         len(missing)),
+                                         mp_context=context,
+                                         initializer=load_tokenizer,
+                                         initargs=(tokenizer_path,)) as pool:
+                    futures = [pool.submit(tokenize_file, path,
+                                           self.shard_path(digest),
+                                           self.typecode)
+                               for digest, path in missing.items()]
+                    for future in futures:
+                        future.result()
+        return hashes
+
+    def shard_path(self, digest):
+        return self.shards + "/" + digest + ".bin"
+
+    # ANCHOR 2. Merging the shards in a single compact file
+    def merge(self, files, hashes):
+        key = hashlib.sha256((self.typecode + "".join(hashes))
+                             .encode("utf-8")).hexdigest()
+        index_path = self.shards + "/dataset.json"
+        data_path = self.shards + "/dataset.bin"
+        if os.path.exists(index_path) and os.path.exists(data_path):
+            with open(index_path) as index_stream:
+                index = json.load(index_stream)
+            if index["key"] == key:
+                return index
+        item_size = array.array(self.typecode).itemsize
+        entries = []
+        offset = 0
+        temporary = data_path + ".tmp"
+        with open(temporary, "wb") as data_stream:
+            for path, digest in zip(files, hashes):
+                with open(self.shard_path(digest), "rb") as shard_stream:
+                    shutil.copyfileobj(shard_stream, data_stream)
+                length = os.path.getsize(self.shard_path(digest)) // item_size
+                entries.append({"file": path, "hash": digest,
+                                "offset": offset, "length": length})
+                offset += length
+        os.replace(temporary, data_path)
+        index = {"key": key, "typecode": self.typecode,
+                 "tokens": offset, "files": entries}
+        with open(index_path, "w") as index_stream:
+            json.dump(index, index_stream, indent=2)
+        return index
+
+    # ANCHOR 3. Resumable training
+    def load_state(self, key):
+        state_file = self.state_folder + "/state.json"
+        if not os.path.exists(state_file):
+            return None
+        with open(state_file) as state_stream:
+            state = json.load(state_stream)
+        if state["key"] != key:
+            # NOTE Progress of a different dataset, starting over
+            shutil.rmtree(self.state_folder)
+            return None
+        return state
+
+    def save_state(self, state, model, optimizer):
+        import torch
+        temporary = self.state_folder + ".tmp"
+        if os.path.exists(temporary):
+            shutil.rmtree(temporary)
+        os.makedirs(temporary)
+        torch.save({"model": model.state_dict(),
+                    "optimizer": optimizer.state_dict()},
+                   temporary + "/weights.pt")
+        with open(temporary + "/state.json", "w") as state_stream:
+            json.dump(state, state_stream)
+        if os.path.exists(self.state_folder):
+            shutil.rmtree(self.state_folder)
+        os.rename(temporary, self.state_folder)
+
+    def train(self, index, epochs, progress=None, should_stop=None):
+        import numpy
+        import torch
+        dtype = numpy.uint16 if index["typecode"] == "H" else numpy.uint32
+        data = numpy.memmap(self.shards + "/dataset.bin", dtype=dtype, mode="r")
+        # NOTE A dataset shorter than a block (a few feedback replies) is
+        #      trained as a single shorter block
+        block_size = min(self.block_size, len(data))
+        if block_size < 2:
+            raise Exception("Not enough training data for a single block")
+        blocks = len(data) // block_size
+        steps = (blocks + self.batch_size - 1) // self.batch_size
+        model = self.gpt.gen.model
+        optimizer = torch.optim.AdamW(model.parameters(), lr=self.learning_rate)
+        state = self.load_state(index["key"])
+        if state is not None:
+            weights = torch.load(self.state_folder + "/weights.pt")
+            model.load_state_dict(weights["model"])
+            optimizer.load_state_dict(weights["optimizer"])
+            if progress:
+                progress("resuming epoch " + str(state["epoch"] + 1) +
+                         " at step " + str(state["step"]))
+        else:
+            state = {"key": index["key"], "epoch": 0, "step": 0,
+                     "epochs": epochs}
+        model.train()
+        try:
+            while state["epoch"] < epochs:
+                # NOTE Same order for the same epoch, so resuming skips
+                #      exactly the blocks already seen
+                generator = torch.Generator().manual_seed(state["epoch"])
+                order = torch.randperm(blocks, generator=generator).tolist()
+                while state["step"] < steps:
+                    if should_stop is not None and should_stop():
+                        self.save_state(state, model, optimizer)
+                        return False
+                    start = time.perf_counter()
+                    chosen = order[state["step"] * self.batch_size:
+                                   (state["step"] + 1) * self.batch_size]
+                    batch = numpy.stack([data[block * block_size:
+                                              (block + 1) * block_size]
+                                         for block in chosen])
+                    input_ids = torch.from_numpy(batch.astype(numpy.int64))
+                    input_ids = input_ids.to(model.device)
+                    loss = model(input_ids=input_ids, labels=input_ids).loss
+                    loss.backward()
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+                    optimizer.step()
+                    optimizer.zero_grad()
+                    state["step"] += 1
+                    telemetry.observe("pipeline.step", time.perf_counter() - start)
+                    telemetry.count("pipeline.samples", len(chosen))
+                    if progress:
+                        progress("epoch %d/%d step %d/%d loss %.3f" %
+                                 (state["epoch"] + 1, epochs, state["step"],
+                                  steps, loss.item()))
+                    if state["step"] % self.save_every == 0:
+                        self.save_state(state, model, optimizer)
+                state["epoch"] += 1
+                state["step"] = 0
+        finally:
+            model.eval()
+        return True
+
+    # ANCHOR Whole pipeline
+    def run(self, paths, epochs=1, force=False, progress=None, should_stop=None):
+        if self.gpt.precision != "fp32":
+            raise Exception("Training needs the fp32 precision")
+        files = collect_files(paths)
+        if not files:
+            raise Exception("No training files found")
+        hashes = self.tokenize(files, progress)
+        index = self.merge(files, hashes)
+        if not force and index["key"] in self.gpt.trained_hashes():
+            print("[*] Dataset already trained, skipping")
+            return False
+        with self.gpt.generation_lock:
+            # NOTE The weights change, the cached keys/values are not valid
+            self.gpt.drop_cache()
+            try:
+                with telemetry.timer("pipeline.train"):
+                    finished = self.train(index, epochs, progress,
+                                          should_stop)
+            except BaseException:
+                self.gpt.restore_weights()
+                raise
+            if not finished:
+                # NOTE The half trained weights are kept in train_state
+                #      only, the model serves the last checkpoint meanwhile
+                self.gpt.restore_weights()
+                print("[*] Training interrupted, it will resume next time")
+                return False
+            description = ", ".join(entry["file"] for entry in index["files"])
+            self.gpt.save_checkpoint(description, index["key"], epochs)
+        shutil.rmtree(self.state_folder, ignore_errors=True)
+        return True
+
+
+# ANCHOR Command line
+# python pipeline.py model_type file_or_folder [...] [--epochs N]
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="HappyChatter training")
+    parser.add_argument("model", choices=neo.MODELS + ("tiny",))
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args()
+    paths = [os.path.abspath(path) for path in args.paths]
+    # NOTE Same working directory layout as the GUI
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    trainer = TrainingPipeline(neo.GPTNeo(model=args.model))
+    trained = trainer.run(paths, epochs=args.epochs, force=args.force,
+                          progress=print)
+    sys.exit(0 if trained else 1)
@@ -0,0 +1,397 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import context
+
+# INSTRUCTIONS:
+# serve a model from several processes using
+# model_pool = pool.ModelPool(model_type_as_in_neo[, workers=4][, threads=2])
+# then, from as many threads as needed, ask for a reply using
+# future = model_pool.chat(session_id, message[, state=context.to_dict()])
+# future = model_pool.generate(prompt)
+# result = future.result()
+# Every worker process has its own GPTNeo, pinned to its own cores with
+# threads torch threads, so the workers never fight for the same cores and
+# the GIL is not shared. The weights are shared between the workers:
+# - start_method="spawn" (default, works everywhere) loads the model in
+#   every worker from the memory mapped safetensors, so the pages of the
+#   weights are in memory only once (see neo.load_mmap)
+# - start_method="fork" (Linux) loads the model once in this process and
+#   forks the workers, which share the weights copy-on-write
+# Chat requests of the same session always go to the same worker, so its
+# KV cache keeps matching the conversation (see neo.GPTNeo.stream). New
+# sessions go to the least busy worker.
+# A request running for longer than timeout seconds fails and its worker is
+# killed. A worker that dies is started again: the request it was running
+# fails, the ones queued behind it go to the other workers.
+# Statistics can be read using
+# model_pool.stats()
+
+# NOTE Conversations kept by every worker, least recently used dropped
+#      (the sessions remembered by the pool too, per worker)
+MAX_SESSIONS = 256
+# NOTE Seconds a request may run before its worker is considered stuck
+TIMEOUT = 300
+# NOTE Seconds between two checks of the workers while idle
+CHECK_EVERY = 1.0
+
+
+# ANCHOR Worker process
+def serve(index, model, options, parameters, threads, cores, requests,
+          results, gpt=None):
+    import torch
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    start = time.perf_counter()
+    try:
+        if gpt is None:
+            import neo
+            gpt = neo.GPTNeo(model=model, **options)
+        if parameters:
+            gpt.set_parameters(**parameters)
+    except Exception as error:
+        traceback.print_exc()
+        results.put(("ready", index, str(error)))
+        return
+    results.put(("ready", index, time.perf_counter() - start))
+    conversations = {}
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        request_id, kind, data = request
+        try:
+            if kind == "chat":
+                result = chat_turn(gpt, conversations, data)
+            else:
+                text, stats = gpt.generate_stream(data["prompt"])
+                result = {"text": text, "stats": stats}
+            results.put((request_id, True, result))
+        except Exception as error:
+            traceback.print_exc()
+            results.put((request_id, False, str(error)))
+
+
+def chat_turn(gpt, conversations, data):
+    session = data["session"]
+    conversation = conversations.pop(session, None)
+    # NOTE Left behind by an earlier visit of the session (it went to
+    #      another worker meanwhile), the state sent is newer
+    if (conversation is not None and data.get("state") is not None and
+            len(conversation.turns) != len(data["state"]["turns"])):
+        conversation = None
+    if conversation is None:
+        if data.get("state") is not None:
+            conversation = context.ConversationContext.from_dict(data["state"])
+        else:
+            conversation = context.ConversationContext(
+                preamble=context.IMPRINTING)
+    # NOTE Reinserted last, so the first one is the least recently used
+    conversations[session] = conversation
+    while len(conversations) > MAX_SESSIONS:
+        conversations.pop(next(iter(conversations)))
+    conversation.add("Human", data["message"])
+    conversation.set_tokenizer(gpt.gen.tokenizer,
+                               max_tokens=gpt.context_budget(),
+                               name=gpt.model)
+    prompt, prompt_ids = conversation.build()
+    text, stats = gpt.generate_stream(prompt, ids=prompt_ids)
+    reply = text.strip()
+    conversation.add("Bot", reply)
+    return {"reply": reply,
+            "stats": stats,
+            "settings": vars(gpt.settings) if gpt.settings else None,
+            "state": conversation.to_dict()}
+
+
+# ANCHOR Core assignment
+def core_sets(workers, threads):
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    if len(cores) < workers * threads:
+        # NOTE Not enough cores to pin, the system schedules the threads
+        return [None] * workers
+    return [cores[number * threads:(number + 1) * threads]
+            for number in range(workers)]
+
+
+class ModelPool:
+
+    def __init__(self, model, workers=2, threads=None, start_method="spawn",
+                 parameters=None, timeout=TIMEOUT, **options):
+        self.model = model
+        self.workers = workers
+        cores = (len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity")
+                 else os.cpu_count() or 1)
+        self.threads = threads or max(1, cores // workers)
+        self.timeout = timeout
+        self.options = options
+        self.parameters = parameters
+        self.context = multiprocessing.get_context(start_method)
+        self.results = self.context.Queue()
+        self.queues = []
+        self.processes = []
+        self.cores = core_sets(workers, self.threads)
+        self.lock = threading.Lock()
+        # NOTE request id -> (future, worker index, kind, data, session,
+        #      deadline), kept until the result arrives to fail it over
+        self.futures = {}
+        self.ids = 0
+        self.closing = False
+        # NOTE session -> worker index, least recently used first
+        self.affinity = OrderedDict()
+        # NOTE Workers started and loaded, and the ones that could not
+        #      load the model again after a crash
+        self.ready = [False] * workers
+        self.failed = set()
+        # Statistics
+        self.pending = [0] * workers
+        self.served = [0] * workers
+        self.load_times = [None] * workers
+        self.crashes = 0
+        self.timeouts = 0
+        self.reader = None
+        self.gpt = None
+        if start_method == "fork":
+            import neo
+            # NOTE Loaded once, the forked workers share its pages
+            self.gpt = neo.GPTNeo(model=model, **options)
+        for index in range(workers):
+            requests, process = self.start_worker(index)
+            self.queues.append(requests)
+            self.processes.append(process)
+            if index == 0:
+                # NOTE The first worker downloads or converts the model if
+                #      needed, the others find it ready on disk
+                self.wait_ready([0])
+        self.wait_ready(range(1, workers))
+        self.reader = threading.Thread(target=self.read_results,
+                                       name="pool-results", daemon=True)
+        self.reader.start()
+
+    def start_worker(self, index):
+        requests = self.context.Queue()
+        process = self.context.Process(
+            target=serve,
+            args=(index, self.model, self.options, self.parameters,
+                  self.threads, self.cores[index], requests, self.results,
+                  self.gpt),
+            name="pool-" + self.model + "-" + str(index),
+            daemon=True)
+        process.start()
+        return requests, process
+
+    def wait_ready(self, indexes):
+        waiting = set(indexes)
+        while waiting:
+            try:
+                kind, index, value = self.results.get(timeout=CHECK_EVERY)
+            except queue.Empty:
+                for index in waiting:
+                    if not self.processes[index].is_alive():
+                        self.close()
+                        raise Exception("Pool worker " + str(index) +
+                                        " stopped while loading")
+                continue
+            if isinstance(value, str):
+                self.close()
+                raise Exception("Pool worker " + str(index) +
+                                " failed to load: " + value)
+            self.load_times[index] = value
+            self.ready[index] = True
+            waiting.discard(index)
+
+    # ANCHOR Dispatching
+    def worker_for(self, session=None):
+        # NOTE Must be called with the lock held
+        usable = [index for index in range(self.workers)
+                  if index not in self.failed]
+        if not usable:
+            raise Exception("Every pool worker of " + self.model + " failed")
+        if session is not None and session in self.affinity:
+            if self.affinity[session] in usable:
+                self.affinity.move_to_end(session)
+                return self.affinity[session]
+        # NOTE Workers still loading after a crash come last
+        index = min(usable, key=lambda index: (not self.ready[index],
+                                               self.pending[index]))
+        if session is not None:
+            self.affinity[session] = index
+            self.affinity.move_to_end(session)
+            while len(self.affinity) > MAX_SESSIONS * self.workers:
+                self.affinity.popitem(last=False)
+        return index
+
+    def dispatch(self, request_id, future, kind, data, session):
+        # NOTE Must be called with the lock held
+        index = self.worker_for(session)
+        self.futures[request_id] = (future, index, kind, data, session,
+                                    time.perf_counter() + self.timeout)
+        self.pending[index] += 1
+        self.queues[index].put((request_id, kind, data))
+
+    def submit(self, kind, data, session=None):
+        future = Future()
+        with self.lock:
+            if self.closing:
+                raise Exception("Pool closed")
+            self.ids += 1
+            self.dispatch(self.ids, future, kind, data, session)
+        return future
+
+    def chat(self, session, message, state=None):
+        return self.submit("chat", {"session": session, "message": message,
+                                    "state": state}, session=session)
+
+    def generate(self, prompt):
+        return self.submit("generate", {"prompt": prompt})
+
+    # ANCHOR Collecting the results
+    def read_results(self):
+        while True:
+            try:
+                result = self.results.get(timeout=CHECK_EVERY)
+            except queue.Empty:
+                self.check()
+                continue
+            if result is None:
+                return
+            request_id, succeeded, value = result
+            if request_id == "ready":
+                # NOTE A worker started again after a crash
+                self.restarted(succeeded, value)
+                continue
+            with self.lock:
+                entry = self.futures.pop(request_id, None)
+                if entry is None:
+                    # NOTE Timed out or failed over meanwhile
+                    continue
+                future, index = entry[:2]
+                self.pending[index] -= 1
+                self.served[index] += 1
+            if succeeded:
+                future.set_result(value)
+            else:
+                future.set_exception(Exception(value))
+            self.check()
+
+    # ANCHOR Crashed and stuck workers
+    # NOTE A request running for longer than timeout fails and its worker
+    #      is killed. A dead worker fails the request it was running (it
+    #      may be the cause), its queued requests go to the other workers
+    #      and it is started again in background.
+    def check(self):
+        now = time.perf_counter()
+        failures = []
+        killed = set()
+        with self.lock:
+            if self.closing:
+                return
+            for request_id, entry in list(self.futures.items()):
+                future, index = entry[:2]
+                if entry[5] > now:
+                    continue
+                del self.futures[request_id]
+                self.pending[index] -= 1
+                self.timeouts += 1
+                failures.append((future, "Pool request timed out after " +
+                                 str(self.timeout) + "s"))
+                if self.processes[index].is_alive():
+                    self.processes[index].terminate()
+                    self.processes[index].join(timeout=10)
+                    killed.add(index)
+            for index, process in enumerate(self.processes):
+                if index in self.failed or process.is_alive():
+                    continue
+                failures.extend(self.restart(index,
+                                             crashed=index not in killed))
+        for future, message in failures:
+            future.set_exception(Exception(message))
+
+    def restart(self, index, crashed=True):
+        # NOTE Must be called with the lock held
+        if crashed:
+            self.crashes += 1
+        self.ready[index] = False
+        print("[!] Pool worker " + str(index) + " of " + self.model +
+              " stopped, starting it again")
+        moved = sorted((request_id, entry) for request_id, entry
+                       in self.futures.items() if entry[1] == index)
+        failures = []
+        for request_id, entry in moved:
+            del self.futures[request_id]
+            self.pending[index] -= 1
+        if moved and crashed:
+            failures.append((moved.pop(0)[1][0], "Pool worker crashed"))
+        self.queues[index], self.processes[index] = self.start_worker(index)
+        for session in [session for session, worker in self.affinity.items()
+                        if worker == index]:
+            del self.affinity[session]
+        for request_id, (future, _, kind, data, session, _) in moved:
+            self.dispatch(request_id, future, kind, data, session)
+        return failures
+
+    def restarted(self, index, value):
+        failures = []
+        with self.lock:
+            if isinstance(value, str):
+                # NOTE The model cannot be loaded anymore, giving up on
+                #      this worker
+                self.failed.add(index)
+                moved = sorted((request_id, entry) for request_id, entry
+                               in self.futures.items() if entry[1] == index)
+                for request_id, (future, _, kind, data,
+                                 session, _) in moved:
+                    del self.futures[request_id]
+                    self.pending[index] -= 1
+                    try:
+                        self.dispatch(request_id, future, kind, data, session)
+                    except Exception as error:
+                        failures.append((future, str(error)))
+            else:
+                self.load_times[index] = value
+                self.ready[index] = True
+        for future, message in failures:
+            future.set_exception(Exception(message))
+
+    # ANCHOR Statistics
+    def stats(self):
+        with self.lock:
+            return {"model": self.model,
+                    "workers": self.workers,
+                    "threads": self.threads,
+                    "pending": list(self.pending),
+                    "served": list(self.served),
+                    "sessions": len(self.affinity),
+                    "load_times": list(self.load_times),
+                    "ready": list(self.ready),
+                    "failed": sorted(self.failed),
+                    "crashes": self.crashes,
+                    "timeouts": self.timeouts}
+
+    # ANCHOR Stopping the workers
+    def close(self):
+        with self.lock:
+            self.closing = True
+        for requests in self.queues:
+            requests.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self.results.put(None)
+        if self.reader is not None:
+            self.reader.join(timeout=10)
+        with self.lock:
+            for entry in self.futures.values():
+                entry[0].set_exception(Exception("Pool closed"))
+            self.futures.clear()
@@ -0,0 +1,234 @@
+import gc
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import catalogue
+
+# INSTRUCTIONS:
+# declare a registry once per process using
+# registry = registry.ModelRegistry([max_bytes=budget_in_bytes])
+# then ask for a model instead of building a new GPTNeo using
+# gpt = registry.get(model_type_as_in_neo[, option=value])
+# the first call loads the model, the following ones return the
+# very same instance until it is evicted to respect the memory budget.
+# Least recently used models are evicted first.
+# A model can also be asked together with its draft model for speculative
+# decoding (see catalogue.DRAFT_PAIRS) using
+# gpt = registry.get_speculative(model_type_as_in_neo[, option=value])
+# With an artifact manager (registry.artifacts = artifact_manager) every
+# load waits for the download of the model first (see artifacts.py).
+# Statistics can be read using
+# registry.stats()
+
+
+class ModelRegistry:
+
+    def __init__(self, max_bytes=8 * 1024 ** 3, factory=None,
+                 artifact_manager=None):
+        # NOTE Memory budget shared by all the resident models
+        self.max_bytes = max_bytes
+        # NOTE The factory can be overridden (i.e. for a stub model)
+        self.factory = factory or load_model
+        # NOTE Every load waits for the download of the model (drafts and
+        #      training included), see artifacts.py
+        self.artifacts = artifact_manager
+        # NOTE key -> [instance, size in bytes], oldest first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # NOTE One lock per key so different models can load together
+        self.loading = {}
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_times = {}
+        # NOTE Remembering the sizes of evicted models for estimate()
+        self.sizes = {}
+        # NOTE Pairs that cannot draft for each other, not tried again
+        self.bad_drafts = {}
+
+    # ANCHOR Key building
+    def key(self, model, **options):
+        # Options are the constructor settings (sorted to be stable)
+        return (model,) + tuple(sorted(options.items()))
+
+    # ANCHOR Residency check
+    def is_loaded(self, model, **options):
+        with self.lock:
+            return self.key(model, **options) in self.entries
+
+    # ANCHOR Getting (and loading if needed) a model
+    def get(self, model="neo-small", **options):
+        key = self.key(model, **options)
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+            key_lock = self.loading.setdefault(key, threading.Lock())
+        # NOTE Loading outside the main lock
+        with key_lock:
+            with self.lock:
+                # NOTE Someone else loaded it while we were waiting
+                if key in self.entries:
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    return self.entries[key][0]
+                self.misses += 1
+            if self.artifacts is not None:
+                self.artifacts.wait(model)
+            start = time.perf_counter()
+            instance = self.factory(model=model, **options)
+            elapsed = time.perf_counter() - start
+            size = model_size(instance)
+            with self.lock:
+                self.load_times.setdefault(model, []).append(elapsed)
+                self.entries[key] = [instance, size]
+                self.sizes[key] = size
+                self.loading.pop(key, None)
+                self.evict(keep=key)
+            return instance
+
+    # ANCHOR Getting a model drafted by the smaller one of its family
+    # NOTE The draft is a normal entry, evicting it only drops the registry
+    #      reference: the target keeps using it until it is evicted too
+    def get_speculative(self, model="neo-large", **options):
+        instance = self.get(model, **options)
+        pair = catalogue.DRAFT_PAIRS.get(model)
+        key = self.key(model, **options)
+        if (pair is None or getattr(instance, "draft", None) is not None or
+                key in self.bad_drafts):
+            return instance
+        draft = self.get(pair[0], **options)
+        try:
+            instance.set_draft(draft, tokens=pair[1])
+        except Exception as error:
+            print("[!] " + str(error))
+            self.bad_drafts[key] = str(error)
+        return instance
+
+    # ANCHOR Guessing how much memory a model needs before loading it
+    def estimate(self, model, **options):
+        key = self.key(model, **options)
+        with self.lock:
+            if key in self.entries:
+                return self.entries[key][1]
+            if key in self.sizes:
+                return self.sizes[key]
+        # NOTE Falling back to the size of the weights on disk
+        return weights_size("models/" + model)
+
+    # ANCHOR Checking if a model can be loaded next to the busy ones
+    def fits(self, model, busy=(), **options):
+        if self.is_loaded(model, **options):
+            return True
+        needed = self.estimate(model, **options)
+        needed += sum(self.estimate(other) for other in set(busy))
+        return needed <= self.max_bytes
+
+    # ANCHOR Dropping a model explicitly
+    def drop(self, model, **options):
+        with self.lock:
+            removed = self.entries.pop(self.key(model, **options), None)
+        if removed is not None:
+            gc.collect()
+        return removed is not None
+
+    # ANCHOR LRU eviction to respect the memory budget
+    # NOTE Must be called with the lock held
+    def evict(self, keep=None):
+        evicted = False
+        while self.used_bytes() > self.max_bytes:
+            victim = None
+            for key in self.entries:
+                if key != keep:
+                    victim = key
+                    break
+            if victim is None:
+                # NOTE The only model left is bigger than the budget
+                break
+            print("[*] Evicting model " + str(victim[0]))
+            del self.entries[victim]
+            self.evictions += 1
+            evicted = True
+        if evicted:
+            gc.collect()
+
+    def used_bytes(self):
+        return sum(entry[1] for entry in self.entries.values())
+
+    # ANCHOR Statistics
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / requests) if requests else 0.0,
+                "evictions": self.evictions,
+                "resident": [key[0] for key in self.entries],
+                "used_bytes": self.used_bytes(),
+                "max_bytes": self.max_bytes,
+                "bad_drafts": {key[0]: reason for key, reason
+                               in self.bad_drafts.items()},
+                "load_times": {model: {"count": len(times),
+                                       "last": times[-1],
+                                       "mean": sum(times) / len(times)}
+                               for model, times in self.load_times.items()}
+            }
+
+
+# ANCHOR Default factory
+# NOTE neo pulls in torch and transformers, imported with the first model
+def load_model(model, **options):
+    import neo
+    return neo.GPTNeo(model=model, **options)
+
+
+# ANCHOR Size of the weights on disk
+# NOTE Large models are sharded, the index lists the shards
+def weights_size(folder):
+    for weights in ("model.safetensors", "pytorch_model.bin"):
+        if os.path.exists(folder + "/" + weights):
+            return os.path.getsize(folder + "/" + weights)
+    for index in ("model.safetensors.index.json",
+                  "pytorch_model.bin.index.json"):
+        if not os.path.exists(folder + "/" + index):
+            continue
+        with open(folder + "/" + index) as index_stream:
+            shards = set(json.load(index_stream)["weight_map"].values())
+        return sum(os.path.getsize(folder + "/" + shard) for shard in shards
+                   if os.path.exists(folder + "/" + shard))
+    return 0
+
+
+# ANCHOR Memory footprint of a loaded model
+def model_size(instance):
+    try:
+        state = instance.gen.model.state_dict()
+    except AttributeError:
+        # NOTE Unknown kind of instance, does not count on the budget
+        return 0
+    # NOTE Walking the state dict also counts quantized packed weights,
+    #      which are not listed by parameters(). Tied weights are shared
+    #      so they are counted once.
+    seen = set()
+    return sum(tensor_bytes(value, seen) for value in state.values())
+
+
+def tensor_bytes(value, seen):
+    if isinstance(value, (tuple, list)):
+        return sum(tensor_bytes(item, seen) for item in value)
+    if not (hasattr(value, "numel") and hasattr(value, "element_size")):
+        return 0
+    try:
+        pointer = value.data_ptr()
+    except RuntimeError:
+        pointer = id(value)
+    if pointer in seen:
+        return 0
+    seen.add(pointer)
+    return value.numel() * value.element_size()
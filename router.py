@@ -0,0 +1,276 @@
+import json
+import os
+import threading
+import time
+
+import artifacts
+import catalogue
+import telemetry
+
+# INSTRUCTIONS:
+# declare a router once per process using
+# model_router = router.Router([slo=5.0][, path="data/router.json"])
+# then, before every reply, let it choose the model using
+# model = model_router.choose(resident=..., pending=...[, default=model])
+# where resident are the models already in memory and pending the replies
+# queued before this one. The largest model whose predicted reply time
+# (load if not resident + first token + expected reply length at its
+# decoding speed, times the queue) fits in slo seconds is chosen. Under
+# pressure (long queue, cold models) smaller models are chosen instead, and
+# when no model fits the fastest one is used.
+# After the reply, feed the measures back using
+# model_router.observe(model, stats, latency[, load_time][, routed=True])
+# where stats are the generation statistics (see neo.GPTNeo.stream) and
+# latency the time the user waited. Replies of models chosen by hand
+# (routed=False) improve the profiles but do not count for the SLO hit
+# rate. The profiles are kept in
+# data/router.json and can be seeded from a benchmark run using
+# python router.py import bench/models.json
+# Every decision is appended to data/router.jsonl. Decisions, SLO hit rate
+# and resident hit rate can be read using
+# model_router.stats()
+# or from the command line using
+# python router.py show
+
+# NOTE RAG answers questions, it is not a chat model
+NOT_ROUTED = ("rag",)
+
+# NOTE Weight of a new measure in the moving averages of the profiles
+SMOOTHING = 0.3
+# NOTE Reply length assumed before any reply of a model was measured
+REPLY_TOKENS = 40
+
+
+# NOTE Models not downloaded yet are not routed to, the download could
+#      take longer than any SLO (see artifacts.py)
+def downloaded(model):
+    return artifacts.is_ready(model)
+
+
+def complete(profile):
+    return bool(profile.get("ttft") and profile.get("tokens_per_sec"))
+
+
+def average(previous, value):
+    if previous is None:
+        return value
+    return previous + SMOOTHING * (value - previous)
+
+
+class Router:
+
+    def __init__(self, slo=5.0, path="data/router.json",
+                 log_path="data/router.jsonl", models=None):
+        self.slo = slo
+        self.path = path
+        self.log_path = log_path
+        self.models = [model for model in (models or catalogue.CATALOGUE)
+                       if model not in NOT_ROUTED]
+        self.lock = threading.Lock()
+        # NOTE model -> {"load", "ttft", "tokens_per_sec", "reply_tokens",
+        #      "replies"}, averaged over the last replies
+        self.profiles = {}
+        # Statistics
+        self.decisions = {}
+        self.fallbacks = 0
+        self.routed = 0
+        self.resident_hits = 0
+        self.observed = 0
+        self.slo_hits = 0
+        if os.path.exists(self.path):
+            with open(self.path) as profiles_stream:
+                self.profiles = json.load(profiles_stream)
+
+    # ANCHOR Profiles
+    def profile(self, model):
+        # NOTE Unmeasured models are scaled from the closest measured one
+        #      by their number of parameters
+        if model in self.profiles and complete(self.profiles[model]):
+            return self.profiles[model]
+        measured = [other for other in self.profiles
+                    if other in catalogue.CATALOGUE and
+                    complete(self.profiles[other])]
+        if not measured:
+            return None
+        closest = min(measured, key=lambda other: abs(
+            catalogue.parameters(other) - catalogue.parameters(model)))
+        ratio = catalogue.parameters(model) / catalogue.parameters(closest)
+        known = self.profiles[closest]
+        return {"load": known["load"] * ratio if known.get("load") else None,
+                "ttft": known["ttft"] * ratio,
+                "tokens_per_sec": known["tokens_per_sec"] / ratio,
+                "reply_tokens": known.get("reply_tokens") or REPLY_TOKENS,
+                "estimated": closest}
+
+    def predict(self, model, resident=(), pending=0):
+        profile = self.profile(model)
+        if profile is None:
+            return None
+        reply = (profile["ttft"] + (profile.get("reply_tokens") or
+                                    REPLY_TOKENS) / profile["tokens_per_sec"])
+        # NOTE The replies are served one after the other
+        latency = reply * (1 + pending)
+        if model not in resident:
+            if profile.get("load") is None:
+                return None
+            latency += profile["load"]
+        return latency
+
+    # ANCHOR Choosing a model
+    def choose(self, resident=(), pending=0, default=None):
+        predictions = {}
+        for model in self.models:
+            if model not in resident and not downloaded(model):
+                continue
+            predicted = self.predict(model, resident, pending)
+            if predicted is not None:
+                predictions[model] = predicted
+        fitting = [model for model, predicted in predictions.items()
+                   if predicted <= self.slo]
+        if fitting:
+            chosen = max(fitting, key=catalogue.parameters)
+            reason = "slo"
+        elif predictions:
+            # NOTE Nothing fits, the fastest one misses the SLO the least
+            chosen = min(predictions, key=predictions.get)
+            reason = "fastest"
+        else:
+            # NOTE Nothing measured yet, the reply will make a profile
+            chosen = default or next((model for model in self.models
+                                      if model in resident or
+                                      downloaded(model)), self.models[0])
+            reason = "default"
+        with self.lock:
+            self.routed += 1
+            self.decisions[chosen] = self.decisions.get(chosen, 0) + 1
+            if reason != "slo":
+                self.fallbacks += 1
+            if chosen in resident:
+                self.resident_hits += 1
+        telemetry.count("router." + reason)
+        self.log({"type": "decision", "model": chosen, "reason": reason,
+                  "predicted": predictions.get(chosen), "slo": self.slo,
+                  "pending": pending, "resident": sorted(resident)})
+        print("[*] Routing to %s (%s, predicted %s, SLO %.1fs)" %
+              (chosen, reason, "%.2fs" % predictions[chosen]
+               if chosen in predictions else "unknown", self.slo))
+        return chosen
+
+    # ANCHOR Learning from the replies
+    def observe(self, model, stats, latency, load_time=None, routed=True):
+        # NOTE Replies from the response cache say nothing about the model
+        generated = "new_tokens" in stats
+        new_tokens = stats.get("new_tokens") or 0
+        decode = stats["total"] - stats["ttft"]
+        with self.lock:
+            profile = self.profiles.setdefault(model, {"replies": 0})
+            if generated:
+                profile["ttft"] = average(profile.get("ttft"), stats["ttft"])
+            if new_tokens > 1 and decode > 0:
+                profile["tokens_per_sec"] = average(
+                    profile.get("tokens_per_sec"), (new_tokens - 1) / decode)
+            if new_tokens:
+                profile["reply_tokens"] = average(profile.get("reply_tokens"),
+                                                  new_tokens)
+            if load_time is not None:
+                profile["load"] = average(profile.get("load"), load_time)
+            profile["replies"] += 1
+            self.save()
+            if not routed:
+                return
+            self.observed += 1
+            met = latency <= self.slo
+            if met:
+                self.slo_hits += 1
+        telemetry.count("router.slo_met" if met else "router.slo_missed")
+        self.log({"type": "reply", "model": model, "latency": latency,
+                  "slo_met": met, "load_time": load_time})
+
+    # ANCHOR Files
+    def save(self):
+        # NOTE Must be called with the lock held
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as profiles_stream:
+            json.dump(self.profiles, profiles_stream, indent=2)
+        os.replace(temporary, self.path)
+
+    def log(self, record):
+        record["time"] = time.time()
+        folder = os.path.dirname(self.log_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with self.lock:
+            with open(self.log_path, "a") as log_stream:
+                log_stream.write(json.dumps(record) + "\n")
+
+    def import_benchmark(self, path, prompt_tokens=128):
+        # NOTE Rows of benchmark.py models, the prompt length closest to
+        #      prompt_tokens is used for every model
+        with open(path) as bench_stream:
+            rows = json.load(bench_stream)
+        best = {}
+        for row in rows:
+            model = row.get("model")
+            if model not in catalogue.CATALOGUE or "ttft" not in row:
+                continue
+            distance = abs(row["prompt_tokens"] - prompt_tokens)
+            if model not in best or distance < best[model][0]:
+                best[model] = (distance, row)
+        with self.lock:
+            for model, (_, row) in best.items():
+                profile = self.profiles.setdefault(model, {"replies": 0})
+                profile.update({"load": row["warm_load"],
+                                "ttft": row["ttft"],
+                                "tokens_per_sec": row["decode_tokens_per_sec"],
+                                "reply_tokens": profile.get("reply_tokens") or
+                                row["new_tokens"]})
+            self.save()
+        return sorted(best)
+
+    # ANCHOR Statistics
+    def stats(self):
+        with self.lock:
+            return {"slo": self.slo,
+                    "routed": self.routed,
+                    "decisions": dict(self.decisions),
+                    "fallbacks": self.fallbacks,
+                    "resident_hit_rate": (self.resident_hits / self.routed
+                                          if self.routed else 0.0),
+                    "slo_hit_rate": (self.slo_hits / self.observed
+                                     if self.observed else 0.0),
+                    "profiles": {model: dict(profile) for model, profile
+                                 in self.profiles.items()}}
+
+
+# ANCHOR Command line
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="HappyChatter model router")
+    parser.add_argument("--slo", type=float, default=5.0)
+    commands = parser.add_subparsers(dest="command", required=True)
+    importer = commands.add_parser("import",
+                                   help="seed the profiles from benchmark.py")
+    importer.add_argument("results", help="JSON written by benchmark models")
+    commands.add_parser("show", help="profiles and predicted reply times")
+    args = parser.parse_args()
+    if args.command == "import":
+        args.results = os.path.abspath(args.results)
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    model_router = Router(slo=args.slo)
+    if args.command == "import":
+        print("[+] Profiles imported for " +
+              ", ".join(model_router.import_benchmark(args.results)))
+    for model in model_router.models:
+        profile = model_router.profile(model)
+        if profile is None:
+            print("%-15s not measured" % model)
+            continue
+        cold = model_router.predict(model)
+        warm = model_router.predict(model, resident=(model,))
+        print("%-15s %s reply %.2fs resident, %s cold%s" %
+              (model, "estimated" if "estimated" in profile else "measured ",
+               warm, "%.2fs" % cold if cold is not None else "unknown",
+               "" if downloaded(model) else " (not downloaded)"))
@@ -0,0 +1,791 @@
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from urllib.parse import urlsplit
+
+import artifacts
+import batching
+import cache
+import catalogue
+import chatlog
+import context
+import memory
+import registry
+import router
+import sessions
+import telemetry
+
+# INSTRUCTIONS:
+# start the headless server using
+# python server.py [--host 127.0.0.1] [--port 8080] [--precision fp32]
+#                  [--response-cache] [--speculative] [--stub]
+#                  [--workers N [--threads N] [--fork]]
+#                  [--memory hidden|hash|sentence] [--slo seconds]
+#                  [--mirror folder] [--disk-budget gigabytes]
+#                  [--batch-window milliseconds] [--batch-size N]
+# --stub replaces the models with a tiny echo model, useful to try the
+# server without downloading anything.
+# /generate requests that are not streamed are generated together when they
+# arrive within --batch-window milliseconds (see batching.py), up to
+# --batch-size prompts per forward pass.
+# --workers serves every model from N processes pinned to their own cores
+# (see pool.py): replies are not streamed token by token in this mode and
+# training is not available.
+# --memory adds the past turns closest to every message to the prompt (see
+# memory.py), embedded by the model itself, by hashing the words or by a
+# small sentence model. It is not available with --workers.
+# --slo enables the "auto" model of /chat (the default model too): every
+# turn is answered by the largest model replying within the given seconds,
+# given the queue and the models in memory (see router.py).
+# The models are downloaded by the artifact manager (see artifacts.py), from
+# the hub or from the models folder of another machine given by --mirror,
+# and the least recently used ones are deleted to stay in --disk-budget.
+# Endpoints (JSON in, JSON out):
+#   GET  /models     the supported, the loaded and the downloaded models
+#   GET  /stats      registry and server statistics
+#   GET  /metrics    timings, counters and memory (see telemetry.py)
+#   GET  /sessions   the saved conversations, newest first
+#   POST /chat       {"message": text[, "session": id, "model": name or
+#                     "auto", "stream": bool]}
+#   POST /generate   {"prompt": text[, "model": name, "stream": bool]}
+#   POST /train      {"files": [file or folder, ...][, "model": name,
+#                     "epochs": number]} ("file": path is accepted too)
+# Streaming responses are chunked, one JSON object per line: {"text": piece}
+# for every piece and a last line with "done": true and the full reply.
+# The session id returned by /chat keeps the conversation going, even
+# after a restart of the server.
+
+
+# ANCHOR Stub model, same interface as neo.GPTNeo with no weights at all
+class StubTokenizer:
+
+    name_or_path = "stub"
+    eos_token_id = 0
+
+    def encode(self, text):
+        return list(text.encode("utf-8"))
+
+
+class StubGen:
+
+    def __init__(self):
+        self.tokenizer = StubTokenizer()
+
+
+class StubModel:
+
+    def __init__(self, model="stub", delay=0.01):
+        # NOTE Same tokenizer for every stub model
+        self.model = "stub"
+        self.model_folder = model
+        self.gen = StubGen()
+        self.delay = delay
+        self.checkpoint = None
+        self.last_stats = None
+
+    def context_budget(self):
+        return 1024
+
+    def reply(self, initial):
+        # NOTE Echoing the last line of the prompt
+        lines = [line for line in initial.strip().split("\n") if line.strip()]
+        last = lines[-1].strip() if lines else ""
+        if ": " in last:
+            last = last.split(": ", 1)[1]
+        return " You said: " + last
+
+    def generate(self, initial):
+        text = self.reply(initial)
+        self.last_stats = {"ttft": 0.0, "total": 0.0, "streamed": False}
+        return text, {"text": text}
+
+    def stream(self, initial, should_stop=None, ids=None):
+        start = time.perf_counter()
+        first = None
+        for word in self.reply(initial).split():
+            if should_stop is not None and should_stop():
+                break
+            time.sleep(self.delay)
+            if first is None:
+                first = time.perf_counter() - start
+            yield " " + word
+        total = time.perf_counter() - start
+        self.last_stats = {"ttft": first or total, "total": total,
+                           "streamed": True}
+
+    def generate_stream(self, initial, callback=None, should_stop=None, ids=None):
+        text = ""
+        for piece in self.stream(initial, should_stop=should_stop, ids=ids):
+            text += piece
+            if callback is not None:
+                callback(piece)
+        return text, self.last_stats
+
+    def generation_settings(self):
+        return None
+
+    def cache_key(self, prompt, settings):
+        return None
+
+    def generate_batch(self, prompts, settings=None, return_stats=False):
+        time.sleep(self.delay)
+        replies = [self.reply(prompt) for prompt in prompts]
+        stats = [{"batch_size": len(prompts), "groups": 1,
+                  "batch_new_tokens": 0, "new_tokens": 0,
+                  "total": self.delay, "tokens_per_sec": 0.0,
+                  "streamed": False} for _ in prompts]
+        self.last_batch_stats = dict(stats[0])
+        if return_stats:
+            return replies, stats
+        return replies
+
+    def train(self, file, **kwargs):
+        return os.path.exists(file)
+
+    def train_files(self, paths, epochs=1):
+        return all(os.path.exists(path) for path in paths)
+
+
+# ANCHOR A conversation served over HTTP
+class Session:
+
+    def __init__(self, session_id, model, chat_log=None, session_store=None,
+                 conversation=None):
+        self.id = session_id
+        # NOTE Routed sessions get the model of every turn from the router
+        self.routed = model == "auto"
+        self.model = model
+        self.chat_log = chat_log
+        self.session_store = session_store
+        # NOTE Turns of the same session are served in order
+        self.lock = asyncio.Lock()
+        if conversation is not None:
+            # NOTE Reopened from the session store
+            self.context = conversation
+            return
+        self.context = context.ConversationContext(preamble=context.IMPRINTING)
+        if self.chat_log is not None:
+            self.chat_log.start(session_id, model, context.IMPRINTING)
+
+    def save(self, human, bot, settings=None, stats=None):
+        if self.chat_log is not None:
+            self.chat_log.turn(self.id, self.model, human, bot,
+                               settings=settings, stats=stats)
+        if self.session_store is not None:
+            self.session_store.save(self.id, self.context, self.model,
+                                    settings=settings)
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found",
+           405: "Method Not Allowed", 500: "Internal Server Error",
+           503: "Service Unavailable"}
+
+
+class ChatServer:
+
+    def __init__(self, model_registry, default_model="neo-small",
+                 max_concurrency=2, max_queue=16, models=catalogue.MODELS,
+                 options=None, response_cache=None, chat_log=None,
+                 session_store=None, speculative=False, pool_options=None,
+                 memory=None, model_router=None, artifact_manager=None,
+                 batch_window_ms=5, max_batch=8):
+        self.registry = model_registry
+        # NOTE With pool options every model is served by worker processes
+        #      (see pool.py) instead of the registry
+        self.pool_options = pool_options
+        self.pools = {}
+        self.pools_lock = threading.Lock()
+        # NOTE /generate requests of a model generated together (see
+        #      batching.py), one batcher per resident model
+        self.batchers = {}
+        self.batch_window_ms = batch_window_ms
+        self.max_batch = max_batch
+        # NOTE Large models drafted by the small ones (see catalogue.DRAFT_PAIRS)
+        self.speculative = speculative
+        # NOTE Encoder of the long-term memory, one index per model
+        self.memory = memory
+        self.memory_indexes = {}
+        # NOTE Chooses the model of the "auto" sessions (see router.py)
+        self.router = model_router
+        # NOTE Downloads the models in background (see artifacts.py)
+        self.artifacts = artifact_manager
+        self.response_cache = response_cache
+        self.chat_log = chat_log
+        self.session_store = session_store
+        # NOTE Constructor options of the models (i.e. precision)
+        self.options = options or {}
+        self.default_model = default_model
+        self.models = models
+        self.max_queue = max_queue
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.sessions = {}
+        # Statistics
+        self.waiting = 0
+        self.served = 0
+        self.rejected = 0
+
+    # ANCHOR Concurrency limit and request queue
+    async def run_model(self, function):
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise HTTPError(503, "Too many requests queued")
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            loop = asyncio.get_running_loop()
+            with telemetry.timer("server.model_call"):
+                return await loop.run_in_executor(None, function)
+        finally:
+            self.semaphore.release()
+            self.served += 1
+
+    # NOTE Batched requests share the forward passes of the batcher thread
+    #      instead of taking a slot of the concurrency limit each
+    async def run_batched(self, model, prompt):
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise HTTPError(503, "Too many requests queued")
+        self.waiting += 1
+        try:
+            loop = asyncio.get_running_loop()
+            with telemetry.timer("server.batched_call"):
+                future = await loop.run_in_executor(
+                    None, self.submit_batched, model, prompt)
+                text, stats = await asyncio.wrap_future(future)
+        finally:
+            self.waiting -= 1
+            self.served += 1
+        return text, stats
+
+    def model_for(self, body, auto=False):
+        model = body.get("model") or self.default_model
+        if model == "auto":
+            if not auto or self.router is None:
+                raise HTTPError(400, "The auto model needs --slo and /chat")
+            return model
+        if model not in self.models:
+            raise HTTPError(400, "Invalid model: " + str(model))
+        return model
+
+    # ANCHOR Getting a model from the registry (runs in a thread)
+    def load(self, model):
+        if self.artifacts is not None:
+            self.artifacts.wait(model)
+        if self.speculative:
+            gpt = self.registry.get_speculative(model, **self.options)
+        else:
+            gpt = self.registry.get(model, **self.options)
+        if self.response_cache is not None:
+            gpt.response_cache = self.response_cache
+        return gpt
+
+    # ANCHOR Getting the worker processes of a model (runs in a thread)
+    def pool_for(self, model):
+        import pool
+        if self.artifacts is not None:
+            self.artifacts.wait(model)
+        with self.pools_lock:
+            if model not in self.pools:
+                self.pools[model] = pool.ModelPool(model, **self.pool_options,
+                                                   **self.options)
+            return self.pools[model]
+
+    # ANCHOR Queueing a prompt in the micro-batcher of a model (runs in a
+    #        thread)
+    def submit_batched(self, model, prompt):
+        start = time.perf_counter()
+        gpt = self.load(model)
+        # NOTE Deterministic replies already known skip the batch
+        key = gpt.cache_key(prompt, gpt.generation_settings())
+        cached = (gpt.response_cache.get(key) if key is not None
+                  else None)
+        if cached is not None:
+            total = time.perf_counter() - start
+            telemetry.count("neo.cached_replies")
+            future = Future()
+            future.set_result((cached, {"ttft": total, "total": total,
+                                        "streamed": False, "cached": True}))
+            return future
+        resident = self.registry.stats()["resident"]
+        stale = []
+        with self.pools_lock:
+            batcher = self.batchers.get(model)
+            if batcher is not None and batcher.gpt is not gpt:
+                # NOTE The model was evicted and loaded again
+                stale.append(self.batchers.pop(model))
+                batcher = None
+            if batcher is None:
+                batcher = batching.MicroBatcher(gpt,
+                                                window_ms=self.batch_window_ms,
+                                                max_batch=self.max_batch)
+                self.batchers[model] = batcher
+            # NOTE Batchers of evicted models would keep them in memory
+            for other in list(self.batchers):
+                if other != model and other not in resident:
+                    stale.append(self.batchers.pop(other))
+            # NOTE Submitted with the lock held, no other request can close
+            #      the batcher in between (queued prompts are still served)
+            future = batcher.submit(prompt)
+        # NOTE Closing waits for the prompts already queued, not holding
+        #      the lock meanwhile
+        for old in stale:
+            old.close()
+        return future
+
+    # ANCHOR Long-term memory index of a model (runs in a thread)
+    def memory_index(self, model, gpt):
+        with self.pools_lock:
+            memory_index = self.memory_indexes.get(model)
+            # NOTE Trained or converted since, the hidden states changed
+            if (memory_index is not None and self.memory == "hidden" and
+                    not memory_index.encoder.current(gpt)):
+                memory_index = None
+            if memory_index is None:
+                if self.memory == "hidden":
+                    encoder = memory.HiddenStateEncoder(self.registry, model,
+                                                        gpt.weights_name(),
+                                                        self.options)
+                elif self.memory == "sentence":
+                    encoder = memory.SentenceEncoder()
+                else:
+                    encoder = memory.HashEncoder()
+                memory_index = memory.MemoryIndex(encoder)
+                self.memory_indexes[model] = memory_index
+            return memory_index
+
+    # ANCHOR Conversation turn (runs in a thread)
+    def chat_turn(self, session, message, callback=None, should_stop=None):
+        start = time.perf_counter()
+        if session.routed:
+            resident = (list(self.pools) if self.pool_options is not None
+                        else self.registry.stats()["resident"])
+            session.model = self.router.choose(resident=resident,
+                                               pending=self.waiting,
+                                               default=None if
+                                               self.default_model == "auto"
+                                               else self.default_model)
+        if self.pool_options is not None:
+            return self.pool_chat_turn(session, message, callback)
+        load_time = None
+        if not self.registry.is_loaded(session.model, **self.options):
+            load_time = time.perf_counter()
+        gpt = self.load(session.model)
+        if load_time is not None:
+            load_time = time.perf_counter() - load_time
+        human = session.context.add("Human", message)
+        try:
+            session.context.set_tokenizer(gpt.gen.tokenizer,
+                                          max_tokens=gpt.context_budget(),
+                                          name=gpt.model)
+            if self.memory is not None:
+                with telemetry.timer("server.recall"):
+                    memory.recall(self.memory_index(session.model, gpt),
+                                  session.context, message)
+            prompt, prompt_ids = session.context.build()
+            text, stats = gpt.generate_stream(prompt, callback=callback,
+                                              should_stop=should_stop,
+                                              ids=prompt_ids)
+        except Exception:
+            # NOTE A failed turn leaves no unanswered message
+            session.context.remove(human)
+            raise
+        reply = text.strip()
+        session.context.add("Bot", reply)
+        session.save(message, reply, settings=getattr(gpt, "settings", None),
+                     stats=stats)
+        if self.router is not None:
+            self.router.observe(session.model, stats,
+                                time.perf_counter() - start,
+                                load_time=load_time, routed=session.routed)
+        return reply, stats
+
+    # NOTE The worker owns the conversation, the state comes back with the
+    #      reply. The reply is sent to the callback in one piece.
+    def pool_chat_turn(self, session, message, callback=None):
+        model_pool = self.pool_for(session.model)
+        result = model_pool.chat(session.id, message,
+                                 state=session.context.to_dict()).result()
+        session.context = context.ConversationContext.from_dict(result["state"])
+        if callback is not None:
+            callback(result["reply"])
+        session.save(message, result["reply"], settings=result["settings"],
+                     stats=result["stats"])
+        return result["reply"], result["stats"]
+
+    def generate_text(self, model, prompt, callback=None, should_stop=None):
+        if self.pool_options is not None:
+            result = self.pool_for(model).generate(prompt).result()
+            if callback is not None:
+                callback(result["text"])
+            return result["text"], result["stats"]
+        gpt = self.load(model)
+        text, stats = gpt.generate_stream(prompt, callback=callback,
+                                          should_stop=should_stop)
+        return text, stats
+
+    # ANCHOR Endpoints
+    async def route(self, method, path, body, writer):
+        if path == "/models":
+            return {"models": list(self.models),
+                    "loaded": self.registry.stats()["resident"],
+                    "artifacts": ({model: self.artifacts.state(model)
+                                   for model in self.models}
+                                  if self.artifacts is not None else None)}
+        if path == "/metrics":
+            return telemetry.snapshot()
+        if path == "/sessions":
+            if self.session_store is None:
+                return {"sessions": [{"id": session_id, "model": session.model}
+                                     for session_id, session
+                                     in self.sessions.items()]}
+            return {"sessions": self.session_store.list()}
+        if path == "/stats":
+            cache_stats = None
+            if self.response_cache is not None:
+                cache_stats = self.response_cache.stats()
+            return {"registry": self.registry.stats(),
+                    "response_cache": cache_stats,
+                    "sessions": len(self.sessions),
+                    "waiting": self.waiting,
+                    "served": self.served,
+                    "rejected": self.rejected,
+                    "pools": [model_pool.stats() for model_pool
+                              in list(self.pools.values())],
+                    "batchers": {model: batcher.stats() for model, batcher
+                                 in list(self.batchers.items())},
+                    "memory": [memory_index.stats() for memory_index
+                               in list(self.memory_indexes.values())],
+                    "router": (self.router.stats()
+                               if self.router is not None else None),
+                    "artifacts": (self.artifacts.stats()
+                                  if self.artifacts is not None else None)}
+        if method != "POST":
+            if path in ("/chat", "/generate", "/train"):
+                raise HTTPError(405, "Use POST")
+            raise HTTPError(404, "Not found")
+        if path == "/chat":
+            return await self.chat(body, writer)
+        if path == "/generate":
+            return await self.generate(body, writer)
+        if path == "/train":
+            if self.pool_options is not None:
+                raise HTTPError(400, "Training is not available with --workers")
+            model = self.model_for(body)
+            paths = body.get("files") or ([body["file"]] if body.get("file") else [])
+            if not isinstance(paths, list) or not paths:
+                raise HTTPError(400, "Missing file")
+            epochs = int(body.get("epochs", 1))
+            trained = await self.run_model(
+                lambda: self.load(model).train_files(paths, epochs=epochs))
+            return {"model": model, "trained": bool(trained)}
+        raise HTTPError(404, "Not found")
+
+    async def chat(self, body, writer):
+        message = body.get("message")
+        if not isinstance(message, str) or not message:
+            raise HTTPError(400, "Missing message")
+        session_id = body.get("session")
+        if session_id is None:
+            session_id = str(uuid.uuid4())
+            self.sessions[session_id] = Session(session_id,
+                                                self.model_for(body, auto=True),
+                                                self.chat_log,
+                                                self.session_store)
+        elif session_id not in self.sessions:
+            if (self.session_store is None or
+                    not self.session_store.exists(session_id)):
+                raise HTTPError(404, "Unknown session")
+            # NOTE Reopening a saved conversation, token ids included
+            conversation, meta = self.session_store.load(session_id)
+            self.sessions[session_id] = Session(session_id, meta["model"],
+                                                self.chat_log,
+                                                self.session_store,
+                                                conversation)
+        session = self.sessions[session_id]
+        if body.get("model"):
+            session.model = self.model_for(body, auto=True)
+            session.routed = session.model == "auto"
+        async with session.lock:
+            if body.get("stream"):
+                await self.stream(writer, {"session": session_id},
+                                  lambda callback, should_stop:
+                                  self.chat_turn(session, message,
+                                                 callback, should_stop))
+                return None
+            reply, stats = await self.run_model(
+                lambda: self.chat_turn(session, message))
+        return {"session": session_id, "reply": reply, "stats": stats}
+
+    async def generate(self, body, writer):
+        prompt = body.get("prompt")
+        if not isinstance(prompt, str) or not prompt:
+            raise HTTPError(400, "Missing prompt")
+        model = self.model_for(body)
+        if body.get("stream"):
+            await self.stream(writer, {"model": model},
+                              lambda callback, should_stop:
+                              self.generate_text(model, prompt,
+                                                 callback, should_stop))
+            return None
+        if self.pool_options is None:
+            text, stats = await self.run_batched(model, prompt)
+        else:
+            text, stats = await self.run_model(
+                lambda: self.generate_text(model, prompt))
+        return {"model": model, "text": text, "stats": stats}
+
+    # ANCHOR Streaming responses (chunked, one JSON per line)
+    async def stream(self, writer, extra, function):
+        loop = asyncio.get_running_loop()
+        pieces = asyncio.Queue()
+        stop = threading.Event()
+
+        def callback(piece):
+            loop.call_soon_threadsafe(pieces.put_nowait, piece)
+
+        def run():
+            try:
+                return function(callback, stop.is_set)
+            finally:
+                loop.call_soon_threadsafe(pieces.put_nowait, None)
+
+        task = asyncio.ensure_future(self.run_model(run))
+        # NOTE Only answering once the request is accepted in the queue
+        await asyncio.sleep(0)
+        if task.done() and task.exception():
+            raise task.exception()
+        writer.write(b"HTTP/1.1 200 OK\r\n"
+                     b"Content-Type: application/x-ndjson\r\n"
+                     b"Transfer-Encoding: chunked\r\n"
+                     b"Connection: close\r\n\r\n")
+        try:
+            while True:
+                piece = await pieces.get()
+                if piece is None:
+                    break
+                await write_chunk(writer, dict(extra, text=piece))
+            reply, stats = await task
+            await write_chunk(writer, dict(extra, done=True,
+                                           reply=reply, stats=stats))
+        except (ConnectionError, asyncio.CancelledError):
+            # NOTE The client went away, stopping the generation and
+            #      waiting for it to notice, the caller still holds the
+            #      session lock the turn is writing under
+            stop.set()
+            await asyncio.wait([task])
+            if not task.cancelled():
+                task.exception()
+            raise
+        except Exception as error:
+            await write_chunk(writer, dict(extra, done=True, error=str(error)))
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    # ANCHOR Connection handling
+    async def handle(self, reader, writer):
+        try:
+            method, path, body = await read_request(reader)
+            result = await self.route(method, path, body, writer)
+            if result is not None:
+                await write_json(writer, 200, result)
+        except HTTPError as error:
+            await write_json(writer, error.status, {"error": str(error)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as error:
+            await write_json(writer, 500, {"error": str(error)})
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8080):
+        server = await asyncio.start_server(self.handle, host, port)
+        print("[+] Serving on http://" + host + ":" + str(port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        with self.pools_lock:
+            for model_pool in self.pools.values():
+                model_pool.close()
+            self.pools.clear()
+            for batcher in self.batchers.values():
+                batcher.close()
+            self.batchers.clear()
+
+
+# ANCHOR Minimal HTTP/1.1 helpers
+async def read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        raise ConnectionError("Empty request")
+    try:
+        method, target, _ = request_line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise HTTPError(400, "Malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = {}
+    length = int(headers.get("content-length", "0") or 0)
+    if length:
+        raw = await reader.readexactly(length)
+        try:
+            body = json.loads(raw.decode("utf-8"))
+        except ValueError:
+            raise HTTPError(400, "Body is not valid JSON")
+        if not isinstance(body, dict):
+            raise HTTPError(400, "Body must be a JSON object")
+    return method.upper(), urlsplit(target).path, body
+
+
+async def write_json(writer, status, payload):
+    data = json.dumps(payload).encode("utf-8")
+    writer.write(("HTTP/1.1 " + str(status) + " " + REASONS.get(status, "") +
+                  "\r\nContent-Type: application/json\r\n"
+                  "Content-Length: " + str(len(data)) + "\r\n"
+                  "Connection: close\r\n\r\n").encode("latin-1") + data)
+    await writer.drain()
+
+
+async def write_chunk(writer, payload):
+    data = (json.dumps(payload) + "\n").encode("utf-8")
+    writer.write(format(len(data), "x").encode("latin-1") + b"\r\n" +
+                 data + b"\r\n")
+    await writer.drain()
+
+
+# ANCHOR Entry point
+def main():
+    parser = argparse.ArgumentParser(description="HappyChatter headless server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--model", default="neo-small")
+    parser.add_argument("--concurrency", type=int, default=2)
+    parser.add_argument("--queue", type=int, default=16)
+    parser.add_argument("--precision", default="fp32", choices=catalogue.PRECISIONS)
+    parser.add_argument("--response-cache", action="store_true",
+                        help="cache the replies of deterministic settings")
+    parser.add_argument("--speculative", action="store_true",
+                        help="draft the large models with the small ones")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes per model (see pool.py)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="torch threads per worker process")
+    parser.add_argument("--fork", action="store_true",
+                        help="fork the workers sharing the weights "
+                             "copy-on-write (Linux)")
+    parser.add_argument("--memory", default=None,
+                        choices=("hidden", "hash", "sentence"),
+                        help="recall the closest past turns (see memory.py)")
+    parser.add_argument("--slo", type=float, default=None,
+                        help="seconds per reply of the auto model "
+                             "(see router.py)")
+    parser.add_argument("--mirror", default=None,
+                        help="download the models from this models folder "
+                             "instead of the hub (see artifacts.py)")
+    parser.add_argument("--disk-budget", type=float, default=64,
+                        help="gigabytes of downloaded models kept on disk")
+    parser.add_argument("--batch-window", type=float, default=5,
+                        help="milliseconds /generate waits to batch "
+                             "requests together")
+    parser.add_argument("--batch-size", type=int, default=8,
+                        help="most /generate prompts per batch")
+    parser.add_argument("--stub", action="store_true",
+                        help="use a tiny echo model instead of real ones")
+    args = parser.parse_args()
+    if args.stub and args.workers > 1:
+        parser.error("--workers needs real models, not --stub")
+    if args.memory is not None and args.workers > 1:
+        parser.error("--memory is not available with --workers")
+    if args.model == "auto" and args.slo is None:
+        parser.error("--model auto needs --slo")
+    if args.stub and args.slo is not None:
+        parser.error("--slo needs real models, not --stub")
+    if args.stub and args.memory == "hidden":
+        parser.error("--memory hidden needs real models, use hash")
+    pool_options = None
+    if args.workers > 1:
+        pool_options = {"workers": args.workers,
+                        "threads": args.threads,
+                        "start_method": "fork" if args.fork else "spawn"}
+        # NOTE Every worker can serve a request at the same time
+        args.concurrency = max(args.concurrency, args.workers)
+    if args.mirror:
+        args.mirror = os.path.abspath(args.mirror)
+    # NOTE Same working directory layout as the GUI
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    factory = StubModel if args.stub else None
+    model_registry = registry.ModelRegistry(factory=factory)
+    options = {} if args.stub else {"precision": args.precision}
+    response_cache = cache.ResponseCache() if args.response_cache else None
+    # NOTE Every session is logged in the same rotated files
+    chat_log = chatlog.ChatLog()
+    # NOTE Conversations survive restarts (see sessions.py)
+    session_store = sessions.SessionStore()
+    artifact_manager = None
+    if not args.stub:
+        source = (artifacts.MirrorSource(args.mirror)
+                  if args.mirror else None)
+        artifact_manager = artifacts.ArtifactManager(
+            source=source, max_bytes=int(args.disk_budget * 1024 ** 3),
+            in_use=lambda: model_registry.stats()["resident"])
+        # NOTE Every load waits for the download, drafts and training
+        #      included
+        model_registry.artifacts = artifact_manager
+        # NOTE The default model is downloaded before the first request
+        if args.model != "auto":
+            artifact_manager.prefetch(args.model)
+    model_router = None
+    if args.slo is not None:
+        model_router = router.Router(slo=args.slo)
+
+    async def run():
+        server = ChatServer(model_registry,
+                            default_model=args.model,
+                            max_concurrency=args.concurrency,
+                            max_queue=args.queue,
+                            options=options,
+                            response_cache=response_cache,
+                            chat_log=chat_log,
+                            session_store=session_store,
+                            speculative=args.speculative,
+                            pool_options=pool_options,
+                            memory=args.memory,
+                            model_router=model_router,
+                            artifact_manager=artifact_manager,
+                            batch_window_ms=args.batch_window,
+                            max_batch=args.batch_size)
+        await server.serve(args.host, args.port)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        chat_log.close()
+
+
+if __name__ == "__main__":
+    main()
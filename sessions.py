@@ -0,0 +1,126 @@
+import array
+import base64
+import dataclasses
+import json
+import os
+import threading
+import time
+
+import context
+
+# INSTRUCTIONS:
+# declare a store once per process using
+# session_store = sessions.SessionStore([folder="data/sessions"])
+# save a conversation after every turn using
+# session_store.save(session_id, conversation, model[, settings])
+# and reopen it using
+# conversation, meta = session_store.load(session_id)
+# where meta contains the model and the generation settings. The token ids
+# of every turn are saved too, so a reopened conversation is not tokenized
+# again as long as the same tokenizer is used.
+# session_store.list() reads the sessions from a single small index
+# (data/sessions/index.json), newest first, without opening them.
+
+
+# ANCHOR Compact token ids (base64 of 32 bit integers)
+def pack_ids(ids):
+    if ids is None:
+        return None
+    return base64.b64encode(array.array("I", ids).tobytes()).decode("ascii")
+
+
+def unpack_ids(packed):
+    if packed is None:
+        return None
+    ids = array.array("I")
+    ids.frombytes(base64.b64decode(packed))
+    return ids.tolist()
+
+
+class SessionStore:
+
+    def __init__(self, folder="data/sessions"):
+        self.folder = folder
+        self.index_path = folder + "/index.json"
+        self.lock = threading.Lock()
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as index_stream:
+                self.index = json.load(index_stream)
+
+    def path(self, session_id):
+        return self.folder + "/" + session_id + ".json"
+
+    # NOTE Written aside and renamed, a crash never leaves half a file
+    def write_json(self, path, data):
+        temporary = path + ".tmp"
+        with open(temporary, "w") as json_stream:
+            json.dump(data, json_stream, separators=(",", ":"))
+        os.replace(temporary, path)
+
+    # ANCHOR Saving
+    def save(self, session_id, conversation, model, settings=None):
+        if dataclasses.is_dataclass(settings):
+            settings = dataclasses.asdict(settings)
+        state = conversation.to_dict()
+        state["preamble_ids"] = pack_ids(state["preamble_ids"])
+        for turn in state["turns"]:
+            turn["ids"] = pack_ids(turn["ids"])
+        now = time.time()
+        with self.lock:
+            entry = self.index.get(session_id, {"created": now})
+            entry.update({"model": model,
+                          "updated": now,
+                          "turns": len(conversation.turns),
+                          "title": title_of(conversation)})
+            os.makedirs(self.folder, exist_ok=True)
+            self.write_json(self.path(session_id),
+                            {"id": session_id,
+                             "model": model,
+                             "settings": settings,
+                             "context": state})
+            self.index[session_id] = entry
+            self.write_json(self.index_path, self.index)
+
+    # ANCHOR Loading
+    def load(self, session_id):
+        if session_id not in self.index:
+            raise KeyError("Unknown session: " + session_id)
+        with open(self.path(session_id)) as session_stream:
+            data = json.load(session_stream)
+        state = data["context"]
+        state["preamble_ids"] = unpack_ids(state["preamble_ids"])
+        for turn in state["turns"]:
+            turn["ids"] = unpack_ids(turn["ids"])
+        conversation = context.ConversationContext.from_dict(state)
+        return conversation, {"id": session_id,
+                              "model": data["model"],
+                              "settings": data["settings"]}
+
+    def exists(self, session_id):
+        return session_id in self.index
+
+    def list(self):
+        with self.lock:
+            entries = [dict(entry, id=session_id)
+                       for session_id, entry in self.index.items()]
+        return sorted(entries, key=lambda entry: entry["updated"],
+                      reverse=True)
+
+    def delete(self, session_id):
+        with self.lock:
+            if self.index.pop(session_id, None) is None:
+                return
+            self.write_json(self.index_path, self.index)
+            try:
+                os.remove(self.path(session_id))
+            except OSError:
+                pass
+
+
+def title_of(conversation, length=40):
+    for turn in conversation.turns:
+        if turn.speaker == "Human":
+            text = " ".join(turn.text.split())
+            return text[:length] + ("..." if len(text) > length else "")
+    return "(empty)"
@@ -0,0 +1,100 @@
+import functools
+import re
+
+# INSTRUCTIONS:
+# the turn boundaries of a reply, without importing torch or transformers,
+# so they can be checked anywhere. Find the first stop sequence using
+# stops.find_stop(text, stops) -> (index, matched text) or None
+# cut a finished reply using
+# stops.cut_at_stop(text, stops)
+# and filter streamed pieces, holding back what may start a stop sequence,
+# using
+# for piece in stops.cut_stream(pieces, stops): ...
+# neo.py exposes the same names (neo.STOP_SEQUENCES, neo.find_stop, ...).
+
+
+# NOTE Turn boundaries: the reply ends where the model starts writing the
+# next line of the conversation. Checked on the last decoded tokens while
+# generating, so the remaining decode budget is not spent (see
+# neo.GPTNeo.stream).
+STOP_SEQUENCES = ("\nHuman:", "\nBot:")
+
+# NOTE Tokens decoded to look for a stop sequence, enough for the longest
+STOP_WINDOW = 8
+
+
+# ANCHOR Stop sequence helpers
+# NOTE A new line may be indented like the lines of the IMPRINTING, so
+#      spaces are allowed after the new line of a stop sequence
+@functools.lru_cache(maxsize=32)
+def stop_pattern(stops):
+    return re.compile("|".join("\n[ \t]*" + re.escape(stop[1:])
+                               if stop.startswith("\n") else re.escape(stop)
+                               for stop in stops))
+
+
+# NOTE Returns (index, matched text) of the first stop sequence. At the
+#      start of the reply the model may write its own "Bot:" line, so the
+#      leading blank text is skipped
+def find_stop(text, stops, reply_start=True):
+    if not stops:
+        return None
+    start = len(text) - len(text.lstrip()) if reply_start else 0
+    match = stop_pattern(tuple(stops)).search(text, start)
+    if match is None:
+        return None
+    return match.start(), match.group()
+
+
+# NOTE Length of the end of the text that may be the start of a stop
+#      sequence, held back while streaming until the next piece arrives
+def partial_stop(text, stops):
+    held = 0
+    newline = text.rfind("\n")
+    if newline != -1:
+        rest = text[newline + 1:].lstrip(" \t")
+        if any(stop.startswith("\n") and stop[1:].startswith(rest)
+               for stop in stops):
+            held = len(text) - newline
+    longest = max((len(stop) for stop in stops), default=0)
+    for length in range(min(len(text), longest - 1), 0, -1):
+        if any(stop.startswith(text[-length:]) for stop in stops):
+            return max(held, length)
+    return held
+
+
+def cut_at_stop(text, stops):
+    found = find_stop(text, stops)
+    if found is None:
+        return text
+    return text[:found[0]]
+
+
+# NOTE Pieces to show while streaming: text that may be the start of a stop
+#      sequence is held back until the next piece, so the boundary is never
+#      shown, even when it spans several pieces. After the boundary the
+#      pieces are still read (the producer is not blocked) but dropped.
+#      Only the first shown piece is the start of the reply (see find_stop)
+def cut_stream(pieces, stops):
+    held = ""
+    shown = False
+    cut = False
+    for piece in pieces:
+        if not piece or cut:
+            continue
+        held += piece
+        found = find_stop(held, stops, reply_start=not shown)
+        if found is not None:
+            piece = held[:found[0]]
+            held = ""
+            cut = True
+        else:
+            keep = partial_stop(held, stops)
+            piece = held[:len(held) - keep]
+            held = held[len(held) - keep:]
+        if not piece:
+            continue
+        shown = True
+        yield piece
+    if held:
+        yield held
@@ -0,0 +1,223 @@
+import bisect
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # NOTE Windows, see peak_rss_bytes
+    resource = None
+
+# INSTRUCTIONS:
+# time a stage using
+# with telemetry.timer("stage.name"):
+#     ...
+# or record a value, a counter or a gauge using
+# telemetry.observe("stage.name", seconds)
+# telemetry.count("tokens.generated", number)
+# telemetry.gauge("memory.rss", bytes)
+# a text summary (used by the stats panel) is given by
+# telemetry.summary()
+# and every metric can be written as JSON using
+# telemetry.export([path])
+# telemetry.start_exporter([interval]) exports periodically in background.
+# Recording is a dictionary lookup and a bisect under a lock, so it can be
+# left on all the time.
+
+# NOTE Power of two buckets from ~1ms to ~12 days (or 1 to 1M for counts)
+BOUNDS = [2.0 ** exponent for exponent in range(-10, 21)]
+
+EXPORT_PATH = "data/metrics.json"
+
+
+# ANCHOR Fixed bucket histogram
+class Histogram:
+
+    def __init__(self):
+        self.buckets = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.last = value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def quantile(self, fraction):
+        # NOTE Upper bound of the bucket holding the quantile
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for index, amount in enumerate(self.buckets):
+            seen += amount
+            if seen >= target:
+                if index < len(BOUNDS):
+                    return min(BOUNDS[index], self.max)
+                return self.max
+        return self.max
+
+    def snapshot(self):
+        return {"count": self.count,
+                "sum": self.total,
+                "mean": self.total / self.count if self.count else None,
+                "min": self.min,
+                "max": self.max,
+                "last": self.last,
+                "p50": self.quantile(0.5),
+                "p90": self.quantile(0.9),
+                "p99": self.quantile(0.99),
+                "buckets": {str(bound): amount for bound, amount
+                            in zip(BOUNDS + ["+Inf"], self.buckets) if amount}}
+
+
+class Telemetry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.started = time.time()
+        self.exporter = None
+
+    # ANCHOR Recording
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def memory(self):
+        for name, value in (("memory.rss_bytes", rss_bytes()),
+                            ("memory.peak_rss_bytes", peak_rss_bytes())):
+            if value is not None:
+                self.gauge(name, value)
+
+    # ANCHOR Reading
+    def snapshot(self):
+        self.memory()
+        with self.lock:
+            return {"started": self.started,
+                    "uptime": time.time() - self.started,
+                    "histograms": {name: histogram.snapshot() for name, histogram
+                                   in sorted(self.histograms.items())},
+                    "counters": dict(sorted(self.counters.items())),
+                    "gauges": dict(sorted(self.gauges.items()))}
+
+    def summary(self):
+        snapshot = self.snapshot()
+        lines = ["Timings (count, mean, p50, p90, max):"]
+        for name, histogram in snapshot["histograms"].items():
+            lines.append("  %-24s %6d  %8.3f  %8.3f  %8.3f  %8.3f" %
+                         (name, histogram["count"], histogram["mean"],
+                          histogram["p50"], histogram["p90"],
+                          histogram["max"]))
+        lines.append("Counters:")
+        for name, value in snapshot["counters"].items():
+            lines.append("  %-24s %d" % (name, value))
+        lines.append("Memory:")
+        for name, value in snapshot["gauges"].items():
+            lines.append("  %-24s %.1fMB" % (name, value / 1024 ** 2))
+        return "\n".join(lines)
+
+    # ANCHOR Exporting
+    def export(self, path=EXPORT_PATH):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        temporary = path + ".tmp"
+        with open(temporary, "w") as metrics_stream:
+            json.dump(self.snapshot(), metrics_stream, indent=2)
+        os.replace(temporary, path)
+
+    def start_exporter(self, interval=30, path=EXPORT_PATH):
+        if self.exporter is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.export(path)
+                except OSError:
+                    pass
+
+        self.exporter = threading.Thread(target=run, daemon=True)
+        self.exporter.start()
+
+
+# ANCHOR Memory helpers
+# NOTE Both return None when the platform gives no measure
+def rss_bytes():
+    # NOTE Current resident memory (Linux), peak memory elsewhere
+    try:
+        with open("/proc/self/status") as status_stream:
+            for line in status_stream:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().rss
+    return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    if resource is None:
+        # NOTE Windows has no getrusage, psutil gives the peak working set
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return getattr(psutil.Process().memory_info(), "peak_wset", None)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # NOTE Linux reports kilobytes, macOS bytes
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+
+# NOTE One instance per process, shared by every module
+metrics = Telemetry()
+observe = metrics.observe
+count = metrics.count
+gauge = metrics.gauge
+timer = metrics.timer
+summary = metrics.summary
+snapshot = metrics.snapshot
+export = metrics.export
+start_exporter = metrics.start_exporter
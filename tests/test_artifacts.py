@@ -0,0 +1,126 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import artifacts  # noqa: E402
+
+# INSTRUCTIONS:
+# run the tests using
+# python -m pytest tests
+# The models are copied from a mirror folder made in the temporary folder
+# of every test, in chunks of a few bytes, nothing is downloaded.
+
+WEIGHTS = bytes(range(256)) * 4
+
+
+# ANCHOR Helpers
+def make_mirror(tmp_path, model="neo-small", checksums=None):
+    root = tmp_path / "mirror" / model
+    root.mkdir(parents=True)
+    (root / "model.safetensors").write_bytes(WEIGHTS)
+    (root / "config.json").write_text('{"model_type": "gpt_neo"}')
+    # NOTE Never copied
+    (root / "README.md").write_text("read me")
+    if checksums is not None:
+        (root / artifacts.MANIFEST).write_text(json.dumps(
+            {"files": {name: {"sha256": sha256}
+                       for name, sha256 in checksums.items()}}))
+    return str(tmp_path / "mirror")
+
+
+def make_manager(tmp_path, source, **options):
+    options.setdefault("chunk_bytes", 100)
+    return artifacts.ArtifactManager(source=source,
+                                     folder=str(tmp_path / "models"),
+                                     **options)
+
+
+class FlakySource(artifacts.MirrorSource):
+
+    def __init__(self, folder, fail_at=None):
+        artifacts.MirrorSource.__init__(self, folder)
+        self.fail_at = fail_at
+        self.copies = []
+
+    def copy(self, model, path, start, length, stream):
+        if path == "model.safetensors" and start == self.fail_at:
+            self.fail_at = None
+            raise Exception("connection lost")
+        self.copies.append((path, start))
+        artifacts.MirrorSource.copy(self, model, path, start, length, stream)
+
+
+# ANCHOR Download
+def test_mirror_download(tmp_path):
+    manager = make_manager(tmp_path, artifacts.MirrorSource(
+        make_mirror(tmp_path)))
+    assert manager.state("neo-small")["state"] == "absent"
+    assert manager.wait("neo-small", timeout=10)
+    folder = tmp_path / "models" / "neo-small"
+    assert (folder / "model.safetensors").read_bytes() == WEIGHTS
+    assert sorted(os.listdir(str(folder))) == [artifacts.MANIFEST,
+                                               "config.json",
+                                               "model.safetensors"]
+    assert manager.ready("neo-small")
+    assert manager.verify("neo-small")
+    assert artifacts.is_ready("neo-small", str(tmp_path / "models"))
+    # NOTE A damaged file is noticed
+    (folder / "config.json").write_text('{"model_type": "gpt_neo"} ')
+    assert not manager.verify("neo-small")
+
+
+def test_interrupted_download_resumes(tmp_path):
+    source = FlakySource(make_mirror(tmp_path), fail_at=500)
+    manager = make_manager(tmp_path, source, workers=1)
+    try:
+        manager.wait("neo-small", timeout=10)
+    except Exception as error:
+        assert "connection lost" in str(error)
+    else:
+        raise AssertionError("the download did not fail")
+    copied = set(source.copies)
+    source.copies = []
+    # NOTE A new manager, as after a restart of the application
+    manager = make_manager(tmp_path, source, workers=1)
+    assert manager.wait("neo-small", timeout=10)
+    assert not copied & set(source.copies)
+    assert ("model.safetensors", 500) in source.copies
+    assert (tmp_path / "models" / "neo-small" /
+            "model.safetensors").read_bytes() == WEIGHTS
+    assert not os.path.exists(str(tmp_path / "models" / "neo-small" /
+                                  artifacts.PARTIAL))
+
+
+def test_checksum_mismatch(tmp_path):
+    mirror = make_mirror(tmp_path, checksums={"model.safetensors": "0" * 64})
+    manager = make_manager(tmp_path, artifacts.MirrorSource(mirror))
+    try:
+        manager.wait("neo-small", timeout=10)
+    except Exception as error:
+        assert "Checksum mismatch for model.safetensors" in str(error)
+    else:
+        raise AssertionError("the damaged file was installed")
+    assert manager.state("neo-small")["state"] == "failed"
+    folder = tmp_path / "models" / "neo-small"
+    assert not (folder / artifacts.MANIFEST).exists()
+    # NOTE Copied again from scratch on the next try
+    assert not (folder / artifacts.PARTIAL / "model.safetensors").exists()
+
+
+# ANCHOR Disk budget
+def test_least_recently_used_model_is_deleted(tmp_path):
+    make_mirror(tmp_path, "aeona")
+    mirror = make_mirror(tmp_path)
+    size = len(WEIGHTS) + len('{"model_type": "gpt_neo"}')
+    manager = make_manager(tmp_path, artifacts.MirrorSource(mirror),
+                           max_bytes=size + 10)
+    assert manager.wait("aeona", timeout=10)
+    checkpoints = tmp_path / "models" / "aeona" / "checkpoints" / "v0001"
+    checkpoints.mkdir(parents=True)
+    assert manager.wait("neo-small", timeout=10)
+    assert manager.state("aeona")["state"] == "absent"
+    assert manager.stats()["evictions"] == 1
+    # NOTE The trained checkpoints are kept
+    assert os.listdir(str(tmp_path / "models" / "aeona")) == ["checkpoints"]
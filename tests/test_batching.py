@@ -0,0 +1,91 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import batching  # noqa: E402
+
+# INSTRUCTIONS:
+# run the tests using
+# python -m pytest tests
+# The model is a fake recording the batches it is given.
+
+
+# ANCHOR Fake model
+class FakeModel:
+
+    def __init__(self, fail=False):
+        self.batches = []
+        self.fail = fail
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def generation_settings(self):
+        return "default"
+
+    def generate_batch(self, prompts, settings=None, return_stats=False):
+        self.started.set()
+        self.release.wait(5)
+        if self.fail:
+            raise Exception("generation failed")
+        self.batches.append((list(prompts), list(settings)))
+        stats = [{"batch_size": len(prompts), "groups": 1,
+                  "batch_new_tokens": 2 * len(prompts), "new_tokens": 2,
+                  "total": 0.5, "tokens_per_sec": 4.0 * len(prompts)}
+                 for _ in prompts]
+        return [prompt.upper() for prompt in prompts], stats
+
+
+# ANCHOR Grouping
+def test_requests_in_the_window_share_a_batch():
+    gpt = FakeModel()
+    batcher = batching.MicroBatcher(gpt, window_ms=200, max_batch=8)
+    futures = [batcher.submit("p" + str(number)) for number in range(4)]
+    replies = [future.result(5) for future in futures]
+    batcher.close()
+    assert [reply for reply, _ in replies] == ["P0", "P1", "P2", "P3"]
+    assert replies[0][1]["batch_size"] == 4
+    assert gpt.batches == [(["p0", "p1", "p2", "p3"], ["default"] * 4)]
+    stats = batcher.stats()
+    assert (stats["batches"], stats["requests"]) == (1, 4)
+    assert stats["new_tokens"] == 8
+
+
+def test_max_batch_and_settings():
+    gpt = FakeModel()
+    # NOTE Holding the model on a first batch, so the others are queued
+    gpt.release.clear()
+    batcher = batching.MicroBatcher(gpt, window_ms=0, max_batch=2)
+    futures = [batcher.submit("first")]
+    assert gpt.started.wait(5)
+    futures += [batcher.submit("p" + str(number), settings="greedy")
+                for number in range(3)]
+    gpt.release.set()
+    for future in futures:
+        future.result(5)
+    batcher.close()
+    assert [prompts for prompts, _ in gpt.batches] == [["first"],
+                                                       ["p0", "p1"], ["p2"]]
+    assert gpt.batches[1][1] == ["greedy", "greedy"]
+    assert batcher.stats()["largest_batch"] == 2
+
+
+def test_errors_reach_every_request():
+    batcher = batching.MicroBatcher(FakeModel(fail=True), window_ms=100)
+    futures = [batcher.submit("p0"), batcher.submit("p1")]
+    for future in futures:
+        assert str(future.exception(5)) == "generation failed"
+    batcher.close()
+
+
+def test_closed_batcher_refuses_requests():
+    batcher = batching.MicroBatcher(FakeModel())
+    batcher.close()
+    try:
+        batcher.submit("late")
+    except Exception as error:
+        assert "closed" in str(error)
+    else:
+        raise AssertionError("submit after close")
@@ -0,0 +1,83 @@
+import json
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cache  # noqa: E402
+
+# INSTRUCTIONS:
+# run the tests using
+# python -m pytest tests
+# The disk store is written in the temporary folder of every test.
+
+
+class Settings:
+
+    def __init__(self, do_sample):
+        self.do_sample = do_sample
+
+
+# ANCHOR Keys
+def test_key():
+    response_cache = cache.ResponseCache(folder=None)
+    key = response_cache.key("neo-small", "base", "Human: hi\r\n", ("x",))
+    assert key == response_cache.key("neo-small", "base", "  Human: hi\n",
+                                     ("x",))
+    assert key != response_cache.key("neo-small", "v2", "Human: hi", ("x",))
+    assert key != response_cache.key("neo-small", "base", "Human: hi", ())
+    assert key != response_cache.key("neo-large", "base", "Human: hi", ("x",))
+    assert response_cache.cacheable(Settings(do_sample=False))
+    assert not response_cache.cacheable(Settings(do_sample=True))
+
+
+# ANCHOR Memory eviction
+def test_memory_least_recently_used():
+    response_cache = cache.ResponseCache(max_entries=2, folder=None)
+    response_cache.put("a", "A")
+    response_cache.put("b", "B")
+    assert response_cache.get("a") == "A"
+    response_cache.put("c", "C")
+    assert response_cache.get("b") is None
+    assert response_cache.get("a") == "A"
+    assert response_cache.get("c") == "C"
+    stats = response_cache.stats()
+    assert stats["evictions"] == 1
+
+
+# ANCHOR Disk store
+def test_disk_survives_a_restart(tmp_path):
+    folder = str(tmp_path)
+    cache.ResponseCache(folder=folder).put("a", "A")
+    response_cache = cache.ResponseCache(folder=folder)
+    assert response_cache.get("a") == "A"
+    assert response_cache.stats()["disk_hits"] == 1
+    assert not [name for name in os.listdir(folder) if name.endswith(".tmp")]
+
+
+def test_disk_least_recently_used(tmp_path):
+    folder = str(tmp_path)
+    response_cache = cache.ResponseCache(folder=folder)
+    for key, used in (("a", 1000), ("b", 3000), ("c", 2000)):
+        response_cache.put(key, "same size")
+        os.utime(response_cache.path(key), (used, used))
+    size = os.path.getsize(response_cache.path("a"))
+    cache.ResponseCache(folder=folder, max_disk_bytes=2 * size)
+    assert sorted(os.listdir(folder)) == ["b.json", "c.json"]
+
+
+def test_concurrent_puts(tmp_path):
+    folder = str(tmp_path)
+    response_cache = cache.ResponseCache(folder=folder)
+    threads = [threading.Thread(target=response_cache.put,
+                                args=("a", str(number) * 1000))
+               for number in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert os.listdir(folder) == ["a.json"]
+    with open(response_cache.path("a")) as cache_stream:
+        text = json.load(cache_stream)["text"]
+    assert text == text[0] * 1000
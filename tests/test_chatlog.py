@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import chatlog  # noqa: E402
+
+# INSTRUCTIONS:
+# run the tests using
+# python -m pytest tests
+# The logs are written in the temporary folder of every test.
+
+
+# ANCHOR Writing and reading back
+def test_turns_are_read_back(tmp_path):
+    folder = str(tmp_path)
+    chat_log = chatlog.ChatLog(folder=folder, flush_every=0.01)
+    chat_log.start("one", "neo-small", "preamble")
+    chat_log.turn("one", "neo-small", "hello", "hi there")
+    chat_log.turn("two", "aeona", "Ciao", "Hello")
+    chat_log.close()
+    assert chatlog.load_session("one", folder) == [("Human", "hello"),
+                                                    ("Bot", "hi there")]
+    sessions = {entry["session"]: entry
+                for entry in chatlog.list_sessions(folder)}
+    assert (sessions["one"]["turns"], sessions["two"]["turns"]) == (1, 1)
+    assert [record["session"] for record in chatlog.search("ciao", folder)] == [
+        "two"]
+    assert chat_log.stats()["written"] == 3
+
+
+# ANCHOR Rotation
+def test_rotation_compresses_the_full_files(tmp_path):
+    folder = str(tmp_path)
+    chat_log = chatlog.ChatLog(folder=folder, max_bytes=100, flush_every=0.01)
+    for number in range(3):
+        chat_log.turn("one", "neo-small", "question " + str(number),
+                      "a long enough answer " * 5)
+        # NOTE One batch per turn, each one fills a file
+        time.sleep(0.1)
+    chat_log.close()
+    files = chatlog.log_files(folder)
+    assert len(files) == chat_log.stats()["rotations"] == 3
+    assert all(path.endswith(".jsonl.gz") for path in files)
+    turns = chatlog.load_session("one", folder)
+    assert [text for speaker, text in turns if speaker == "Human"] == [
+        "question 0", "question 1", "question 2"]
+
+
+def test_cut_line_is_skipped(tmp_path):
+    folder = str(tmp_path)
+    chat_log = chatlog.ChatLog(folder=folder, flush_every=0.01)
+    chat_log.turn("one", "neo-small", "hello", "hi")
+    chat_log.close()
+    with open(chatlog.log_files(folder)[0], "a") as log_stream:
+        log_stream.write('{"type": "turn", "session": "one"')
+    assert chatlog.load_session("one", folder) == [("Human", "hello"),
+                                                    ("Bot", "hi")]
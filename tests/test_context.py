@@ -0,0 +1,94 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import context  # noqa: E402
+
+# INSTRUCTIONS:
+# run the tests using
+# python -m pytest tests
+# The tokenizer is a fake giving one id per word, so the budgets are
+# counted in words.
+
+
+# ANCHOR Fake tokenizer
+class WordTokenizer:
+
+    vocab_size = 1000
+
+    def encode(self, text):
+        return [len(word) for word in text.split()]
+
+
+def make_context(max_tokens=20):
+    conversation = context.ConversationContext(preamble="Talk nicely\n",
+                                               max_tokens=max_tokens)
+    conversation.set_tokenizer(WordTokenizer(), name="words")
+    return conversation
+
+
+# ANCHOR Token window
+def test_recent_turns_fitting_in_the_budget():
+    conversation = make_context(max_tokens=12)
+    conversation.add("Human", "one two three")
+    conversation.add("Bot", "four five")
+    conversation.add("Human", "six seven eight")
+    prompt, ids = conversation.build()
+    # NOTE 2 words of preamble, then 4 + 3 + 4 words for the turns
+    assert prompt == "Talk nicely\nBot: four five\nHuman: six seven eight\n"
+    assert len(ids) == 9
+    stats = conversation.stats()
+    assert (stats["included_turns"], stats["dropped_turns"]) == (2, 1)
+    assert stats["truncated_builds"] == 1
+
+
+def test_turns_are_tokenized_once():
+    conversation = make_context()
+    conversation.add("Human", "hello there")
+    conversation.build()
+    encoded = conversation.stats()["tokenizer_calls"]
+    conversation.build()
+    assert conversation.stats()["tokenizer_calls"] == encoded
+    # NOTE Another vocabulary, the cached ids are dropped
+    conversation.set_tokenizer(WordTokenizer(), name="other")
+    assert conversation.turns[0].ids is None
+    conversation.build()
+    assert conversation.stats()["tokenizer_calls"] == encoded * 2
+
+
+def test_memories_use_a_quarter_of_the_budget():
+    conversation = make_context(max_tokens=40)
+    conversation.set_memories([("old question", "old answer"),
+                               ("another long question here",
+                                "and another long answer here")])
+    conversation.add("Human", "new question")
+    prompt, _ = conversation.build()
+    assert "Human: old question\nBot: old answer\n" in prompt
+    assert "another" not in prompt
+    assert conversation.stats()["memory_turns"] == 1
+
+
+def test_remove():
+    conversation = make_context()
+    turn = conversation.add("Human", "not answered")
+    conversation.remove(turn)
+    assert conversation.turns == []
+
+
+# ANCHOR Saving and restoring
+def test_round_trip_keeps_the_ids():
+    conversation = make_context()
+    conversation.add("Human", "hello there")
+    conversation.build()
+    restored = context.ConversationContext.from_dict(conversation.to_dict())
+    assert [turn.ids for turn in restored.turns] == [
+        turn.ids for turn in conversation.turns]
+    restored.set_tokenizer(WordTokenizer(), name="words")
+    restored.build()
+    assert restored.stats()["tokenizer_calls"] == 0
+
+
+def test_tokenizer_name():
+    assert context.tokenizer_name(WordTokenizer(), "words") == "words-1000"
+    assert context.tokenizer_name(WordTokenizer()) == "WordTokenizer-1000"
@@ -0,0 +1,131 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import feedback  # noqa: E402
+
+# INSTRUCTIONS:
+# run the tests using
+# python -m pytest tests
+# The worker is a fake keeping the submitted jobs, nothing is trained: the
+# scheduler is only checked on when it submits.
+
+
+# ANCHOR Fakes
+class FakeJob:
+
+    def __init__(self, function):
+        self.function = function
+        self.state = "queued"
+
+    def progress(self, message):
+        pass
+
+    def cancelled(self):
+        return False
+
+
+class FailingRegistry:
+
+    def get(self, model):
+        raise Exception("Not enough training data for a single block")
+
+
+class FakeWorker:
+
+    def __init__(self):
+        self.registry = FailingRegistry()
+        self.jobs = []
+        self.busy = 0
+
+    def pending(self):
+        return self.busy
+
+    def submit(self, kind, model, function, lane=None):
+        job = FakeJob(function)
+        self.jobs.append((kind, model, lane, job))
+        return job
+
+
+def rate(store, count, model="neo-small", rating=1):
+    for number in range(count):
+        store.rate(model + "-" + str(number), model, "question " + str(number),
+                   "answer " + str(number), rating)
+
+
+def make_scheduler(tmp_path, monkeypatch, **options):
+    # NOTE The training batches are written in data/feedback
+    monkeypatch.chdir(tmp_path)
+    store = feedback.FeedbackStore(str(tmp_path / "feedback.jsonl"))
+    options.setdefault("min_pairs", 3)
+    options.setdefault("idle_seconds", 0)
+    scheduler = feedback.FeedbackScheduler(FakeWorker(), store, **options)
+    return scheduler, store
+
+
+# ANCHOR Store
+def test_last_rating_wins_and_survives_a_restart(tmp_path):
+    path = str(tmp_path / "feedback.jsonl")
+    store = feedback.FeedbackStore(path)
+    rate(store, 2)
+    store.rate("neo-small-1", "neo-small", "question 1", "answer 1", -1)
+    store.mark_trained(["neo-small-0"])
+    with open(path, "a") as feedback_stream:
+        feedback_stream.write('{"type": "rating", "id": ')
+    store = feedback.FeedbackStore(path)
+    assert store.approved() == []
+    assert store.stats() == {"rated": 2, "up": 1, "down": 1, "trained": 1}
+
+
+# ANCHOR Scheduler gating
+def test_submits_when_idle_with_enough_pairs(tmp_path, monkeypatch):
+    scheduler, store = make_scheduler(tmp_path, monkeypatch, max_pairs=4)
+    rate(store, 2)
+    assert scheduler.check() is None
+    rate(store, 6)
+    job = scheduler.check()
+    assert job is not None
+    kind, model, lane, _ = scheduler.worker.jobs[0]
+    assert (kind, model, lane) == ("feedback", "neo-small", "train:neo-small")
+    batch = os.listdir(str(tmp_path / "data" / "feedback"))
+    with open(str(tmp_path / "data" / "feedback" / batch[0])) as batch_stream:
+        assert batch_stream.read().count("Human: ") == 4
+    # NOTE One job at a time
+    assert scheduler.check() is None
+
+
+def test_waits_for_idle_and_free_worker(tmp_path, monkeypatch):
+    scheduler, store = make_scheduler(tmp_path, monkeypatch, idle_seconds=60)
+    rate(store, 3)
+    scheduler.touch()
+    assert scheduler.check() is None
+    scheduler.last_activity = time.time() - 120
+    scheduler.worker.busy = 1
+    assert scheduler.check() is None
+    scheduler.worker.busy = 0
+    assert scheduler.check() is not None
+
+
+def test_backs_off_after_failures(tmp_path, monkeypatch):
+    scheduler, store = make_scheduler(tmp_path, monkeypatch,
+                                      min_interval=10, max_backoff=30)
+    rate(store, 3)
+    job = scheduler.check()
+    job.state = "running"
+    try:
+        job.function(job)
+    except Exception:
+        job.state = "failed"
+    else:
+        raise AssertionError("the training did not fail")
+    assert scheduler.failures == 1
+    assert scheduler.check() is None
+    assert scheduler.wait_time() == 20
+    scheduler.failures = 3
+    assert scheduler.wait_time() == 30
+    # NOTE Retried once the wait is over
+    scheduler.last_run = time.time() - 31
+    assert scheduler.check() is not None
+    assert store.approved(model="neo-small")
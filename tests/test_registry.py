@@ -0,0 +1,134 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import registry  # noqa: E402
+
+# INSTRUCTIONS:
+# run the tests using
+# python -m pytest tests
+# The models are fakes whose state dict has the size given in SIZES, so
+# the memory budget is checked without torch.
+
+SIZES = {"neo-small": 100, "dialo-small": 100, "aeona": 100,
+         "neo-large": 300}
+
+
+# ANCHOR Fake models
+class FakeTensor:
+
+    def __init__(self, size):
+        self.size = size
+
+    def numel(self):
+        return self.size
+
+    def element_size(self):
+        return 1
+
+    def data_ptr(self):
+        return id(self)
+
+
+class FakeWeights:
+
+    def __init__(self, size):
+        self.tensor = FakeTensor(size)
+
+    def state_dict(self):
+        # NOTE Tied weights are counted once
+        return {"weight": self.tensor, "tied": self.tensor}
+
+
+class FakeGen:
+
+    def __init__(self, size):
+        self.model = FakeWeights(size)
+
+
+class FakeModel:
+
+    def __init__(self, model, **options):
+        self.model_folder = model
+        self.options = options
+        self.gen = FakeGen(SIZES[model])
+
+
+def make_registry(max_bytes=250):
+    return registry.ModelRegistry(max_bytes=max_bytes, factory=FakeModel)
+
+
+# ANCHOR Loading and reuse
+def test_get_reuses_the_instance():
+    model_registry = make_registry()
+    first = model_registry.get("neo-small")
+    assert model_registry.get("neo-small") is first
+    # NOTE Other options are another entry
+    assert model_registry.get("neo-small", precision="bf16") is not first
+    stats = model_registry.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 2)
+    assert model_registry.is_loaded("neo-small")
+    assert not model_registry.is_loaded("aeona")
+
+
+# ANCHOR LRU order and byte budget
+def test_least_recently_used_is_evicted():
+    model_registry = make_registry()
+    model_registry.get("neo-small")
+    model_registry.get("dialo-small")
+    # NOTE Used again, so dialo-small is now the oldest
+    model_registry.get("neo-small")
+    model_registry.get("aeona")
+    stats = model_registry.stats()
+    assert stats["resident"] == ["neo-small", "aeona"]
+    assert stats["used_bytes"] == 200
+    assert stats["evictions"] == 1
+
+
+def test_model_bigger_than_the_budget_is_kept_alone():
+    model_registry = make_registry()
+    model_registry.get("neo-small")
+    model_registry.get("neo-large")
+    assert model_registry.stats()["resident"] == ["neo-large"]
+    model_registry.get("neo-small")
+    assert model_registry.stats()["resident"] == ["neo-small"]
+
+
+def test_estimate_and_fits():
+    model_registry = make_registry()
+    model_registry.get("neo-large")
+    model_registry.get("neo-small")
+    # NOTE Evicted models are remembered with their size
+    assert model_registry.estimate("neo-large") == 300
+    assert model_registry.estimate("neo-small") == 100
+    assert model_registry.fits("neo-small", busy=["neo-large"])
+    assert model_registry.fits("dialo-small", busy=["neo-small"])
+    assert not model_registry.fits("neo-large", busy=["neo-small"])
+
+
+def test_drop():
+    model_registry = make_registry()
+    model_registry.get("neo-small")
+    assert model_registry.drop("neo-small")
+    assert not model_registry.drop("neo-small")
+    assert model_registry.stats()["resident"] == []
+
+
+# ANCHOR Weights on disk
+def test_weights_size(tmp_path):
+    folder = str(tmp_path)
+    assert registry.weights_size(folder) == 0
+    for name, size in (("a.safetensors", 100), ("b.safetensors", 50)):
+        with open(folder + "/" + name, "wb") as weights_stream:
+            weights_stream.write(b"x" * size)
+    # NOTE Sharded checkpoint, several tensors per shard
+    with open(folder + "/model.safetensors.index.json", "w") as index_stream:
+        json.dump({"weight_map": {"one": "a.safetensors",
+                                  "two": "a.safetensors",
+                                  "three": "b.safetensors"}}, index_stream)
+    assert registry.weights_size(folder) == 150
+    with open(folder + "/model.safetensors", "wb") as weights_stream:
+        weights_stream.write(b"x" * 10)
+    assert registry.weights_size(folder) == 10
@@ -0,0 +1,71 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import router  # noqa: E402
+
+# INSTRUCTIONS:
+# run the tests using
+# python -m pytest tests
+# Every model is passed as resident, so no download is looked for.
+
+MODELS = ["neo-small", "neo-large"]
+
+
+def make_router(tmp_path, slo=5.0):
+    return router.Router(slo=slo, path=str(tmp_path / "router.json"),
+                         log_path=str(tmp_path / "router.jsonl"),
+                         models=MODELS)
+
+
+def stats(ttft, total, new_tokens):
+    return {"ttft": ttft, "total": total, "new_tokens": new_tokens}
+
+
+# ANCHOR Profiles
+def test_observe_builds_the_profile(tmp_path):
+    model_router = make_router(tmp_path)
+    model_router.observe("neo-small", stats(0.1, 1.1, 41), 1.0, load_time=2.0)
+    profile = model_router.stats()["profiles"]["neo-small"]
+    assert profile["tokens_per_sec"] == 40.0
+    assert (profile["ttft"], profile["reply_tokens"], profile["load"]) == (
+        0.1, 41, 2.0)
+    assert model_router.predict("neo-small", resident=MODELS) == 0.1 + 41 / 40
+    assert model_router.predict("neo-small") == 2.0 + 0.1 + 41 / 40
+    # NOTE Saved for the next run
+    assert make_router(tmp_path).profiles == model_router.profiles
+
+
+def test_cached_replies_only_count_for_the_slo(tmp_path):
+    model_router = make_router(tmp_path)
+    model_router.observe("neo-small", {"ttft": 0.0, "total": 0.0,
+                                       "cached": True}, 0.1)
+    assert "ttft" not in model_router.profiles["neo-small"]
+    model_router.observe("neo-small", stats(0.1, 1.1, 41), 9.0, routed=False)
+    assert model_router.stats()["slo_hit_rate"] == 1.0
+
+
+# ANCHOR Choosing
+def test_largest_model_fitting_the_slo(tmp_path):
+    model_router = make_router(tmp_path)
+    model_router.observe("neo-small", stats(0.1, 1.1, 41), 1.0)
+    # NOTE neo-large is scaled from neo-small, far too slow
+    assert model_router.choose(resident=MODELS) == "neo-small"
+    model_router.observe("neo-large", stats(0.5, 2.5, 41), 3.0)
+    assert model_router.choose(resident=MODELS) == "neo-large"
+    # NOTE A long queue makes the large model miss the SLO
+    assert model_router.choose(resident=MODELS, pending=1) == "neo-small"
+    decisions = model_router.stats()["decisions"]
+    assert decisions == {"neo-small": 2, "neo-large": 1}
+
+
+def test_fallbacks(tmp_path):
+    model_router = make_router(tmp_path, slo=0.5)
+    assert model_router.choose(resident=MODELS,
+                               default="neo-large") == "neo-large"
+    model_router.observe("neo-small", stats(0.1, 1.1, 41), 1.0)
+    model_router.observe("neo-large", stats(0.5, 2.5, 41), 3.0)
+    # NOTE Nothing fits, the fastest one
+    assert model_router.choose(resident=MODELS) == "neo-small"
+    assert model_router.stats()["fallbacks"] == 2
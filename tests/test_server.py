@@ -0,0 +1,269 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cache  # noqa: E402
+import chatlog  # noqa: E402
+import registry  # noqa: E402
+import server  # noqa: E402
+import sessions  # noqa: E402
+
+# INSTRUCTIONS:
+# run the tests using
+# python -m pytest tests
+# The server is served on a free local port with the stub model (see
+# server.StubModel), nothing is downloaded and torch is not needed.
+
+
+# ANCHOR Helpers
+def make_server(folder, **options):
+    chat_log = chatlog.ChatLog(folder=os.path.join(folder, "logs"))
+    session_store = sessions.SessionStore(os.path.join(folder, "sessions"))
+    options.setdefault("models", ("neo-small",))
+    chat_server = server.ChatServer(
+        registry.ModelRegistry(factory=server.StubModel),
+        chat_log=chat_log, session_store=session_store, **options)
+    return chat_server, chat_log
+
+
+async def request(port, method, path, body=None):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    data = json.dumps(body).encode("utf-8") if body is not None else b""
+    writer.write((method + " " + path + " HTTP/1.1\r\n"
+                  "Host: localhost\r\n"
+                  "Content-Length: " + str(len(data)) + "\r\n\r\n")
+                 .encode("latin-1") + data)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, payload = response.partition(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    if b"Transfer-Encoding: chunked" in head:
+        lines = []
+        while payload:
+            size, _, rest = payload.partition(b"\r\n")
+            size = int(size, 16)
+            if not size:
+                break
+            lines.append(json.loads(rest[:size]))
+            payload = rest[size + 2:]
+        return status, lines
+    return status, json.loads(payload)
+
+
+def serve(chat_server, scenario):
+    async def run():
+        listener = await asyncio.start_server(chat_server.handle,
+                                              "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        try:
+            return await scenario(port)
+        finally:
+            listener.close()
+            await listener.wait_closed()
+            chat_server.close()
+    return asyncio.run(run())
+
+
+# ANCHOR Endpoints
+def test_chat(tmp_path):
+    chat_server, chat_log = make_server(str(tmp_path))
+
+    async def scenario(port):
+        status, reply = await request(port, "POST", "/chat",
+                                      {"message": "hello there"})
+        assert status == 200
+        assert reply["reply"] == "You said: hello there"
+        assert reply["session"]
+        status, error = await request(port, "POST", "/chat", {})
+        assert status == 400
+        assert "message" in error["error"].lower()
+
+    serve(chat_server, scenario)
+    chat_log.close()
+
+
+def test_chat_stream(tmp_path):
+    chat_server, chat_log = make_server(str(tmp_path))
+
+    async def scenario(port):
+        status, lines = await request(port, "POST", "/chat",
+                                      {"message": "one two three",
+                                       "stream": True})
+        assert status == 200
+        pieces = [line["text"] for line in lines if "text" in line]
+        assert "".join(pieces).strip() == "You said: one two three"
+        assert lines[-1]["done"]
+        assert lines[-1]["reply"] == "".join(pieces).strip()
+        assert all(line["session"] == lines[0]["session"] for line in lines)
+
+    serve(chat_server, scenario)
+    chat_log.close()
+
+
+class SlowStub(server.StubModel):
+
+    def __init__(self, model="stub"):
+        server.StubModel.__init__(self, model, delay=0.05)
+
+
+def test_chat_stream_disconnect_keeps_session_lock(tmp_path):
+    chat_log = chatlog.ChatLog(folder=str(tmp_path / "logs"))
+    chat_server = server.ChatServer(
+        registry.ModelRegistry(factory=SlowStub), models=("neo-small",),
+        chat_log=chat_log)
+
+    async def scenario(port):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        data = json.dumps({"message": " ".join(["word"] * 40),
+                           "stream": True}).encode("utf-8")
+        writer.write(("POST /chat HTTP/1.1\r\n"
+                      "Content-Length: " + str(len(data)) + "\r\n\r\n")
+                     .encode("latin-1") + data)
+        await writer.drain()
+        await reader.readuntil(b"session")
+        writer.close()
+        session = None
+        while session is None:
+            await asyncio.sleep(0.01)
+            session = next(iter(chat_server.sessions.values()), None)
+        while not session.lock.locked():
+            await asyncio.sleep(0.01)
+        # NOTE The lock is only released once the turn is over
+        async with session.lock:
+            assert [turn.speaker for turn in session.context.turns] == [
+                "Human", "Bot"]
+
+    serve(chat_server, scenario)
+    chat_log.close()
+
+
+def test_generate_is_batched(tmp_path):
+    chat_server, chat_log = make_server(str(tmp_path), batch_window_ms=50)
+
+    async def scenario(port):
+        results = await asyncio.gather(*[
+            request(port, "POST", "/generate", {"prompt": "Human: hi " + str(i)})
+            for i in range(4)])
+        for number, (status, reply) in enumerate(results):
+            assert status == 200
+            assert reply["text"] == " You said: hi " + str(number)
+        status, stats = await request(port, "GET", "/stats")
+        batcher = stats["batchers"]["neo-small"]
+        assert batcher["requests"] == 4
+        assert batcher["largest_batch"] > 1
+
+    serve(chat_server, scenario)
+    chat_log.close()
+
+
+class CachingStub(server.StubModel):
+
+    def cache_key(self, prompt, settings):
+        return self.response_cache.key(self.model, "base", prompt, ())
+
+
+def test_generate_uses_response_cache(tmp_path):
+    chat_log = chatlog.ChatLog(folder=str(tmp_path / "logs"))
+    response_cache = cache.ResponseCache(folder=None)
+    chat_server = server.ChatServer(
+        registry.ModelRegistry(factory=CachingStub), models=("neo-small",),
+        chat_log=chat_log, response_cache=response_cache)
+
+    async def scenario(port):
+        key = response_cache.key("stub", "base", "Human: cached", ())
+        response_cache.put(key, " from the cache")
+        status, reply = await request(port, "POST", "/generate",
+                                      {"prompt": "Human: cached"})
+        assert status == 200
+        assert reply["text"] == " from the cache"
+        assert reply["stats"]["cached"]
+        status, reply = await request(port, "POST", "/generate",
+                                      {"prompt": "Human: not cached"})
+        assert reply["text"] == " You said: not cached"
+        assert reply["stats"]["batch_size"] == 1
+        _, stats = await request(port, "GET", "/stats")
+        assert stats["batchers"]["neo-small"]["requests"] == 1
+
+    serve(chat_server, scenario)
+    chat_log.close()
+
+
+def test_generate_stream(tmp_path):
+    chat_server, chat_log = make_server(str(tmp_path))
+
+    async def scenario(port):
+        status, lines = await request(port, "POST", "/generate",
+                                      {"prompt": "Human: streamed",
+                                       "stream": True})
+        assert status == 200
+        assert lines[-1]["done"]
+        assert lines[-1]["reply"] == " You said: streamed"
+        status, error = await request(port, "POST", "/generate",
+                                      {"prompt": "x", "model": "unknown"})
+        assert status == 400
+
+    serve(chat_server, scenario)
+    chat_log.close()
+
+
+def test_queue_rejection(tmp_path):
+    chat_server, chat_log = make_server(str(tmp_path), max_concurrency=1,
+                                        max_queue=1)
+    release = threading.Event()
+
+    async def scenario(port):
+        # NOTE Holding the only slot, then filling the only queue place
+        busy = asyncio.ensure_future(chat_server.run_model(release.wait))
+        await asyncio.sleep(0.05)
+        queued = asyncio.ensure_future(chat_server.run_model(lambda: None))
+        await asyncio.sleep(0.05)
+        status, error = await request(port, "POST", "/chat",
+                                      {"message": "too many"})
+        release.set()
+        await busy
+        await queued
+        assert status == 503
+        assert chat_server.rejected == 1
+
+    serve(chat_server, scenario)
+    chat_log.close()
+
+
+def test_sessions_survive_restart(tmp_path):
+    chat_server, chat_log = make_server(str(tmp_path))
+
+    async def first(port):
+        _, reply = await request(port, "POST", "/chat",
+                                 {"message": "remember me"})
+        await request(port, "POST", "/chat",
+                      {"message": "again", "session": reply["session"]})
+        return reply["session"]
+
+    session_id = serve(chat_server, first)
+    chat_log.close()
+    # NOTE A new server reopens the conversation from the session store
+    chat_server, chat_log = make_server(str(tmp_path))
+
+    async def second(port):
+        status, listed = await request(port, "GET", "/sessions")
+        assert status == 200
+        assert session_id in [session["id"] for session in listed["sessions"]]
+        status, reply = await request(port, "POST", "/chat",
+                                      {"message": "still here",
+                                       "session": session_id})
+        assert status == 200
+        assert reply["session"] == session_id
+        turns = chat_server.sessions[session_id].context.turns
+        assert [turn.text for turn in turns][:2] == ["remember me",
+                                                     "You said: remember me"]
+        status, _ = await request(port, "POST", "/chat",
+                                  {"message": "hi", "session": "missing"})
+        assert status == 404
+
+    serve(chat_server, second)
+    chat_log.close()
@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import context  # noqa: E402
+import sessions  # noqa: E402
+
+# INSTRUCTIONS:
+# run the tests using
+# python -m pytest tests
+# The sessions are written in the temporary folder of every test.
+
+
+class CharTokenizer:
+
+    vocab_size = 256
+
+    def encode(self, text):
+        return list(text.encode("utf-8"))
+
+
+def make_conversation(*texts):
+    conversation = context.ConversationContext(preamble="Be nice\n")
+    conversation.set_tokenizer(CharTokenizer(), name="chars")
+    for number, text in enumerate(texts):
+        conversation.add("Human" if number % 2 == 0 else "Bot", text)
+    conversation.build()
+    return conversation
+
+
+# ANCHOR Saving and reopening
+def test_save_and_load(tmp_path):
+    folder = str(tmp_path)
+    conversation = make_conversation("hello there", "hi")
+    sessions.SessionStore(folder).save("one", conversation, "neo-small",
+                                       settings={"top_k": 5})
+    # NOTE A new store reads the index written by the first one
+    store = sessions.SessionStore(folder)
+    assert store.exists("one")
+    loaded, meta = store.load("one")
+    assert meta == {"id": "one", "model": "neo-small",
+                    "settings": {"top_k": 5}}
+    assert [(turn.speaker, turn.text, turn.ids) for turn in loaded.turns] == [
+        (turn.speaker, turn.text, turn.ids) for turn in conversation.turns]
+    # NOTE Same tokenizer, nothing is tokenized again
+    loaded.set_tokenizer(CharTokenizer(), name="chars")
+    loaded.build()
+    assert loaded.stats()["tokenizer_calls"] == 0
+
+
+def test_list_newest_first_and_delete(tmp_path):
+    store = sessions.SessionStore(str(tmp_path))
+    store.save("old", make_conversation("first message"), "neo-small")
+    time.sleep(0.01)
+    store.save("new", make_conversation("x" * 60), "aeona")
+    listed = store.list()
+    assert [entry["id"] for entry in listed] == ["new", "old"]
+    assert listed[0]["title"] == "x" * 40 + "..."
+    assert listed[1]["title"] == "first message"
+    store.delete("old")
+    assert not store.exists("old")
+    assert [entry["id"] for entry in
+            sessions.SessionStore(str(tmp_path)).list()] == ["new"]
+    try:
+        store.load("old")
+    except KeyError:
+        pass
+    else:
+        raise AssertionError("deleted session loaded")
+
+
+def test_pack_ids():
+    ids = [0, 1, 50256, 2 ** 31]
+    assert sessions.unpack_ids(sessions.pack_ids(ids)) == ids
+    assert sessions.pack_ids(None) is None
+    assert sessions.title_of(context.ConversationContext()) == "(empty)"
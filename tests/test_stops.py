@@ -0,0 +1,80 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stops  # noqa: E402
+
+# INSTRUCTIONS:
+# run the tests using
+# python -m pytest tests
+# The turn boundaries are checked on plain text, no model is needed.
+
+STOPS = stops.STOP_SEQUENCES
+
+
+# ANCHOR find_stop
+def test_find_stop():
+    assert stops.find_stop(" Hello there", STOPS) is None
+    assert stops.find_stop(" Hello\nHuman: hi", STOPS) == (6, "\nHuman:")
+    # NOTE Indented like the lines of the imprinting
+    assert stops.find_stop(" Hello\n  Bot: hi", STOPS) == (6, "\n  Bot:")
+    assert stops.find_stop(" Hello\nHuman: hi", ()) is None
+
+
+def test_find_stop_reply_start():
+    # NOTE The model may write its own "Bot:" line first
+    assert stops.find_stop("\nBot: Hello", STOPS) is None
+    assert stops.find_stop("\nBot: Hello", STOPS,
+                           reply_start=False) == (0, "\nBot:")
+
+
+# ANCHOR partial_stop
+def test_partial_stop():
+    assert stops.partial_stop(" Hello", STOPS) == 0
+    assert stops.partial_stop(" Hello\n", STOPS) == 1
+    assert stops.partial_stop(" Hello\nHum", STOPS) == 4
+    assert stops.partial_stop(" Hello\n  Bo", STOPS) == 5
+    assert stops.partial_stop(" Hello\nHumble", STOPS) == 0
+
+
+def test_cut_at_stop():
+    assert stops.cut_at_stop(" Hello\nHuman: hi", STOPS) == " Hello"
+    assert stops.cut_at_stop(" Hello", STOPS) == " Hello"
+
+
+# ANCHOR cut_stream
+def test_cut_stream_boundary_across_pieces():
+    pieces = [" Hello", " there\n", "Human:", " what"]
+    assert "".join(stops.cut_stream(pieces, STOPS)) == " Hello there"
+
+
+def test_cut_stream_boundary_after_flush():
+    # NOTE The streamer flushes at new lines, so the held text starts with
+    #      the new line of the boundary
+    pieces = [" Hello", " there", "\n", "Hu", "man", ": what", "\nBot:"]
+    assert list(stops.cut_stream(pieces, STOPS)) == [" Hello", " there"]
+
+
+def test_cut_stream_reply_start():
+    pieces = ["\nBot:", " Hello", "\nHuman:", " more"]
+    assert "".join(stops.cut_stream(pieces, STOPS)) == "\nBot: Hello"
+
+
+def test_cut_stream_releases_held_text():
+    pieces = [" Hello", "\n", "Humble", " pie"]
+    assert "".join(stops.cut_stream(pieces, STOPS)) == " Hello\nHumble pie"
+    assert list(stops.cut_stream([" Hello", "\nHu"], STOPS)) == [" Hello",
+                                                                "\nHu"]
+
+
+def test_cut_stream_reads_every_piece():
+    read = []
+
+    def pieces():
+        for piece in [" Hello", "\nHuman:", " one", " two"]:
+            read.append(piece)
+            yield piece
+
+    assert list(stops.cut_stream(pieces(), STOPS)) == [" Hello"]
+    assert len(read) == 4
@@ -0,0 +1,130 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import worker  # noqa: E402
+
+# INSTRUCTIONS:
+# run the tests using
+# python -m pytest tests
+# The jobs are plain functions blocked on events, the registry is a fake
+# where every model fits.
+
+
+# ANCHOR Helpers
+class FakeRegistry:
+
+    def fits(self, model, busy=()):
+        return True
+
+
+class Events:
+
+    def __init__(self):
+        self.posted = []
+        self.condition = threading.Condition()
+
+    def post(self, key, job):
+        with self.condition:
+            self.posted.append((key, job))
+            self.condition.notify_all()
+
+    def wait(self, key, job, timeout=5):
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: (key, job) in self.posted, timeout)
+
+
+def blocked(release, ran=None):
+    def run(job):
+        if ran is not None:
+            ran.append(job.data.get("name"))
+        while not release.wait(0.01):
+            if job.cancelled():
+                return None
+        return job.data.get("name")
+    return run
+
+
+def wait_state(job, state, timeout=5):
+    deadline = time.time() + timeout
+    while job.state != state and time.time() < deadline:
+        time.sleep(0.01)
+    return job.state == state
+
+
+# ANCHOR Lanes
+def test_jobs_of_a_lane_run_one_after_the_other():
+    events = Events()
+    jobs = worker.Worker(FakeRegistry(), post=events.post, max_workers=2)
+    release = threading.Event()
+    first = jobs.submit("chat", "neo-small", blocked(release), lane="chat",
+                        name="first")
+    second = jobs.submit("chat", "neo-small", blocked(release), lane="chat",
+                         name="second")
+    other = jobs.submit("train", "aeona", blocked(release), lane="train",
+                        name="other")
+    assert wait_state(first, "running")
+    assert wait_state(other, "running")
+    assert second.state == "queued"
+    assert jobs.pending() == 3
+    release.set()
+    assert events.wait(worker.DONE, second)
+    assert events.wait(worker.DONE, other)
+    assert [first.result, second.result, other.result] == ["first", "second",
+                                                          "other"]
+    jobs.shutdown()
+
+
+# ANCHOR Cancellation
+def test_cancelled_queued_job_never_runs():
+    events = Events()
+    jobs = worker.Worker(FakeRegistry(), post=events.post, max_workers=1)
+    release = threading.Event()
+    ran = []
+    running = jobs.submit("chat", "neo-small", blocked(release, ran),
+                          name="running")
+    queued = jobs.submit("chat", "neo-small", blocked(release, ran),
+                         name="queued")
+    assert wait_state(running, "running")
+    queued.cancel()
+    assert queued.state == "cancelled"
+    assert events.wait(worker.CANCELLED, queued)
+    # NOTE A running job sees the flag and stops
+    running.cancel()
+    assert events.wait(worker.CANCELLED, running)
+    assert running.result is None
+    assert ran == ["running"]
+    jobs.shutdown()
+
+
+def test_cancel_all_of_a_kind():
+    events = Events()
+    jobs = worker.Worker(FakeRegistry(), post=events.post, max_workers=1)
+    release = threading.Event()
+    chat = jobs.submit("chat", "neo-small", blocked(release))
+    train = jobs.submit("train", "neo-small", blocked(release))
+    assert wait_state(chat, "running")
+    jobs.cancel_all("chat")
+    assert events.wait(worker.CANCELLED, chat)
+    release.set()
+    assert events.wait(worker.DONE, train)
+    jobs.shutdown()
+
+
+def test_failed_job():
+    events = Events()
+    jobs = worker.Worker(FakeRegistry(), post=events.post, max_workers=1)
+
+    def fail(job):
+        job.progress("about to fail")
+        raise Exception("broken")
+
+    job = jobs.submit("chat", "neo-small", fail)
+    assert events.wait(worker.ERROR, job)
+    assert (job.state, str(job.error)) == ("failed", "broken")
+    assert (worker.PROGRESS, job) in events.posted
+    jobs.shutdown()
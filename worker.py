@@ -0,0 +1,221 @@
+import itertools
+import threading
+import time
+import traceback
+
+import telemetry
+
+# INSTRUCTIONS:
+# declare a worker once per process using
+# worker = worker.Worker(model_registry, post=window.write_event_value)
+# then submit jobs from the event loop instead of running them inline
+# job = worker.load(model)
+# job = worker.generate(model, prompt)
+# job = worker.train(model, [file_or_folder, ...])
+# or any custom function taking the job as its only argument with
+# job = worker.submit("kind", model, function)
+# The worker posts the events below back to the window, with the job as
+# value, so the event loop never blocks:
+#   -JOB-PROGRESS-   job.message changed
+#   -JOB-PARTIAL-    job.partial contains the text generated so far
+#   -JOB-DONE-       job.result is ready
+#   -JOB-ERROR-      job.error contains the exception
+#   -JOB-CANCELLED-  the job was cancelled
+# Jobs sharing a lane (by default the model) run one after the other, jobs
+# on different lanes and models run together if the memory budget of the
+# registry allows it.
+
+PROGRESS = "-JOB-PROGRESS-"
+PARTIAL = "-JOB-PARTIAL-"
+DONE = "-JOB-DONE-"
+ERROR = "-JOB-ERROR-"
+CANCELLED = "-JOB-CANCELLED-"
+
+
+# ANCHOR A unit of work
+class Job:
+
+    def __init__(self, worker, job_id, kind, model, function, lane, data):
+        self.worker = worker
+        self.id = job_id
+        self.kind = kind
+        self.model = model
+        self.function = function
+        self.lane = lane or model
+        self.data = data
+        self.state = "queued"
+        self.message = ""
+        self.partial = ""
+        self.result = None
+        self.error = None
+        self.cancel_event = threading.Event()
+        self.created = time.perf_counter()
+
+    # NOTE Called by the job function to report back to the window
+    def progress(self, message):
+        self.message = message
+        self.worker.post(PROGRESS, self)
+
+    def stream(self, text):
+        # NOTE Accumulating, so a missed event never loses text
+        self.partial += text
+        self.worker.post(PARTIAL, self)
+
+    def cancel(self):
+        self.worker.cancel(self)
+
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+
+class Worker:
+
+    def __init__(self, registry, post=None, max_workers=2):
+        self.registry = registry
+        self.post_function = post
+        self.queue = []
+        self.running = []
+        self.condition = threading.Condition()
+        self.ids = itertools.count(1)
+        self.closing = False
+        self.threads = []
+        for number in range(max_workers):
+            thread = threading.Thread(target=self.loop,
+                                      name="worker-" + str(number),
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # ANCHOR Posting events back
+    def post(self, key, job):
+        if self.post_function is not None:
+            try:
+                self.post_function(key, job)
+            except Exception:
+                # NOTE The window may already be closed
+                pass
+
+    # ANCHOR Submitting jobs
+    def submit(self, kind, model, function, lane=None, **data):
+        with self.condition:
+            job = Job(self, next(self.ids), kind, model, function, lane, data)
+            self.queue.append(job)
+            self.condition.notify_all()
+        return job
+
+    def load(self, model, lane=None, **options):
+        def run(job):
+            job.progress("loading model, please be patient...")
+            self.registry.get(model, **options)
+            return model
+        return self.submit("load", model, run, lane=lane)
+
+    def generate(self, model, prompt, lane=None, **options):
+        def run(job):
+            if not self.registry.is_loaded(model, **options):
+                job.progress("loading model, please be patient...")
+            gpt = self.registry.get(model, **options)
+            if job.cancelled():
+                return None
+            job.progress("generating response...")
+            return gpt.generate(prompt)
+        return self.submit("generate", model, run, lane=lane)
+
+    def train(self, model, paths, epochs=1, lane=None, artifacts=None,
+              **options):
+        # NOTE paths are files or folders, see pipeline.py
+        def run(job):
+            # NOTE Waiting for the download with progress (see artifacts.py)
+            if artifacts is not None and not artifacts.wait(
+                    model, progress=job.progress, should_stop=job.cancelled):
+                return None
+            job.progress("loading model, please be patient...")
+            gpt = self.registry.get(model, **options)
+            if job.cancelled():
+                return None
+            import pipeline
+            trainer = pipeline.TrainingPipeline(gpt)
+            return trainer.run(paths, epochs=epochs,
+                               progress=job.progress,
+                               should_stop=job.cancelled)
+        return self.submit("train", model, run, lane=lane or "train:" + model)
+
+    # ANCHOR Cancelling jobs
+    def cancel(self, job):
+        job.cancel_event.set()
+        with self.condition:
+            if job in self.queue:
+                # NOTE Queued jobs never start
+                self.queue.remove(job)
+                job.state = "cancelled"
+                self.post(CANCELLED, job)
+
+    def cancel_all(self, kind=None):
+        with self.condition:
+            jobs = list(self.queue) + list(self.running)
+        for job in jobs:
+            if kind is None or job.kind == kind:
+                self.cancel(job)
+
+    def pending(self):
+        with self.condition:
+            return len(self.queue) + len(self.running)
+
+    # ANCHOR Choosing the next job
+    # NOTE Must be called with the condition held
+    def next_job(self):
+        busy_lanes = set(job.lane for job in self.running)
+        busy_models = [job.model for job in self.running]
+        for job in self.queue:
+            if job.lane in busy_lanes or job.model in busy_models:
+                continue
+            # NOTE Running next to other models only when memory allows
+            if busy_models and not self.registry.fits(job.model, busy=busy_models):
+                continue
+            return job
+        return None
+
+    # ANCHOR Worker thread
+    def loop(self):
+        while True:
+            with self.condition:
+                job = self.next_job()
+                while job is None and not self.closing:
+                    self.condition.wait()
+                    job = self.next_job()
+                if self.closing:
+                    return
+                self.queue.remove(job)
+                self.running.append(job)
+                job.state = "running"
+            started = time.perf_counter()
+            telemetry.observe("worker.queue_wait", started - job.created)
+            try:
+                result = job.function(job)
+                if job.cancelled():
+                    job.state = "cancelled"
+                    event = CANCELLED
+                else:
+                    job.result = result
+                    job.state = "done"
+                    event = DONE
+            except Exception as error:
+                traceback.print_exc()
+                job.error = error
+                job.state = "failed"
+                event = ERROR
+            telemetry.observe("worker." + job.kind, time.perf_counter() - started)
+            with self.condition:
+                self.running.remove(job)
+                self.condition.notify_all()
+            # NOTE Posting after the job left the running list
+            self.post(event, job)
+
+    # ANCHOR Stopping the threads
+    def shutdown(self):
+        with self.condition:
+            self.closing = True
+            for job in self.queue:
+                job.cancel_event.set()
+            self.queue = []
+            self.condition.notify_all()